@@ -12,6 +12,8 @@ ROOT_CERT_URL="${SYSTEMPREP_ROOT_CERT_URL}"
 SYSTEMPREPMASTERSCRIPTSOURCE="${SYSTEMPREP_MASTER_URL:-https://s3.amazonaws.com/systemprep/MasterScripts/systemprep-linuxmaster.py}"
 SALTCONTENTURL="${SYSTEMPREP_SALTCONTENT_URL:-https://systemprep-content.s3.amazonaws.com/linux/salt/salt-content.zip}"
 SOURCEISS3BUCKET="${SYSTEMPREP_USES3UTILS:-False}"
+GOVERNED="${SYSTEMPREP_GOVERNED:-False}"
+SALTCONTENTDELTA="${SYSTEMPREP_SALTCONTENTDELTA:-False}"
 
 # System variables
 __SCRIPTPATH=$(readlink -f ${0})
@@ -83,6 +85,11 @@ print_usage()
   -u|--use-s3-utils|\$SYSTEMPREP_USES3UTILS
       Use S3 utils (awscli, python boto) instead of http utils (curl, wget,
       python requests) to download content. Requires '-g|--region'.
+  -G|--governed|\$SYSTEMPREP_GOVERNED
+      Run at a low CPU and I/O priority.
+  -d|--salt-content-delta|\$SYSTEMPREP_SALTCONTENTDELTA
+      Update the salt content in place, fetching only the changed members of
+      the zip archive.
   -h|--help
       Display this message.
 
@@ -182,11 +189,11 @@ update_trust() {
 }  # --- end of function update_trust  ---
 
 # Parse command-line parameters
-SHORTOPTS="e:p:ns:g:c:r:m:o:uh"
+SHORTOPTS="e:p:ns:g:c:r:m:o:uGdh"
 LONGOPTS=(
     "environment:,oupath:,noreboot,saltstates:,region:,awscli-url:,"
     "root-cert-url:,systemprep-master-url:,salt-content-url:,use-s3-utils,"
-    "help")
+    "governed,salt-content-delta,help")
 LONGOPTS_STRING=$(IFS=$''; echo "${LONGOPTS[*]}")
 ARGS=$(getopt \
     --options "${SHORTOPTS}" \
@@ -228,6 +235,10 @@ while [ true ]; do
             shift; SALTCONTENTURL="${1}" ;;
         -u|--use-s3-utils)
             SOURCEISS3BUCKET="True" ;;
+        -G|--governed)
+            GOVERNED="True" ;;
+        -d|--salt-content-delta)
+            SALTCONTENTDELTA="True" ;;
         -h|--help)
             print_usage; exit 0 ;;
         --)
@@ -249,7 +260,9 @@ SYSTEMPREPPARAMS=(
     "EntEnv=${ENTENV}"
     "OuPath=${OUPATH}"
     "SourceIsS3Bucket=${SOURCEISS3BUCKET}"
-    "AwsRegion=${AWSREGION}")
+    "AwsRegion=${AWSREGION}"
+    "Governed=${GOVERNED}"
+    "SaltContentDelta=${SALTCONTENTDELTA}")
 
 # Setup logging
 if [[ ! -d ${LOGDIR} ]]; then
@@ -315,10 +328,6 @@ else
             ( echo "Could not download file. Check the url and whether 'curl' is in the path. Quitting..." && exit 1 )
 fi
 
-# Convert the parameter list to a string
-# The string will be converted to a python dictionary by the master script
-PARAMSTRING=$( IFS=$' '; echo "${SYSTEMPREPPARAMS[*]}" )
-
 # Temporarily suppress rsyslog rate limiting
 if [[ -e /etc/rsyslog.conf ]]; then
     echo "Temporarily disabling rsyslog rate limiting"
@@ -348,24 +357,15 @@ fi
 
 # Write out the SystemPrep parameters
 echo "Writing SystemPrep Parameters to log file..."
-echo "   SaltStates=${SALTSTATES}"
-echo "   SaltContentSource=${SALTCONTENTURL}"
-echo "   NoReboot=${NOREBOOT}"
-echo "   EntEnv=${ENTENV}"
-echo "   OuPath=${OUPATH}"
-echo "   SourceIsS3Bucket=${SOURCEISS3BUCKET}"
-echo "   AwsRegion=${AWSREGION}"
+for PARAM in "${SYSTEMPREPPARAMS[@]}"; do
+    echo "   ${PARAM}"
+done
 
 # Execute the master script
+# The master waits for this script to exit before rebooting
+export SYSTEMPREP_BOOTSTRAP_PID=$$
 echo "Running the SystemPrep master script -- ${SCRIPTFULLPATH}"
-python ${SCRIPTFULLPATH} \
-    "SaltStates=${SALTSTATES}" \
-    "SaltContentSource=${SALTCONTENTURL}" \
-    "NoReboot=${NOREBOOT}" \
-    "EntEnv=${ENTENV}" \
-    "OuPath=${OUPATH}" \
-    "SourceIsS3Bucket=${SOURCEISS3BUCKET}" \
-    "AwsRegion=${AWSREGION}" || \
+python ${SCRIPTFULLPATH} "${SYSTEMPREPPARAMS[@]}" || \
     error_result=$?  # If error, capture the exit code
 
 # Restore prior logging config
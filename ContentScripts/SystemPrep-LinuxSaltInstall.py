@@ -1,44 +1,236 @@
 #!/usr/bin/env python
+import bz2
+import fcntl
+import hashlib
+import json
 import os
+import platform
+import random
 import sys
 import tempfile
+import threading
+import time
 import urllib2
 import shutil
 import tarfile
 import zipfile
 import re
+import resource
+import StringIO
+import struct
+import subprocess
+import zlib
 import boto
 
 from boto.exception import BotoClientError
 from boto.exception import S3ResponseError
+from distutils.spawn import find_executable
 
 
-def download_file(url, filename, sourceiss3bucket=None):
+# --- begin shared block: downloads ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+_s3_connection = None
+
+
+def _get_s3_connection():
     """
-Download the file from `url` and save it locally under `filename`.
+Returns a connection to S3, reusing the connection of earlier downloads.
+    :rtype : boto.s3.connection.S3Connection
+    """
+    global _s3_connection
+    if _s3_connection is None:
+        _s3_connection = boto.connect_s3()
+    return _s3_connection
+
+
+class _HashingWriter(object):
+    """
+    File-like wrapper that updates a hash object with every block written to
+    the underlying file, so the digest is computed as the download streams in.
+    """
+    def __init__(self, fileobj, hashobj):
+        self.fileobj = fileobj
+        self.hashobj = hashobj
+        self.name = fileobj.name
+
+    def write(self, data):
+        self.hashobj.update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# --- begin shared block: throttling ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+class _TokenBucket(object):
+    """
+    Token bucket that caps the average download rate at `rate` bytes per
+    second, allowing bursts of up to one second of data. Shared by every
+    download in the process.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class _ThrottledWriter(object):
+    """
+    File-like wrapper that takes a token from the download bucket for every
+    byte written to the underlying file, if a rate limit is set, and counts
+    the bytes downloaded by the process.
+    """
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+        self.name = fileobj.name
+
+    def write(self, data):
+        global _download_bytes
+        _download_bytes += len(data)
+        if self.bucket:
+            self.bucket.consume(len(data))
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+_download_throttle = None
+_download_bytes = 0
+_download_retries = 5
+_download_backoff = 0.0
+_download_backoff_min = 1.0
+_download_backoff_max = 60.0
+_artifact_dir = None
+
+
+def configure_downloads(downloadratelimit=None, downloadretries=None,
+                        artifactdir=None):
+    """
+Sets the bandwidth cap, the throttling retry limit and the shared artifact
+directory for every download made by this script.
+    :rtype : bool
+    :param downloadratelimit: str, maximum download rate in bytes per second.
+                              '0' or None disables the cap
+    :param downloadretries: str, number of times to retry a request the source
+                            rejected because it is throttling requests
+    :param artifactdir: str, directory of downloaded artifacts shared by
+                        concurrent runs. None downloads every file directly
+    """
+    global _download_throttle, _download_retries, _artifact_dir
+    rate = int(downloadratelimit or 0)
+    _download_throttle = _TokenBucket(rate) if rate > 0 else None
+    if downloadretries is not None:
+        _download_retries = int(downloadretries)
+    _artifact_dir = artifactdir or None
+    return True
+
+
+def _is_throttled(exc):
+    """
+Returns True if `exc` is a response from a source that is throttling
+requests, e.g. an S3 503 SlowDown.
+    :rtype : bool
+    :param exc: Exception, error raised by urllib2 or boto
+    """
+    status = getattr(exc, 'status', None) or getattr(exc, 'code', None)
+    return status in (429, 503) or getattr(exc, 'error_code', None) in \
+        ('SlowDown', 'Throttling', 'RequestLimitExceeded')
+
+
+def _call_with_backoff(url, func, *args):
+    """
+Returns `func(*args)`, retrying up to `downloadretries` times while the
+source throttles the request. The backoff delay is shared by all downloads:
+it doubles with every throttled response and halves with every success, so
+later requests slow down as long as the source is overloaded. Each wait is
+randomized so a fleet of systems does not retry in lockstep.
+    :param url: str, url being requested, for messages
+    :param func: function that makes the request
+    :param args: arguments to `func`
+    """
+    global _download_backoff
+    attempt = 0
+    while True:
+        if _download_backoff:
+            time.sleep(random.uniform(_download_backoff / 2, _download_backoff))
+        try:
+            result = func(*args)
+        except Exception as exc:
+            if not _is_throttled(exc):
+                raise
+            _download_backoff = min(_download_backoff_max,
+                                    max(_download_backoff_min,
+                                        _download_backoff * 2))
+            if attempt >= _download_retries:
+                raise SystemError('Source is still throttling requests after '
+                                  '{0} retries.\n'
+                                  'url = {1}\n'
+                                  'Exception: {2}'
+                                  .format(attempt, url, exc))
+            attempt += 1
+            print('Source is throttling requests, backing off -- \n'
+                  '    url     = {0}\n'
+                  '    attempt = {1}\n'
+                  '    backoff = {2:.1f} seconds'.format(url, attempt,
+                                                         _download_backoff))
+            continue
+        _download_backoff = _download_backoff / 2 \
+            if _download_backoff > _download_backoff_min else 0.0
+        return result
+
+# --- end shared block: throttling ---
+
+
+# ETag the source sent with each url downloaded by `_fetch_to_fileobj`
+_download_etags = {}
+
+
+def _fetch_to_fileobj(url, fileobj, sourceiss3bucket=None):
+    """
+Download the file from `url` and write it to the open file object `fileobj`.
     :rtype : bool
     :param url:
-    :param filename:
+    :param fileobj:
     :param sourceiss3bucket:
     """
     conn = None
+    filename = fileobj.name
 
     if sourceiss3bucket:
         bucket_name = url.split('/')[3]
         key_name = '/'.join(url.split('/')[4:])
         try:
-            conn = boto.connect_s3()
+            conn = _get_s3_connection()
             bucket = conn.get_bucket(bucket_name)
             key = bucket.get_key(key_name)
-            key.get_contents_to_filename(filename=filename)
-        except (NameError, BotoClientError, S3ResponseError):
+            key.get_contents_to_file(fileobj)
+        except (NameError, BotoClientError, S3ResponseError) as exc:
+            if _is_throttled(exc):
+                raise
             try:
                 bucket_name = url.split('/')[2].split('.')[0]
                 key_name = '/'.join(url.split('/')[3:])
                 bucket = conn.get_bucket(bucket_name)
                 key = bucket.get_key(key_name)
-                key.get_contents_to_filename(filename=filename)
+                key.get_contents_to_file(fileobj)
             except Exception as exc:
+                if _is_throttled(exc):
+                    raise
                 raise SystemError('Unable to download file from S3 bucket.\n'
                                   'url = {0}\n'
                                   'bucket = {1}\n'
@@ -48,6 +240,8 @@ Download the file from `url` and save it locally under `filename`.
                                   .format(url, bucket_name, key_name,
                                           filename, exc))
         except Exception as exc:
+            if _is_throttled(exc):
+                raise
             raise SystemError('Unable to download file from S3 bucket.\n'
                               'url = {0}\n'
                               'bucket = {1}\n'
@@ -56,15 +250,18 @@ Download the file from `url` and save it locally under `filename`.
                               'Exception: {4}'
                               .format(url, bucket_name, key_name,
                                       filename, exc))
+        _download_etags[url] = key.etag
         print('Downloaded file from S3 bucket -- \n'
               '    url      = {0}\n'
               '    filename = {1}'.format(url, filename))
     else:
         try:
             response = urllib2.urlopen(url)
-            with open(filename, 'wb') as outfile:
-                shutil.copyfileobj(response, outfile)
+            shutil.copyfileobj(response, fileobj)
+            _download_etags[url] = response.info().getheader('ETag')
         except Exception as exc:
+            if _is_throttled(exc):
+                raise
             # TODO: Update `except` logic
             raise SystemError('Unable to download file from web server.\n'
                               'url = {0}\n'
@@ -77,6 +274,573 @@ Download the file from `url` and save it locally under `filename`.
     return True
 
 
+def _download_to_fileobj(url, fileobj, sourceiss3bucket=None):
+    """
+Download the file from `url` and write it to the open file object `fileobj`,
+within the download rate limit, backing off while the source throttles
+requests. Throttling is reported in the response status, before any data is
+written, so a throttled request is safe to repeat. If an artifact directory is
+set, the file is copied from the shared copy in that directory instead.
+    :rtype : bool
+    :param url:
+    :param fileobj:
+    :param sourceiss3bucket:
+    """
+    if _artifact_dir:
+        artifact = _fetch_artifact(url, sourceiss3bucket)
+        with open(artifact, 'rb') as f:
+            shutil.copyfileobj(f, fileobj)
+        print('Copied file from the artifact directory -- \n'
+              '    url      = {0}\n'
+              '    artifact = {1}'.format(url, artifact))
+        return True
+    return _call_with_backoff(url, _fetch_to_fileobj, url,
+                              _ThrottledWriter(fileobj, _download_throttle),
+                              sourceiss3bucket)
+
+
+def _get_artifact_path(url):
+    """
+Returns the path of the copy of `url` in the artifact directory. The path
+mirrors the host and path of the url, so distinct urls never collide.
+    :rtype : str
+    :param url: str, url of the artifact
+    """
+    return os.sep.join([_artifact_dir] + url.split('://', 1)[-1].split('/'))
+
+
+def _fetch_artifact(url, sourceiss3bucket=None):
+    """
+Returns the path of the copy of `url` in the artifact directory, downloading
+it first if no run sharing the directory has done so yet. A lock file next
+to the artifact makes concurrent runs wait for the one that is downloading
+it, so each artifact is downloaded once. Artifacts are never refreshed; use a
+new directory for each batch.
+    :rtype : str
+    :param url: str, url of the artifact
+    :param sourceiss3bucket:
+    """
+    artifact = _get_artifact_path(url)
+    try:
+        os.makedirs(os.path.dirname(artifact))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(artifact)):
+            raise
+    with open('{0}.lock'.format(artifact), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isfile(artifact):
+                partial = '{0}.part'.format(artifact)
+                with open(partial, 'wb') as f:
+                    _call_with_backoff(url, _fetch_to_fileobj, url,
+                                       _ThrottledWriter(f, _download_throttle),
+                                       sourceiss3bucket)
+                os.rename(partial, artifact)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return artifact
+
+
+_artifact_store = None
+_artifact_peers = []
+# peers are asked in random order, so a missing artifact costs at most this
+# many timeouts before the origin url is used
+_artifact_peer_attempts = 3
+_artifact_peer_timeout = 2
+
+
+def configure_peers(artifactstore=None, artifactpeers=None):
+    """
+Sets the local store of verified artifacts and the peers to query for
+artifacts before their origin url.
+    :rtype : bool
+    :param artifactstore: str, directory in which to keep a copy of every
+                          verified artifact, named by its SHA-256 digest.
+                          None disables the store
+    :param artifactpeers: str, comma-separated `host:port` or base urls of
+                          peers serving their artifact stores with
+                          `Utils/systemprep-artifactpeer.py`
+    """
+    global _artifact_store, _artifact_peers
+    _artifact_store = artifactstore or None
+    _artifact_peers = []
+    for peer in (artifactpeers or '').split(','):
+        peer = peer.strip().rstrip('/')
+        if peer:
+            _artifact_peers.append(peer if '://' in peer
+                                   else 'http://{0}'.format(peer))
+    return True
+
+
+def _get_file_digest(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def store_artifact(filepath, sha256):
+    """
+Copies the verified file at `filepath` into the artifact store as
+`<artifactstore>/sha256/<sha256>`, if the store is enabled.
+    :rtype : bool
+    :param filepath: str, path of the verified file
+    :param sha256: str, hex digest of the file
+    """
+    if not _artifact_store:
+        return False
+    storedir = os.sep.join((_artifact_store, 'sha256'))
+    try:
+        if not os.path.isdir(storedir):
+            os.makedirs(storedir)
+        fd, partial = tempfile.mkstemp(dir=storedir)
+        os.close(fd)
+    except (IOError, OSError) as exc:
+        print('Could not add the file to the artifact store -- {0}'
+              .format(exc))
+        return False
+    try:
+        shutil.copyfile(filepath, partial)
+        os.chmod(partial, 0o644)
+        os.rename(partial, os.sep.join((storedir, sha256.lower())))
+    except (IOError, OSError) as exc:
+        print('Could not add the file to the artifact store -- {0}'
+              .format(exc))
+        os.remove(partial)
+        return False
+    return True
+
+
+def fetch_from_peers(sha256, filename):
+    """
+Saves the artifact with the SHA-256 digest `sha256` to `filename` from the
+local artifact store, or from the first peer that serves it. At most
+`_artifact_peer_attempts` peers, chosen at random, are asked. Every copy is
+verified against the digest; a peer that serves a bad copy is skipped.
+Returns False if no verified copy was found, so the caller can fall back to
+the origin url.
+    :rtype : bool
+    :param sha256: str, hex digest of the artifact
+    :param filename: str, path in which to save the artifact
+    """
+    sha256 = sha256.lower()
+    if _artifact_store:
+        stored = os.sep.join((_artifact_store, 'sha256', sha256))
+        if os.path.isfile(stored) and sha256 == _get_file_digest(stored):
+            shutil.copyfile(stored, filename)
+            print('Copied file from the artifact store -- \n'
+                  '    sha256   = {0}\n'
+                  '    filename = {1}'.format(sha256, filename))
+            return True
+    for peer in random.sample(_artifact_peers, min(len(_artifact_peers),
+                                                   _artifact_peer_attempts)):
+        url = '{0}/sha256/{1}'.format(peer, sha256)
+        try:
+            response = urllib2.urlopen(url, timeout=_artifact_peer_timeout)
+            with open(filename, 'wb') as outfile:
+                writer = _HashingWriter(outfile, hashlib.sha256())
+                shutil.copyfileobj(response,
+                                   _ThrottledWriter(writer,
+                                                    _download_throttle))
+        except Exception:
+            continue
+        if sha256 == writer.hashobj.hexdigest():
+            print('Downloaded file from peer -- \n'
+                  '    url      = {0}\n'
+                  '    filename = {1}'.format(url, filename))
+            store_artifact(filename, sha256)
+            return True
+        print('Peer served a file that does not match its digest -- {0}'
+              .format(url))
+    return False
+
+
+def download_file(url, filename, sourceiss3bucket=None, sha256=None,
+                  retries=2):
+    """
+Download the file from `url` and save it locally under `filename`.
+The SHA-256 digest is computed while the file is written, so verification does
+not cost a second read of the file. If `sha256` is given and the digest does
+not match, the file is fetched again, up to `retries` times.
+If `sha256` is given, the file is first looked up by its digest in the
+artifact store and on peers, see `fetch_from_peers`, and verified files are
+added to the artifact store.
+Returns the hex digest of the downloaded file.
+    :rtype : str
+    :param url:
+    :param filename:
+    :param sourceiss3bucket:
+    :param sha256: str, expected hex digest of the file
+    :param retries: int, number of re-fetches to attempt on a digest mismatch
+    """
+    if sha256 and fetch_from_peers(sha256, filename):
+        return sha256.lower()
+
+    digest = None
+    for attempt in range(retries + 1):
+        try:
+            with open(filename, 'wb') as outfile:
+                writer = _HashingWriter(outfile, hashlib.sha256())
+                _download_to_fileobj(url, writer, sourceiss3bucket)
+        except IOError as exc:
+            raise SystemError('Unable to write downloaded file.\n'
+                              'url = {0}\n'
+                              'filename = {1}\n'
+                              'Exception: {2}'
+                              .format(url, filename, exc))
+        digest = writer.hashobj.hexdigest()
+        if not sha256 or digest == sha256.lower():
+            if sha256:
+                print('Verified SHA-256 digest of {0} -- {1}'
+                      .format(filename, digest))
+                store_artifact(filename, digest)
+            return digest
+        print('SHA-256 digest mismatch, re-fetching file -- \n'
+              '    url      = {0}\n'
+              '    expected = {1}\n'
+              '    actual   = {2}'.format(url, sha256, digest))
+        if _artifact_dir and os.path.isfile(_get_artifact_path(url)):
+            os.remove(_get_artifact_path(url))
+
+    raise SystemError('Downloaded file does not match the published '
+                      'SHA-256 digest.\n'
+                      'url = {0}\n'
+                      'filename = {1}\n'
+                      'expected = {2}\n'
+                      'actual = {3}'
+                      .format(url, filename, sha256, digest))
+
+
+def get_artifact_digest(url, sourceiss3bucket=None):
+    """
+Returns the SHA-256 digest published for the artifact at `url`.
+The digest is read from the manifest published next to the artifact,
+`<url>.sha256`, which holds the hex digest followed by the file name, as
+written by `sha256sum`.
+    :rtype : str
+    :param url: str, url of the artifact
+    :param sourceiss3bucket:
+    """
+    manifesturl = '{0}.sha256'.format(url)
+    manifest = StringIO.StringIO()
+    manifest.name = manifesturl.split('/')[-1]
+    _download_to_fileobj(manifesturl, manifest, sourceiss3bucket)
+    fields = manifest.getvalue().split()
+    if not fields or not re.match('^[0-9a-fA-F]{64}$', fields[0]):
+        raise SystemError('Artifact manifest does not contain a SHA-256 '
+                          'digest.\n'
+                          'url = {0}'.format(manifesturl))
+    return fields[0].lower()
+
+# --- end shared block: downloads ---
+
+
+def _get_s3_key(url):
+    """
+Returns the boto key object for the S3 `url`. Tries the path-style form of
+the url first, then the virtual-hosted form, the same as `download_file`.
+    :rtype : boto.s3.key.Key
+    :param url: str, url of the object in S3
+    """
+    conn = _get_s3_connection()
+    parts = url.split('/')
+    for bucket_name, key_name in ((parts[3], '/'.join(parts[4:])),
+                                  (parts[2].split('.')[0],
+                                   '/'.join(parts[3:]))):
+        try:
+            key = conn.get_bucket(bucket_name).get_key(key_name)
+        except (BotoClientError, S3ResponseError) as exc:
+            if _is_throttled(exc):
+                raise
+            continue
+        if key is not None:
+            return key
+    raise SystemError('Unable to find the object in an S3 bucket.\n'
+                      'url = {0}'.format(url))
+
+
+def _fetch_range(url, headers, sourceiss3bucket=None):
+    """
+Makes one range request for `read_range`.
+    :rtype : str
+    """
+    global _download_bytes
+    if sourceiss3bucket:
+        data = _get_s3_key(url).get_contents_as_string(headers=headers)
+    else:
+        response = urllib2.urlopen(urllib2.Request(url, headers=headers))
+        if 206 != response.getcode():
+            raise SystemError('Server does not support range requests.')
+        data = response.read()
+    _download_bytes += len(data)
+    if _download_throttle:
+        _download_throttle.consume(len(data))
+    return data
+
+
+def read_range(url, byterange, sourceiss3bucket=None):
+    """
+Returns the bytes of `url` selected by `byterange`, using an HTTP range
+request. Raises SystemError if the server ignores the range. Range requests
+share the download rate limit and backoff of `download_file`.
+    :rtype : str
+    :param url: str, url of the remote file
+    :param byterange: str, range specifier, e.g. '0-1023' or '-65536'
+    :param sourceiss3bucket:
+    """
+    headers = {'Range': 'bytes={0}'.format(byterange)}
+    try:
+        return _call_with_backoff(url, _fetch_range, url, headers,
+                                  sourceiss3bucket)
+    except Exception as exc:
+        raise SystemError('Unable to read byte range from remote file.\n'
+                          'url = {0}\n'
+                          'range = {1}\n'
+                          'Exception: {2}'
+                          .format(url, byterange, exc))
+
+
+_zip_eocd = struct.Struct('<4s4H2LH')
+_zip_cd_entry = struct.Struct('<4s6H3L5H2L')
+_zip_max_eocd_size = _zip_eocd.size + 0xffff
+
+
+def get_zip_members(url, sourceiss3bucket=None):
+    """
+Reads the central directory of the remote zip archive at `url` with range
+requests, without downloading the member data.
+Returns a dictionary keyed by member name. Each value is a dictionary with the
+keys 'crc', 'compress_size', 'file_size', 'compress_type', 'flags' and
+'offset'. The local header offsets are used to compute the byte range of each
+member, so every value also has an 'end' key, the offset of the first byte
+after the member. Returns None if the archive uses zip64 extensions.
+    :rtype : dict
+    :param url: str, url of the zip archive
+    :param sourceiss3bucket:
+    """
+    tail = read_range(url, '-{0}'.format(_zip_max_eocd_size),
+                      sourceiss3bucket)
+    eocdindex = tail.rfind('PK\x05\x06')
+    if eocdindex < 0:
+        raise SystemError('Could not find the end of the central directory '
+                          'in the zip archive.\n'
+                          'url = {0}'.format(url))
+    (signature, disk, cddisk, diskentries, entries, cdsize, cdoffset,
+     commentlen) = _zip_eocd.unpack(
+        tail[eocdindex:eocdindex + _zip_eocd.size])
+    if 0xffff in (diskentries, entries) or 0xffffffff in (cdsize, cdoffset):
+        return None
+
+    # The central directory immediately precedes the EOCD record, so it is
+    # usually already inside the tail that was just read
+    tailoffset = cdoffset + cdsize - eocdindex
+    if cdoffset >= tailoffset:
+        centraldir = tail[cdoffset - tailoffset:eocdindex]
+    else:
+        centraldir = read_range(url, '{0}-{1}'.format(
+            cdoffset, cdoffset + cdsize - 1), sourceiss3bucket)
+
+    members = {}
+    position = 0
+    for _ in range(entries):
+        fields = _zip_cd_entry.unpack(
+            centraldir[position:position + _zip_cd_entry.size])
+        namelen, extralen, commentlen = fields[10:13]
+        position += _zip_cd_entry.size
+        name = centraldir[position:position + namelen]
+        position += namelen + extralen + commentlen
+        members[name] = {
+            'flags': fields[3],
+            'compress_type': fields[4],
+            'crc': fields[7],
+            'compress_size': fields[8],
+            'file_size': fields[9],
+            'offset': fields[16],
+        }
+
+    # A member's bytes run from its local header to the next local header,
+    # or to the central directory for the last member
+    offsets = sorted(m['offset'] for m in members.values()) + [cdoffset]
+    ends = dict(zip(offsets[:-1], offsets[1:]))
+    for member in members.values():
+        member['end'] = ends[member['offset']]
+    return members
+
+
+def _get_file_crc(filepath):
+    """
+Returns the CRC-32 of the local file at `filepath`, as stored in zip headers.
+    :rtype : int
+    :param filepath: str, path to the file
+    """
+    crc = 0
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+
+def _get_member_path(to_directory, name):
+    """
+Returns the path under `to_directory` of the zip member `name`, or None if the
+name is absolute or resolves outside `to_directory`.
+    :rtype : str
+    :param to_directory: str, path to the target directory
+    :param name: str, name of the member in the archive
+    """
+    if not name or name.startswith(('/', '\\')) or ':' in name.split('/')[0]:
+        return None
+    root = os.path.abspath(to_directory)
+    filepath = os.path.abspath(os.path.join(root, name))
+    if not filepath.startswith(root + os.sep):
+        return None
+    return filepath
+
+
+def _extract_zip_member(name, member, data, to_directory):
+    """
+Decompresses the raw local record of a zip member, verifies its CRC-32, and
+writes it under `to_directory`.
+    :rtype : bool
+    :param name: str, name of the member in the archive
+    :param member: dict, member entry as returned by `get_zip_members`
+    :param data: str, bytes of the member's local header and data
+    :param to_directory: str, path to the target directory
+    """
+    namelen, extralen = struct.unpack('<2H', data[26:30])
+    start = 30 + namelen + extralen
+    payload = data[start:start + member['compress_size']]
+    if zipfile.ZIP_STORED == member['compress_type']:
+        contents = payload
+    else:
+        contents = zlib.decompress(payload, -zlib.MAX_WBITS)
+    if zlib.crc32(contents) & 0xffffffff != member['crc']:
+        raise SystemError('CRC-32 mismatch in fetched zip member: {0}'
+                          .format(name))
+
+    filepath = _get_member_path(to_directory, name)
+    if not filepath:
+        raise SystemError('Refusing to extract zip member outside of {0}: {1}'
+                          .format(to_directory, name))
+    try:
+        os.makedirs(os.path.dirname(filepath))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(filepath)):
+            raise
+    with open(filepath, 'wb') as f:
+        f.write(contents)
+    return True
+
+
+def sync_zip_contents(url, to_directory, statefile, sourceiss3bucket=None):
+    """
+Updates `to_directory` to match the remote zip archive at `url`, fetching
+only the members whose CRC-32 or size differ from the installed files.
+Members that were installed from a previous version of the archive, but are
+no longer in it, are deleted. `statefile` records the member names installed
+from the archive, and is written by `save_zip_state` after a full extraction.
+Returns False, without changing anything, if the archive cannot be synced
+partially and must be downloaded and extracted in full.
+    :rtype : bool
+    :param url: str, url of the zip archive
+    :param to_directory: str, path to the directory holding the installed
+                         contents of the archive
+    :param statefile: str, path to the file recording installed members
+    :param sourceiss3bucket:
+    """
+    try:
+        with open(statefile, 'r') as f:
+            installed = json.load(f)
+    except (IOError, ValueError):
+        print('No record of previously installed members. Fetching the '
+              'complete archive -- {0}'.format(url))
+        return False
+
+    try:
+        members = get_zip_members(url, sourceiss3bucket)
+    except SystemError as exc:
+        print('Could not read the archive\'s central directory. Fetching the '
+              'complete archive -- {0}\n'
+              '{1}'.format(url, exc))
+        return False
+    if members is None or [m for m in members.values()
+                           if m['flags'] & 0x1 or m['compress_type'] not in
+                           (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)]:
+        print('Archive uses zip features that cannot be fetched partially. '
+              'Fetching the complete archive -- {0}'.format(url))
+        return False
+    if [n for n in members if not _get_member_path(to_directory, n)]:
+        print('Archive has members with absolute or parent directory paths. '
+              'Fetching the complete archive -- {0}'.format(url))
+        return False
+
+    changed = []
+    for name, member in members.items():
+        if name.endswith('/'):
+            continue
+        filepath = _get_member_path(to_directory, name)
+        if not os.path.isfile(filepath) or \
+                os.path.getsize(filepath) != member['file_size'] or \
+                _get_file_crc(filepath) != member['crc']:
+            changed.append(name)
+
+    # Coalesce members that are adjacent in the archive into one request
+    changed.sort(key=lambda n: members[n]['offset'])
+    ranges = []
+    for name in changed:
+        if ranges and ranges[-1][1] == members[name]['offset']:
+            ranges[-1][1] = members[name]['end']
+            ranges[-1][2].append(name)
+        else:
+            ranges.append([members[name]['offset'], members[name]['end'],
+                           [name]])
+
+    fetched = 0
+    for start, end, names in ranges:
+        data = read_range(url, '{0}-{1}'.format(start, end - 1),
+                          sourceiss3bucket)
+        fetched += len(data)
+        for name in names:
+            offset = members[name]['offset'] - start
+            _extract_zip_member(name, members[name],
+                                data[offset:members[name]['end'] - start],
+                                to_directory)
+
+    removed = sorted(set(installed) - set(members))
+    for name in removed:
+        filepath = _get_member_path(to_directory, name)
+        if filepath and os.path.isfile(filepath):
+            os.remove(filepath)
+
+    save_zip_state(statefile, members)
+    print('Synced archive members -- \n'
+          '    source  = {0}\n'
+          '    dest    = {1}\n'
+          '    changed = {2}\n'
+          '    removed = {3}\n'
+          '    bytes   = {4}'.format(url, to_directory, len(changed),
+                                     len(removed), fetched))
+    return True
+
+
+def save_zip_state(statefile, names):
+    """
+Records the member names installed from a zip archive, for use by
+`sync_zip_contents`.
+    :rtype : bool
+    :param statefile: str, path to the file recording installed members
+    :param names: iterable, names of the installed members
+    """
+    try:
+        with open(statefile, 'w') as f:
+            json.dump(sorted(names), f)
+    except Exception as exc:
+        raise SystemError('Could not write the archive state file: {0}\n'
+                          'Exception: {1}'.format(statefile, exc))
+    return True
+
+
 def create_working_dir(basedir, dirprefix):
     """
 Creates a directory in `basedir` with a prefix of `dirprefix`.
@@ -97,25 +861,140 @@ Returns the path to the working directory.
     return workingdir
 
 
+_archive_signatures = (
+    ('zip', 0, 'PK\x03\x04'),
+    ('zip', 0, 'PK\x05\x06'),
+    ('gz', 0, '\x1f\x8b'),
+    ('bz2', 0, 'BZh'),
+    ('xz', 0, '\xfd7zXZ\x00'),
+    ('tar', 257, 'ustar'),
+)
+_parallel_decompressors = {
+    'gz': (['pigz', '-dc'],),
+    'bz2': (['lbzip2', '-dc'], ['pbzip2', '-dc']),
+    'xz': (['xz', '--threads=0', '-dc'],),
+}
+_decompressor_thread_options = {
+    'pigz': '-p{0}',
+    'lbzip2': '-n{0}',
+    'pbzip2': '-p{0}',
+    'xz': '--threads={0}',
+}
+
+
+def get_archive_format(filepath):
+    """
+Returns the format of the archive at `filepath`, detected from the magic
+bytes at the start of the file rather than from the file name. One of 'zip',
+'gz', 'bz2', 'xz' or 'tar'. The compressed formats are assumed to contain a
+tar archive.
+    :rtype : str
+    :param filepath: str, path to the archive
+    :raise ValueError: error raised if the format is not recognized
+    """
+    with open(filepath, 'rb') as f:
+        header = f.read(512)
+    for archiveformat, offset, signature in _archive_signatures:
+        if header[offset:offset + len(signature)] == signature:
+            return archiveformat
+    raise ValueError('Could not extract `"{0}`" as no appropriate '
+                     'extractor is found'.format(filepath))
+
+
+def _get_decompress_command(archiveformat, maxthreads=None):
+    """
+Returns the command line of a multi-threaded decompressor for
+`archiveformat` that is installed on the system, or None. The command writes
+the decompressed stream to stdout when the archive path is appended.
+    :rtype : list
+    :param archiveformat: str, format returned by `get_archive_format`
+    :param maxthreads: int, maximum threads of the decompressor. None uses
+                       one per core
+    """
+    for command in _parallel_decompressors.get(archiveformat, ()):
+        if not find_executable(command[0]):
+            continue
+        # xz only accepts `--threads` from version 5.2
+        if 'xz' == command[0] and subprocess.call(
+                command[:2] + ['--version'], stdout=open(os.devnull, 'w'),
+                stderr=subprocess.STDOUT):
+            return ['xz', '-dc']
+        command = [x for x in command if not x.startswith('--threads')]
+        if maxthreads:
+            command.insert(1, _decompressor_thread_options[command[0]]
+                           .format(maxthreads))
+        elif 'xz' == command[0]:
+            command.insert(1, '--threads=0')
+        return command
+    if 'xz' == archiveformat and find_executable('xz'):
+        return ['xz', '-dc']
+    return None
+
+
+class _MultiStreamReader(object):
+    """
+    Read-only file-like object that decompresses every stream of a
+    multi-stream gzip or bzip2 file, as written by parallel compressors. The
+    stdlib readers stop after the first stream.
+    """
+    def __init__(self, fileobj, decompressorfactory):
+        self.fileobj = fileobj
+        self.decompressorfactory = decompressorfactory
+        self.decompressor = decompressorfactory()
+        self.buffer = ''
+        self.position = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = self.decompressorfactory()
+            else:
+                data = self.fileobj.read(1024 * 1024)
+                if not data:
+                    break
+            try:
+                decompressed = self.decompressor.decompress(data)
+            except EOFError:
+                # bz2 raises when data follows the end of a stream
+                self.decompressor = self.decompressorfactory()
+                decompressed = self.decompressor.decompress(data)
+            self.buffer = self.buffer[self.position:] + decompressed
+            self.position = 0
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position = min(end, len(self.buffer))
+        return data
+
+
+_stream_decompressors = {
+    'gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'bz2': bz2.BZ2Decompressor,
+}
+
+
 def extract_contents(filepath,
                      to_directory='.',
-                     createdirfromfilename=None):
+                     createdirfromfilename=None,
+                     maxthreads=None):
     """
     Extracts a compressed file to the specified directory.
-    Supports files that end in .zip, .tar.gz, .tgz, tar.bz2, or tbz.
+    Supports zip archives, and tar archives that are uncompressed or
+    compressed with gzip, bzip2 or xz. The format is detected from the file's
+    magic bytes. Compressed tar archives are decompressed with pigz, lbzip2,
+    pbzip2 or xz when installed, so multi-stream archives are decompressed
+    across cores.
     :param filepath: str, path to the compressed file
     :param to_directory: str, path to the target directory
-    :raise ValueError: error raised if file extension is not supported
-    """
-    if filepath.endswith('.zip'):
-        opener, mode = zipfile.ZipFile, 'r'
-    elif filepath.endswith('.tar.gz') or filepath.endswith('.tgz'):
-        opener, mode = tarfile.open, 'r:gz'
-    elif filepath.endswith('.tar.bz2') or filepath.endswith('.tbz'):
-        opener, mode = tarfile.open, 'r:bz2'
-    else:
-        raise ValueError('Could not extract `"{0}`" as no appropriate '
-                         'extractor is found'.format(filepath))
+    :param maxthreads: int, maximum threads of the decompressor. None uses
+                       one per core
+    :raise ValueError: error raised if file format is not supported
+    """
+    archiveformat = get_archive_format(filepath)
+    command = _get_decompress_command(archiveformat, maxthreads)
+    if 'xz' == archiveformat and not command:
+        raise ValueError('Could not extract `"{0}`" as the `xz` utility was '
+                         'not found'.format(filepath))
 
     if createdirfromfilename:
         to_directory = os.sep.join((to_directory,
@@ -130,19 +1009,480 @@ def extract_contents(filepath,
     os.chdir(to_directory)
 
     try:
-        openfile = opener(filepath, mode)
-        try:
-            openfile.extractall()
-        finally:
-            openfile.close()
+        if 'zip' == archiveformat:
+            openfile = zipfile.ZipFile(filepath, 'r')
+            try:
+                openfile.extractall()
+            finally:
+                openfile.close()
+        elif 'tar' == archiveformat:
+            openfile = tarfile.open(filepath, 'r:')
+            try:
+                openfile.extractall()
+            finally:
+                openfile.close()
+        elif command:
+            process = subprocess.Popen(command + [filepath],
+                                       stdout=subprocess.PIPE)
+            try:
+                openfile = tarfile.open(fileobj=process.stdout, mode='r|')
+                try:
+                    openfile.extractall()
+                finally:
+                    openfile.close()
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            if returncode:
+                raise SystemError('Decompressor exited with an error.\n'
+                                  'command = {0}\n'
+                                  'return code = {1}'
+                                  .format(' '.join(command + [filepath]),
+                                          returncode))
+        else:
+            with open(filepath, 'rb') as f:
+                stream = _MultiStreamReader(
+                    f, _stream_decompressors[archiveformat])
+                openfile = tarfile.open(fileobj=stream, mode='r|')
+                try:
+                    openfile.extractall()
+                finally:
+                    openfile.close()
     finally:
         os.chdir(cwd)
 
     print('Extracted file -- \n'
           '    source = {0}\n'
-          '    dest   = {1}'.format(filepath, to_directory))
+          '    dest   = {1}\n'
+          '    format = {2}\n'
+          '    decompressor = {3}'
+          .format(filepath, to_directory, archiveformat,
+                  command[0] if command else 'python'))
+    return True
+
+
+_supported_dists = ('amazon', 'centos', 'red hat')
+_match_supported_dist = re.compile(r'^({0})'
+                                    '(?:[^0-9]+)'
+                                    '([\d]+[.][\d]+)'
+                                    '(?:.*)'
+                                    .format('|'.join(_supported_dists)))
+_amazon_epel_versions = {
+    '2014.03' : '6',
+    '2014.09' : '6',
+    '2015.03' : '6',
+    '2015.09' : '6',
+}
+
+
+def get_target_path(targetroot, path):
+    """
+Returns the absolute `path` resolved under `targetroot`, the root of the
+filesystem being provisioned.
+    :rtype : str
+    :param targetroot: str, path of the target root. None or '/' is the
+                       running system
+    :param path: str, absolute path within the target root
+    """
+    if not targetroot or '/' == targetroot:
+        return path
+    return os.sep.join((targetroot.rstrip(os.sep), path.lstrip(os.sep)))
+
+
+def get_dist_info(targetroot=None):
+    """
+Returns a (dist, epel_version) tuple for the target system, detected from
+/etc/system-release the same way as `systemprep-linuxyumrepoinstall.py`.
+`dist` is one of 'amazon', 'centos' or 'redhat'.
+    :rtype : tuple
+    :param targetroot: str, path of the target root
+    """
+    releasefile = get_target_path(targetroot, '/etc/system-release')
+    try:
+        with open(releasefile, 'rb') as f:
+            release = f.readline().strip()
+    except Exception as exc:
+        raise SystemError('Could not read {0}. '
+                          'Error: {1}'.format(releasefile, exc))
+
+    m = _match_supported_dist.search(release.lower())
+    if m is None:
+        raise SystemError('Unsupported OS distribution. OS must be one of: '
+                          '{0}.'.format(', '.join(_supported_dists)))
+    dist, version = (x.translate(None, ' ') for x in m.groups())
+
+    if 'amazon' == dist:
+        epel_version = _amazon_epel_versions.get(version, None)
+    else:
+        epel_version = version.split('.')[0]
+    if epel_version is None:
+        raise SystemError('Unsupported OS version! dist = {0}, version = {1}.'
+                          .format(dist, version))
+    return dist, epel_version
+
+
+def install_salt_bundle(bundlesource, packages, workingdir,
+                        sourceiss3bucket=None, verifyartifacts=None,
+                        targetroot=None):
+    """
+Installs `packages` from a bundle, an archive holding the complete,
+pre-resolved set of rpms for this distribution and epel version, plus a
+`bundle.manifest` file describing the system it was built for. The rpms are
+installed in one yum transaction with every repo disabled, so no repo
+metadata is downloaded.
+Returns False, without installing anything, if the bundle cannot be fetched
+or does not match this system, so the caller can fall back to yum.
+    :rtype : bool
+    :param bundlesource: str, url of the bundle. '{dist}', '{epel_version}'
+                         and '{arch}' are replaced with the values for this
+                         system
+    :param packages: list, names of the packages the bundle must install
+    :param workingdir: str, directory in which to download the bundle
+    :param sourceiss3bucket:
+    :param verifyartifacts:
+    :param targetroot: str, path of the target root to install into
+    """
+    try:
+        dist, epel_version = get_dist_info(targetroot)
+        arch = platform.machine()
+        url = bundlesource.format(dist=dist, epel_version=epel_version,
+                                  arch=arch)
+        bundlefile = os.sep.join((workingdir, url.split('/')[-1]))
+        bundledir = os.sep.join((workingdir, 'salt-bundle'))
+        bundledigest = None
+        if verifyartifacts:
+            bundledigest = get_artifact_digest(url, sourceiss3bucket)
+        download_file(url, bundlefile, sourceiss3bucket, sha256=bundledigest)
+        extract_contents(filepath=bundlefile, to_directory=bundledir)
+        with open(os.sep.join((bundledir, 'bundle.manifest')), 'r') as f:
+            manifest = dict(line.strip().split('=', 1) for line in f
+                            if '=' in line)
+    except (SystemError, ValueError, IOError) as exc:
+        print('Could not use the salt bundle -- {0}'.format(exc))
+        return False
+
+    expected = {'dist': dist, 'epel_version': epel_version, 'arch': arch}
+    mismatched = [k for k, v in expected.items() if manifest.get(k) != v]
+    if mismatched:
+        print('Salt bundle was built for a different system. Mismatched '
+              'keys: {0}'.format(', '.join(mismatched)))
+        return False
+
+    rpms = sorted(os.sep.join((bundledir, name))
+                  for name in os.listdir(bundledir) if name.endswith('.rpm'))
+    process = subprocess.Popen(['rpm', '-qp', '--queryformat', '%{NAME}\\n']
+                               + rpms, stdout=subprocess.PIPE)
+    names = process.communicate()[0].split()
+    missing = [p for p in packages if p not in names]
+    if not rpms or process.returncode or missing:
+        print('Salt bundle does not contain the required packages: {0}'
+              .format(', '.join(missing or packages)))
+        return False
+
+    targetroot = get_target_path(targetroot, '/')
+    install_result = os.system('yum -y --installroot={0} --disablerepo="*" '
+                               'localinstall {1}'
+                               .format(targetroot, ' '.join(rpms)))
+    print('Return code of yum localinstall: {0}'.format(install_result))
+    if install_result or os.system('rpm --root {0} -q {1}'
+                                   .format(targetroot, ' '.join(packages))):
+        print('Salt bundle did not install the required packages.')
+        return False
+    return True
+
+
+# --- begin shared block: journal ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+class CheckpointJournal(object):
+    """
+    Records the phases of a run that completed, with a digest of the inputs
+    of each phase, so a rerun after a failure can skip them. A rerun skips
+    phases while they match the journal in order. The first phase that did
+    not complete, or whose inputs changed, and every phase after it, run
+    again.
+    """
+    def __init__(self, path, cleanrun=False):
+        self.path = path
+        self.entries = []
+        self.position = 0
+        self.resuming = not cleanrun
+        if cleanrun:
+            print('Detected `cleanrun`, ignoring the checkpoint journal -- {0}'
+                  .format(path))
+            return
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)['phases']
+        except (IOError, ValueError, KeyError, TypeError):
+            self.entries = []
+
+    def expects(self, name):
+        """
+    Returns True if the next phase recorded by an earlier run is `name`, so it
+    may be skipped. The input digest of any other phase is only needed once
+    the phase completes.
+        """
+        return self.resuming and self.position < len(self.entries) and \
+            name == self.entries[self.position]['name']
+
+    def skip(self, name, digest):
+        """
+    Returns True if the phase `name` completed in an earlier run with the
+    same input `digest`, and every phase before it was skipped too. A phase
+    with no digest is never skipped.
+        """
+        if self.resuming and digest and self.position < len(self.entries) \
+                and {'name': name, 'digest': digest} == \
+                self.entries[self.position]:
+            self.position += 1
+            print('Skipping phase completed by an earlier run -- {0}'
+                  .format(name))
+            return True
+        self.resuming = False
+        del self.entries[self.position:]
+        return False
+
+    def complete(self, name, digest):
+        """
+    Records that the phase `name` completed with the input `digest`.
+        """
+        self.entries.append({'name': name, 'digest': digest})
+        self.position = len(self.entries)
+        journaldir = os.path.dirname(self.path)
+        if not os.path.isdir(journaldir):
+            os.makedirs(journaldir)
+        with open('{0}.tmp'.format(self.path), 'w') as f:
+            json.dump({'phases': self.entries}, f, indent=2)
+        os.rename('{0}.tmp'.format(self.path), self.path)
+
+    def clear(self):
+        """
+    Removes the journal, so the next run starts from the first phase.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.entries = []
+        self.position = 0
+
+
+def get_input_digest(*inputs):
+    """
+Returns the SHA-256 hex digest of `inputs`, which must be serializable as
+JSON.
+    :rtype : str
+    :param inputs: values the phase depends on
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+# --- end shared block: journal ---
+
+
+def get_remote_etag(url, sourceiss3bucket=None):
+    """
+Returns the ETag of the remote file at `url`, using a HEAD request, or None
+if the server does not provide one.
+    :rtype : str
+    :param url: str, url of the remote file
+    :param sourceiss3bucket:
+    """
+    try:
+        if sourceiss3bucket:
+            return _get_s3_key(url).etag
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        return urllib2.urlopen(request).info().getheader('ETag')
+    except Exception:
+        return None
+
+
+def get_download_etag(url, sourceiss3bucket=None):
+    """
+Returns the ETag the source sent when this process downloaded `url`. If the
+file was not downloaded from the source, e.g. it was copied from the
+artifact directory or updated by ranged requests, returns the ETag of the
+remote file instead, see `get_remote_etag`.
+    :rtype : str
+    :param url: str, url of the file
+    :param sourceiss3bucket:
+    """
+    if url in _download_etags:
+        return _download_etags[url]
+    return get_remote_etag(url, sourceiss3bucket)
+
+
+_sync_manifest = '.systemprep-sync.json'
+# Custom module directories of a file root, their directory in the minion's
+# extmods cache, and the saltutil function that syncs them. Any other
+# directory, e.g. `_engines`, is compared to the cache directory of the same
+# name without the underscore, and is only synced by `saltutil.sync_all`
+_sync_types = {
+    '_beacons': ('beacons', 'sync_beacons'),
+    '_grains': ('grains', 'sync_grains'),
+    '_modules': ('modules', 'sync_modules'),
+    '_output': ('output', 'sync_output'),
+    '_proxy': ('proxy', 'sync_proxymodules'),
+    '_renderers': ('renderers', 'sync_renderers'),
+    '_returners': ('returners', 'sync_returners'),
+    '_sdb': ('sdb', 'sync_sdb'),
+    '_states': ('states', 'sync_states'),
+    '_utils': ('utils', 'sync_utils'),
+}
+# Files salt's sync copies to the extmods cache; it ignores any other file
+_sync_file_pattern = re.compile(r'\.(pyx?|so|zip)$')
+
+
+def _walk_files(directory):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, directory).replace(os.sep, '/'), path
+
+
+def get_custom_module_digests(fileroots):
+    """
+Returns the SHA-256 digests of the custom modules in `fileroots`, as a
+dictionary of `{'_modules': {'<relpath>': '<sha256>'}}`, one entry per
+custom module directory. A module found in more than one file root is taken
+from the first, as salt does. The digests are read from the sync manifest
+written by `Utils/systemprep-packagecontent.py` at the root of the archive
+the file root was extracted from, and computed from the files for any file
+root without one. Only the files salt syncs, matching `_sync_file_pattern`,
+are included.
+    :rtype : dict
+    :param fileroots: list, (fileroot, archiveroot) tuples of the paths of the
+                      salt file roots, in order, and of the directories their
+                      archives were extracted to
+    """
+    digests = {}
+    for fileroot, archiveroot in fileroots:
+        rootdigests = {}
+        manifest = os.sep.join((archiveroot, _sync_manifest))
+        if os.path.isfile(manifest):
+            with open(manifest, 'r') as f:
+                files = json.load(f)['files']
+            prefix = os.path.relpath(fileroot, archiveroot).replace(os.sep, '/')
+            prefix = '' if '.' == prefix else prefix + '/'
+            for path, digest in files.items():
+                if not path.startswith(prefix) or \
+                        '/' not in path[len(prefix):]:
+                    continue
+                typedir, relpath = path[len(prefix):].split('/', 1)
+                if typedir.startswith('_'):
+                    rootdigests.setdefault(typedir, {})[relpath] = digest
+        elif os.path.isdir(fileroot):
+            for typedir in os.listdir(fileroot):
+                typepath = os.sep.join((fileroot, typedir))
+                if typedir.startswith('_') and os.path.isdir(typepath):
+                    rootdigests[typedir] = dict(
+                        (relpath, _get_file_digest(path))
+                        for relpath, path in _walk_files(typepath))
+        for typedir, files in rootdigests.items():
+            for relpath, digest in files.items():
+                if _sync_file_pattern.search(relpath):
+                    digests.setdefault(typedir, {}).setdefault(relpath,
+                                                               digest)
+    return digests
+
+
+def get_changed_sync_types(digests, extmodsdir):
+    """
+Returns the sorted list of custom module directories, e.g. '_modules', whose
+files in the minion's extmods cache differ from `digests`. A directory that
+is not in `_sync_types` is compared to the cache directory of the same name
+without the underscore, so one the salt version syncs, e.g. `_engines`, is
+returned only when it changed, and one it does not sync, e.g. `_pillar` on a
+masterless minion, is returned on every run. A type whose modules were all
+removed is returned if the cache still has them.
+    :rtype : list
+    :param digests: dict, as returned by `get_custom_module_digests`
+    :param extmodsdir: str, path of the minion's extmods cache
+    """
+    typedirs = set(digests)
+    for typedir, (cachedir, function) in _sync_types.items():
+        if os.path.isdir(os.sep.join((extmodsdir, cachedir))):
+            typedirs.add(typedir)
+    changed = []
+    for typedir in sorted(typedirs):
+        cachedir = _sync_types[typedir][0] if typedir in _sync_types \
+            else typedir[1:]
+        cached = dict(
+            (relpath, _get_file_digest(path)) for relpath, path in
+            _walk_files(os.sep.join((extmodsdir, cachedir)))
+            if _sync_file_pattern.search(relpath))
+        if cached != digests.get(typedir, {}):
+            changed.append(typedir)
+    return changed
+
+
+# --- begin shared block: resource usage ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+def get_resource_usage():
+    """
+Returns the resources consumed by this process and by the child processes it
+has waited for, including every process they waited for in turn.
+    :rtype : dict
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cpu_user_seconds': round(own.ru_utime + children.ru_utime, 3),
+        'cpu_system_seconds': round(own.ru_stime + children.ru_stime, 3),
+        'max_rss_kb': max(own.ru_maxrss, children.ru_maxrss),
+        'block_reads': own.ru_inblock + children.ru_inblock,
+        'block_writes': own.ru_oublock + children.ru_oublock,
+        'bytes_downloaded': _download_bytes,
+    }
+
+
+def get_resource_usage_since(startusage):
+    """
+Returns the resources consumed since `startusage` was taken. Peak memory
+cannot be measured over an interval, so `max_rss_kb` is the peak so far.
+    :rtype : dict
+    :param startusage: dict, as returned by `get_resource_usage`
+    """
+    usage = get_resource_usage()
+    for key in usage:
+        if key.startswith('cpu_'):
+            usage[key] = round(usage[key] - startusage[key], 3)
+        elif 'max_rss_kb' != key:
+            usage[key] -= startusage[key]
+    return usage
+
+
+def print_resource_usage(name, usage):
+    """
+Prints `usage` on one line, in a format that is easy to find in the logs.
+    :rtype : bool
+    :param name: str, name of the run the usage belongs to
+    :param usage: dict, as returned by `get_resource_usage`
+    """
+    print('Resource usage -- name = {0}, {1}'
+          .format(name, ', '.join('{0} = {1}'.format(k, usage[k])
+                                  for k in sorted(usage))))
+    sys.stdout.flush()
     return True
 
+# --- end shared block: resource usage ---
+
+
+# --- begin shared block: phase banners ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+def print_phase(phase, start):
+    """
+Prints a banner recording the duration of a provisioning phase. The banner
+is parsed by `Utils/systemprep-timeline.py` to report fleet-wide timings.
+    :rtype : float
+    :param phase: str, name of the phase
+    :param start: float, time the phase started, as returned by `time.time`
+    """
+    end = time.time()
+    print('Completed phase -- name = {0}, start = {1:.3f}, seconds = {2:.3f}'
+          .format(phase, start, end - start))
+    return end
+
+# --- end shared block: phase banners ---
+
 
 def cleanup(workingdir):
     """
@@ -165,7 +1505,21 @@ def cleanup(workingdir):
     return True
 
 
+def reset_run_state():
+    """
+Resets the download state left by an earlier call of `main` in this process,
+e.g. by the agent of the master script, which imports this script once and
+calls `main` for every request. The S3 connection is kept.
+    :rtype : bool
+    """
+    global _download_backoff
+    _download_backoff = 0.0
+    _download_etags.clear()
+    return True
+
+
 def main(saltinstallmethod='git',
+         saltbundlesource=None,
          saltbootstrapsource=None,
          saltgitrepo=None,
          saltversion=None,
@@ -178,6 +1532,16 @@ def main(saltinstallmethod='git',
          entenv='false',
          oupath=None,
          sourceiss3bucket='false',
+         verifyartifacts='false',
+         saltcontentdelta='false',
+         downloadratelimit=None,
+         downloadretries=None,
+         targetroot=None,
+         artifactdir=None,
+         cleanrun='false',
+         artifactstore=None,
+         artifactpeers=None,
+         maxthreads=None,
          **kwargs):
     """
     Manages the salt installation and configuration.
@@ -188,6 +1552,16 @@ def main(saltinstallmethod='git',
                           'yum': install salt from a yum repo. the salt
                                  packages must be available in a yum repo
                                  already configured on the system.
+                          'bundle': install salt from the pre-resolved rpm
+                                    bundle at `saltbundlesource`, without
+                                    downloading yum repo metadata. falls back
+                                    to 'yum' if the bundle is unavailable or
+                                    does not match the system.
+    :param saltbundlesource: str, location of the rpm bundle. required if
+                             `saltinstallmethod` is `bundle`. '{dist}',
+                             '{epel_version}' and '{arch}' are replaced with
+                             the values for the system.
+                             Example: "https://s3.amazonaws.com/systemprep-repo/linux/bundles/salt-minion-{dist}-el{epel_version}-{arch}.tar"
     :param saltbootstrapsource: str, location of the salt bootstrap installer.
                                 required if `saltinstallmethod` is `git`.
                                 Example: "https://raw.githubusercontent.com/saltstack/salt-bootstrap/develop/bootstrap-salt.sh"
@@ -213,6 +1587,53 @@ def main(saltinstallmethod='git',
                            salt-call state run
     :param sourceiss3bucket: str, set to 'true' if saltcontentsource and
                              formulastoinclude are hosted in an S3 bucket.
+    :param verifyartifacts: str, set to 'true' to verify saltcontentsource and
+                            formulastoinclude against the SHA-256 manifest
+                            published next to each archive, `<url>.sha256`.
+                            the digest is computed while the archive
+                            downloads, and a mismatch re-fetches the archive.
+    :param saltcontentdelta: str, set to 'true' to update the salt content
+                             in place when `saltcontentsource` is a zip
+                             archive. the archive's central directory is read
+                             with a range request, and only the members that
+                             differ from the files under /srv/salt are
+                             fetched. members removed from the archive are
+                             deleted. each fetched member is checked against
+                             its CRC-32, since the digest of the complete
+                             archive does not apply. ignored when
+                             `verifyartifacts` is set, so the archive is
+                             always verified.
+    :param downloadratelimit: str, maximum download rate in bytes per second,
+                              shared by every download this script makes.
+                              default is no limit
+    :param downloadretries: str, number of times to retry a download the
+                            source rejects because it is throttling requests,
+                            e.g. an S3 503 SlowDown. the backoff between
+                            retries grows while the source stays throttled.
+                            default is 5
+    :param targetroot: str, path of a mounted root filesystem to provision
+                       instead of the running system. salt is installed with
+                       `yum --installroot`, the salt content is extracted
+                       under the root, and salt-call runs in a chroot, which
+                       must have /dev, /proc and /sys mounted. default is '/'
+    :param artifactdir: str, directory shared by concurrent runs in which
+                        each artifact is downloaded once. default is to
+                        download every artifact directly
+    :param cleanrun: str, set to 'true' to ignore the checkpoint journal and
+                     run every phase. otherwise, after a failed run, phases
+                     that completed with the same inputs are skipped, up to
+                     the first phase that failed or whose inputs changed.
+                     the journal is removed when the script succeeds
+    :param artifactstore: str, directory in which to keep every verified
+                          archive, named by its SHA-256 digest, so the system
+                          can serve it to peers. default is no store
+    :param artifactpeers: str, comma-separated `host:port` or base urls of
+                          peers to query for archives by digest before their
+                          origin url. requires `verifyartifacts`. default is
+                          no peers
+    :param maxthreads: str, maximum threads of a decompressor, to limit the
+                       CPU the script takes from a host serving traffic.
+                       default is one thread per core
     :param entenv: str, controls whether to set a custom grain in salt that
                    identifies the enterprise environment.
                    'false' does not set the custom grain
@@ -228,6 +1649,7 @@ def main(saltinstallmethod='git',
     :raise SystemError: error raised whenever an issue is encountered
     """
     scriptname = __file__
+    startusage = get_resource_usage()
 
     # Convert from None to list, to support iteration
     formulastoinclude = [] if formulastoinclude is None else formulastoinclude
@@ -235,6 +1657,9 @@ def main(saltinstallmethod='git',
         formulaterminationstrings
     # Convert from string to bool
     sourceiss3bucket = 'true' == sourceiss3bucket.lower()
+    verifyartifacts = 'true' == verifyartifacts.lower()
+    saltcontentdelta = 'true' == saltcontentdelta.lower()
+    cleanrun = 'true' == cleanrun.lower()
     # Handle entenv tri-state
     entenv = True if 'true' == entenv.lower() else False if 'false' == \
         entenv.lower() else entenv.lower()
@@ -243,6 +1668,7 @@ def main(saltinstallmethod='git',
     print('Entering script -- ' + scriptname)
     print('Printing parameters...')
     print('    saltinstallmethod = {0}'.format(saltinstallmethod))
+    print('    saltbundlesource = {0}'.format(saltbundlesource))
     print('    saltbootstrapsource = {0}'.format(saltbootstrapsource))
     print('    saltgitrepo = {0}'.format(saltgitrepo))
     print('    saltversion = {0}'.format(saltversion))
@@ -253,65 +1679,119 @@ def main(saltinstallmethod='git',
     print('    salt_results_log = {0}'.format(salt_results_log))
     print('    salt_debug_log = {0}'.format(salt_debug_log))
     print('    sourceiss3bucket = {0}'.format(sourceiss3bucket))
+    print('    verifyartifacts = {0}'.format(verifyartifacts))
+    print('    saltcontentdelta = {0}'.format(saltcontentdelta))
+    print('    downloadratelimit = {0}'.format(downloadratelimit))
+    print('    downloadretries = {0}'.format(downloadretries))
+    print('    targetroot = {0}'.format(targetroot))
+    print('    artifactdir = {0}'.format(artifactdir))
+    print('    cleanrun = {0}'.format(cleanrun))
+    print('    artifactstore = {0}'.format(artifactstore))
+    print('    artifactpeers = {0}'.format(artifactpeers))
+    print('    maxthreads = {0}'.format(maxthreads))
     print('    entenv = {0}'.format(entenv))
     print('    oupath = {0}'.format(oupath))
     for key, value in kwargs.items():
         print('    {0} = {1}'.format(key, value))
 
+    configure_downloads(downloadratelimit, downloadretries, artifactdir)
+    configure_peers(artifactstore, artifactpeers)
+    maxthreads = int(maxthreads) if maxthreads else None
+
     yum_pkgs = [
         'policycoreutils-python',
         'selinux-policy-targeted',
         'salt-minion',
     ]
+    # Paths are as seen from within the target root. Files are read and
+    # written at get_target_path(targetroot, path)
+    rootdir = get_target_path(targetroot, '/')
     minionconf = '/etc/salt/minion'
     saltcall = '/usr/bin/salt-call'
+    if '/' != rootdir:
+        saltcall = 'chroot {0} {1}'.format(rootdir, saltcall)
     saltsrv = '/srv/salt'
     saltfileroot = os.sep.join((saltsrv, 'states'))
     saltformularoot = os.sep.join((saltsrv, 'formulas'))
     saltpillarroot = os.sep.join((saltsrv, 'pillar'))
     saltbaseenv = os.sep.join((saltfileroot, 'base'))
-    workingdir = create_working_dir('/usr/tmp/', 'saltinstall-')
-    salt_results_logfile = salt_results_log or os.sep.join((workingdir,
+    saltextmods = '/var/cache/salt/minion/extmods'
+    workingdir = create_working_dir(get_target_path(targetroot, '/usr/tmp/'),
+                                    'saltinstall-')
+    targetworkingdir = os.sep + os.path.relpath(workingdir, rootdir)
+    salt_results_logfile = salt_results_log or os.sep.join((targetworkingdir,
                                 'saltcall.results.log'))
-    salt_debug_logfile = salt_debug_log or os.sep.join((workingdir,
+    salt_debug_logfile = salt_debug_log or os.sep.join((targetworkingdir,
                                 'saltcall.debug.log'))
     saltcall_arguments = '--out yaml --out-file {0} --return local --log-file ' \
                          '{1} --log-file-level debug' \
                          .format(salt_results_logfile, salt_debug_logfile)
+    journal = CheckpointJournal(get_target_path(
+        targetroot, '/var/lib/systemprep/saltinstall.journal'), cleanrun)
 
-    #Install salt via yum or git
-    if 'yum' == saltinstallmethod.lower():
-        # Install salt-minion and dependencies for selinux python modules
-        # TODO: Install salt version specified by `saltversion`
-        install_result = os.system('yum -y install {0}'.format(' '.join(yum_pkgs)))
-        print('Return code of yum install: {0}'.format(install_result))
-    elif 'git' == saltinstallmethod.lower():
-        # Check required params for the `git` install method
-        if not saltbootstrapsource:
-            error_message = 'Detected `git` as the install method, but the ' \
-                            'required parameter `saltbootstrapsource` was not ' \
-                            'provided.'
-            raise SystemError(error_message)
-        if not saltgitrepo:
-            error_message = 'Detected `git` as the install method, but the ' \
-                            'required parameter `saltgitrepo` was not ' \
-                            'provided.'
-            raise SystemError(error_message)
-        #Download the salt bootstrap installer and install salt
-        saltbootstrapfilename = saltbootstrapsource.split('/')[-1]
-        saltbootstrapfile = '/'.join((workingdir, saltbootstrapfilename))
-        download_file(saltbootstrapsource, saltbootstrapfile)
-        if saltversion:
-            os.system('sh {0} -g {1} git {2}'.format(saltbootstrapfile,
-                                                     saltgitrepo, saltversion))
-        else:
-            os.system('sh {0} -g {1}'.format(saltbootstrapfile, saltgitrepo))
+    phasestart = time.time()
+
+    phasedigest = get_input_digest(saltinstallmethod, saltbundlesource,
+                                   saltbootstrapsource, saltgitrepo,
+                                   saltversion, targetroot)
+    if journal.skip('salt-install', phasedigest):
+        phasestart = time.time()
     else:
-        raise SystemError('Unrecognized `saltinstallmethod`! Must set '
-                          '`saltinstallmethod` to either "git" or "yum".')
+        #Install salt via a bundle of rpms, yum or git
+        if 'bundle' == saltinstallmethod.lower() and saltbundlesource and \
+                install_salt_bundle(saltbundlesource, yum_pkgs, workingdir,
+                                    sourceiss3bucket, verifyartifacts,
+                                    targetroot):
+            print('Installed salt from the rpm bundle.')
+            install_result = 0
+        elif saltinstallmethod.lower() in ('yum', 'bundle'):
+            if 'bundle' == saltinstallmethod.lower():
+                print('Falling back to installing salt with yum.')
+            # Install salt-minion and dependencies for selinux python modules
+            # TODO: Install salt version specified by `saltversion`
+            yumoptions = '' if '/' == rootdir else \
+                '--installroot={0} '.format(rootdir)
+            install_result = os.system('yum -y {0}install {1}'
+                                       .format(yumoptions, ' '.join(yum_pkgs)))
+            print('Return code of yum install: {0}'.format(install_result))
+        elif 'git' == saltinstallmethod.lower():
+            # Check required params for the `git` install method
+            if not saltbootstrapsource:
+                error_message = 'Detected `git` as the install method, but the ' \
+                                'required parameter `saltbootstrapsource` was not ' \
+                                'provided.'
+                raise SystemError(error_message)
+            if not saltgitrepo:
+                error_message = 'Detected `git` as the install method, but the ' \
+                                'required parameter `saltgitrepo` was not ' \
+                                'provided.'
+                raise SystemError(error_message)
+            #Download the salt bootstrap installer and install salt
+            saltbootstrapfilename = saltbootstrapsource.split('/')[-1]
+            saltbootstrapfile = '/'.join((workingdir, saltbootstrapfilename))
+            download_file(saltbootstrapsource, saltbootstrapfile)
+            saltbootstrapcmd = 'sh {0}'.format(
+                '/'.join((targetworkingdir, saltbootstrapfilename)))
+            if '/' != rootdir:
+                saltbootstrapcmd = 'chroot {0} {1}'.format(rootdir,
+                                                           saltbootstrapcmd)
+            if saltversion:
+                install_result = os.system('{0} -g {1} git {2}'.format(
+                    saltbootstrapcmd, saltgitrepo, saltversion))
+            else:
+                install_result = os.system('{0} -g {1}'.format(saltbootstrapcmd,
+                                                               saltgitrepo))
+        else:
+            raise SystemError('Unrecognized `saltinstallmethod`! Must set '
+                              '`saltinstallmethod` to "git", "yum" or '
+                              '"bundle".')
+        if not install_result:
+            journal.complete('salt-install', phasedigest)
+        phasestart = print_phase('salt-install', phasestart)
 
     #Create directories for salt content and formulas
     for saltdir in [saltfileroot, saltbaseenv, saltformularoot]:
+        saltdir = get_target_path(targetroot, saltdir)
         try:
             os.makedirs(saltdir)
         except OSError:
@@ -322,28 +1802,102 @@ def main(saltinstallmethod='git',
     if saltcontentsource:
         saltcontentfilename = saltcontentsource.split('/')[-1]
         saltcontentfile = os.sep.join((workingdir, saltcontentfilename))
-        download_file(saltcontentsource, saltcontentfile, sourceiss3bucket)
-        extract_contents(filepath=saltcontentfile,
-                         to_directory=saltsrv)
+        saltcontentdir = get_target_path(targetroot, saltsrv)
+        saltcontentstate = os.sep.join((saltcontentdir, '.{0}.members'
+                                        .format(saltcontentfilename)))
+        iszip = saltcontentfilename.lower().endswith('.zip')
+        saltcontentdigest = None
+        if verifyartifacts:
+            saltcontentdigest = get_artifact_digest(saltcontentsource,
+                                                    sourceiss3bucket)
+        # without a verified digest, the version is the ETag of the archive.
+        # it is only looked up up front when the journal may skip the phase,
+        # otherwise it is taken from the download
+        version = saltcontentdigest
+        if not version and journal.expects('salt-content'):
+            version = get_remote_etag(saltcontentsource, sourceiss3bucket)
+        phasedigest = version and get_input_digest(saltcontentsource, version,
+                                                   saltcontentdelta,
+                                                   targetroot)
+        if journal.skip('salt-content', phasedigest):
+            phasestart = time.time()
+        else:
+            if saltcontentdelta and iszip and verifyartifacts:
+                print('The archive digest cannot verify a partial update. '
+                      'Fetching the complete archive -- {0}'
+                      .format(saltcontentsource))
+            if saltcontentdelta and iszip and not verifyartifacts and \
+                    sync_zip_contents(saltcontentsource, saltcontentdir,
+                                      saltcontentstate, sourceiss3bucket):
+                print('Updated salt content in place from changed archive '
+                      'members.')
+            else:
+                download_file(saltcontentsource, saltcontentfile,
+                              sourceiss3bucket, sha256=saltcontentdigest)
+                extract_contents(filepath=saltcontentfile,
+                                 to_directory=saltcontentdir,
+                                 maxthreads=maxthreads)
+                if iszip:
+                    saltcontentzip = zipfile.ZipFile(saltcontentfile, 'r')
+                    try:
+                        save_zip_state(saltcontentstate, saltcontentzip.namelist())
+                    finally:
+                        saltcontentzip.close()
+            version = saltcontentdigest or get_download_etag(saltcontentsource,
+                                                             sourceiss3bucket)
+            phasedigest = version and get_input_digest(saltcontentsource,
+                                                       version,
+                                                       saltcontentdelta,
+                                                       targetroot)
+            journal.complete('salt-content', phasedigest)
+            phasestart = print_phase('salt-content', phasestart)
 
     #Download and extract any salt formulas specified in formulastoinclude
     saltformulaconf = []
+    saltformuladirs = []
     for formulasource in formulastoinclude:
         formulafilename = formulasource.split('/')[-1]
         formulafile = os.sep.join((workingdir, formulafilename))
-        download_file(formulasource, formulafile)
-        extract_contents(filepath=formulafile,
-                         to_directory=saltformularoot)
+        formulaphase = 'formula {0}'.format(formulafilename)
+        formuladigest = None
+        if verifyartifacts:
+            formuladigest = get_artifact_digest(formulasource)
+        version = formuladigest
+        if not version and journal.expects(formulaphase):
+            version = get_remote_etag(formulasource)
+        phasedigest = version and get_input_digest(formulasource, version,
+                                                   formulaterminationstrings,
+                                                   targetroot)
+        skipped = journal.skip(formulaphase, phasedigest)
+        if not skipped:
+            download_file(formulasource, formulafile, sha256=formuladigest)
+            extract_contents(filepath=formulafile,
+                             to_directory=get_target_path(targetroot,
+                                                          saltformularoot),
+                             maxthreads=maxthreads)
         formulafilebase = '.'.join(formulafilename.split('.')[:-1])
         formuladir = os.sep.join((saltformularoot, formulafilebase))
         for string in formulaterminationstrings:
             if formulafilebase.endswith(string):
                 newformuladir = formuladir[:-len(string)]
-                if os.path.exists(newformuladir):
-                    shutil.rmtree(newformuladir)
-                shutil.move(formuladir, newformuladir)
+                if skipped:
+                    formuladir = newformuladir
+                    continue
+                if os.path.exists(get_target_path(targetroot, newformuladir)):
+                    shutil.rmtree(get_target_path(targetroot, newformuladir))
+                shutil.move(get_target_path(targetroot, formuladir),
+                            get_target_path(targetroot, newformuladir))
                 formuladir = newformuladir
         saltformulaconf += '    - {0}\n'.format(formuladir),
+        saltformuladirs.append(formuladir)
+        if skipped:
+            phasestart = time.time()
+        else:
+            version = formuladigest or get_download_etag(formulasource)
+            phasedigest = version and get_input_digest(
+                formulasource, version, formulaterminationstrings, targetroot)
+            journal.complete(formulaphase, phasedigest)
+            phasestart = print_phase(formulaphase, phasestart)
 
     #Create a list that contains the new file_roots configuration
     saltfilerootconf = []
@@ -359,75 +1913,124 @@ def main(saltinstallmethod='git',
     saltpillarrootconf += '  base:\n',
     saltpillarrootconf += '    - {0}\n\n'.format(saltpillarroot),
 
-    #Backup the minionconf file
-    shutil.copyfile(minionconf, '{0}.bak'.format(minionconf))
-
-    #Read the minionconf file into a list
-    with open(minionconf, 'r') as f:
-        minionconflines = f.readlines()
-
-    #Find the file_roots section in the minion conf file
-    filerootsbegin = '^#file_roots:|^file_roots:'
-    filerootsend = '#$|^$'
-    beginindex = None
-    endindex = None
-    n = 0
-    for line in minionconflines:
-        if re.match(filerootsbegin, line):
-            beginindex = n
-        if beginindex and not endindex and re.match(filerootsend, line):
-            endindex = n
-        n += 1
-
-    #Update the file_roots section with the new configuration
-    minionconflines = minionconflines[0:beginindex] + \
-                      saltfilerootconf + minionconflines[endindex + 1:]
-
-    #Find the pillar_roots section in the minion conf file
-    pillarrootsbegin = '^#pillar_roots:|^pillar_roots:'
-    pillarrootsend = '^#$|^$'
-    beginindex = None
-    endindex = None
-    n = 0
-    for line in minionconflines:
-        if re.match(pillarrootsbegin, line):
-            beginindex = n
-        if beginindex and not endindex and re.match(pillarrootsend, line):
-            endindex = n
-        n += 1
-
-    #Update the pillar_roots section with the new configuration
-    minionconflines = minionconflines[0:beginindex] + \
-                      saltpillarrootconf + minionconflines[endindex + 1:]
-
-    #Write the new configuration to minionconf
-    try:
-        with open(minionconf, 'w') as f:
-            f.writelines(minionconflines)
-    except Exception as exc:
-        raise SystemError('Could not write to minion conf file: {0}\n'
-                          'Exception: {1}'.format(minionconf, exc))
+    phasedigest = get_input_digest(saltfilerootconf, saltpillarrootconf,
+                                   targetroot)
+    if journal.skip('minion-config', phasedigest):
+        phasestart = time.time()
     else:
-        print('Saved the new minion configuration successfully.')
+        #Backup the minionconf file
+        minionconf = get_target_path(targetroot, minionconf)
+        shutil.copyfile(minionconf, '{0}.bak'.format(minionconf))
+
+        #Read the minionconf file into a list
+        with open(minionconf, 'r') as f:
+            minionconflines = f.readlines()
+
+        #Find the file_roots section in the minion conf file
+        filerootsbegin = '^#file_roots:|^file_roots:'
+        filerootsend = '#$|^$'
+        beginindex = None
+        endindex = None
+        n = 0
+        for line in minionconflines:
+            if re.match(filerootsbegin, line):
+                beginindex = n
+            if beginindex and not endindex and re.match(filerootsend, line):
+                endindex = n
+            n += 1
+
+        #Update the file_roots section with the new configuration
+        minionconflines = minionconflines[0:beginindex] + \
+                          saltfilerootconf + minionconflines[endindex + 1:]
+
+        #Find the pillar_roots section in the minion conf file
+        pillarrootsbegin = '^#pillar_roots:|^pillar_roots:'
+        pillarrootsend = '^#$|^$'
+        beginindex = None
+        endindex = None
+        n = 0
+        for line in minionconflines:
+            if re.match(pillarrootsbegin, line):
+                beginindex = n
+            if beginindex and not endindex and re.match(pillarrootsend, line):
+                endindex = n
+            n += 1
+
+        #Update the pillar_roots section with the new configuration
+        minionconflines = minionconflines[0:beginindex] + \
+                          saltpillarrootconf + minionconflines[endindex + 1:]
+
+        #Write the new configuration to minionconf
+        try:
+            with open(minionconf, 'w') as f:
+                f.writelines(minionconflines)
+        except Exception as exc:
+            raise SystemError('Could not write to minion conf file: {0}\n'
+                              'Exception: {1}'.format(minionconf, exc))
+        else:
+            print('Saved the new minion configuration successfully.')
+        journal.complete('minion-config', phasedigest)
+        phasestart = print_phase('minion-config', phasestart)
 
     # Write custom grains
     if entenv == True:
         # TODO: Get environment from EC2 metadata or tags
         entenv = entenv
-    print('Setting grain `systemprep`...')
-    systemprepgrainresult = os.system(
-        '{0} --local grains.setval systemprep \'{{"enterprise_environment":'
-        '"{1}"}}\''.format(saltcall, entenv))
-    if oupath:
-        print('Setting grain `join-domain`...')
-        joindomaingrainresult = os.system(
-            '{0} --local grains.setval "join-domain" \'{{"oupath":'
-            '"{1}"}}\''.format(saltcall, oupath))
-
-    # Sync custom modules
-    print('Syncing custom salt modules...')
-    systemprepsyncresult = os.system(
-        '{0} --local saltutil.sync_all'.format(saltcall))
+    phasedigest = get_input_digest(entenv, oupath)
+    if journal.skip('grains', phasedigest):
+        phasestart = time.time()
+    else:
+        print('Setting grain `systemprep`...')
+        systemprepgrainresult = os.system(
+            '{0} --local grains.setval systemprep \'{{"enterprise_environment":'
+            '"{1}"}}\''.format(saltcall, entenv))
+        if oupath:
+            print('Setting grain `join-domain`...')
+            joindomaingrainresult = os.system(
+                '{0} --local grains.setval "join-domain" \'{{"oupath":'
+                '"{1}"}}\''.format(saltcall, oupath))
+        if not systemprepgrainresult and not (oupath and
+                                              joindomaingrainresult):
+            journal.complete('grains', phasedigest)
+        phasestart = print_phase('grains', phasestart)
+
+    # Sync the custom module types that differ from the extmods cache
+    extmodsdir = get_target_path(targetroot, saltextmods)
+    digests = get_custom_module_digests(
+        [(get_target_path(targetroot, saltbaseenv),
+          get_target_path(targetroot, saltsrv))] +
+        [(get_target_path(targetroot, x),) * 2 for x in saltformuladirs])
+    phasedigest = get_input_digest(saltcall, digests)
+    if journal.skip('sync', phasedigest):
+        phasestart = time.time()
+    else:
+        changed = get_changed_sync_types(digests, extmodsdir)
+        if not changed:
+            print('Custom salt modules match the extmods cache. Skipping '
+                  'the sync.')
+            systemprepsyncresult = 0
+        elif 1 == len(changed) and changed[0] in _sync_types:
+            # Each salt-call pays the full loader startup, so a targeted
+            # sync is only faster than sync_all for a single type
+            print('Syncing changed custom salt module type -- {0}'
+                  .format(changed[0]))
+            systemprepsyncresult = os.system('{0} --local saltutil.{1}'
+                .format(saltcall, _sync_types[changed[0]][1]))
+        else:
+            untargeted = [x for x in changed if x not in _sync_types]
+            print('Changed custom salt module types -- {0}{1}'
+                  .format(', '.join(changed),
+                          '; no targeted sync for {0}'
+                          .format(', '.join(untargeted))
+                          if untargeted else ''))
+            systemprepsyncresult = 1
+        if systemprepsyncresult:
+            print('Syncing custom salt modules...')
+            systemprepsyncresult = os.system(
+                '{0} --local saltutil.sync_all'.format(saltcall))
+        if not systemprepsyncresult:
+            journal.complete('sync', phasedigest)
+        phasestart = print_phase('sync', phasestart)
 
     # Check whether we need to run salt-call
     if 'none' == saltstates.lower():
@@ -448,10 +2051,12 @@ def main(saltinstallmethod='git',
                         .format(saltcall, saltstates, saltcall_arguments))
 
         print('Return code of salt-call: {0}'.format(result))
+        print_phase('salt-states', phasestart)
 
         # Check for errors in the salt state execution
         try:
-            with open(salt_results_logfile, 'rb') as f:
+            with open(get_target_path(targetroot, salt_results_logfile),
+                      'rb') as f:
                 salt_results = f.read()
         except Exception as exc:
             error_message = 'Could open the salt results log file: {0}\n' \
@@ -472,14 +2077,23 @@ def main(saltinstallmethod='git',
 
     #Remove working files
     cleanup(workingdir)
+    journal.clear()
+    print_resource_usage('saltinstall', get_resource_usage_since(startusage))
 
     print(str(scriptname) + ' complete!')
     print('-' * 80)
 
 
-if __name__ == "__main__":
+def parse_args(args):
+    """
+Converts command line parameters of the form `param=value` to the keyword
+arguments of `main`. The master script also uses this to run the script in
+its own interpreter.
+    :rtype : dict
+    :param args: list, command line parameters
+    """
     # convert command line parameters of the form `param=value` to a dict
-    kwargs = dict(x.split('=', 1) for x in sys.argv[1:])
+    kwargs = dict(x.split('=', 1) for x in args)
     #Convert parameter keys to lowercase, parameter values are unmodified
     kwargs = dict((k.lower(), v) for k, v in kwargs.items())
 
@@ -494,5 +2108,8 @@ if __name__ == "__main__":
     if 'formulaterminationstrings' in kwargs:
         kwargs['formulaterminationstrings'] = kwargs['formulaterminationstrings'].translate(None, '()[]')
         kwargs['formulaterminationstrings'] = filter(None, kwargs['formulaterminationstrings'].split(','))
+    return kwargs
 
-    main(**kwargs)
+
+if __name__ == "__main__":
+    main(**parse_args(sys.argv[1:]))
@@ -1,23 +1,207 @@
 #!/usr/bin/env python
+import fcntl
+import os
+import random
 import re
+import resource
 import shutil
 import sys
+import threading
+import time
 import urllib2
 
 from boto.exception import BotoClientError
 
 
+# --- begin shared block: throttling ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+class _TokenBucket(object):
+    """
+    Token bucket that caps the average download rate at `rate` bytes per
+    second, allowing bursts of up to one second of data. Shared by every
+    download in the process.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class _ThrottledWriter(object):
+    """
+    File-like wrapper that takes a token from the download bucket for every
+    byte written to the underlying file, if a rate limit is set, and counts
+    the bytes downloaded by the process.
+    """
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+        self.name = fileobj.name
+
+    def write(self, data):
+        global _download_bytes
+        _download_bytes += len(data)
+        if self.bucket:
+            self.bucket.consume(len(data))
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+_download_throttle = None
+_download_bytes = 0
+_download_retries = 5
+_download_backoff = 0.0
+_download_backoff_min = 1.0
+_download_backoff_max = 60.0
+_artifact_dir = None
+
+
+def configure_downloads(downloadratelimit=None, downloadretries=None,
+                        artifactdir=None):
+    """
+Sets the bandwidth cap, the throttling retry limit and the shared artifact
+directory for every download made by this script.
+    :rtype : bool
+    :param downloadratelimit: str, maximum download rate in bytes per second.
+                              '0' or None disables the cap
+    :param downloadretries: str, number of times to retry a request the source
+                            rejected because it is throttling requests
+    :param artifactdir: str, directory of downloaded artifacts shared by
+                        concurrent runs. None downloads every file directly
+    """
+    global _download_throttle, _download_retries, _artifact_dir
+    rate = int(downloadratelimit or 0)
+    _download_throttle = _TokenBucket(rate) if rate > 0 else None
+    if downloadretries is not None:
+        _download_retries = int(downloadretries)
+    _artifact_dir = artifactdir or None
+    return True
+
+
+def _is_throttled(exc):
+    """
+Returns True if `exc` is a response from a source that is throttling
+requests, e.g. an S3 503 SlowDown.
+    :rtype : bool
+    :param exc: Exception, error raised by urllib2 or boto
+    """
+    status = getattr(exc, 'status', None) or getattr(exc, 'code', None)
+    return status in (429, 503) or getattr(exc, 'error_code', None) in \
+        ('SlowDown', 'Throttling', 'RequestLimitExceeded')
+
+
+def _call_with_backoff(url, func, *args):
+    """
+Returns `func(*args)`, retrying up to `downloadretries` times while the
+source throttles the request. The backoff delay is shared by all downloads:
+it doubles with every throttled response and halves with every success, so
+later requests slow down as long as the source is overloaded. Each wait is
+randomized so a fleet of systems does not retry in lockstep.
+    :param url: str, url being requested, for messages
+    :param func: function that makes the request
+    :param args: arguments to `func`
+    """
+    global _download_backoff
+    attempt = 0
+    while True:
+        if _download_backoff:
+            time.sleep(random.uniform(_download_backoff / 2, _download_backoff))
+        try:
+            result = func(*args)
+        except Exception as exc:
+            if not _is_throttled(exc):
+                raise
+            _download_backoff = min(_download_backoff_max,
+                                    max(_download_backoff_min,
+                                        _download_backoff * 2))
+            if attempt >= _download_retries:
+                raise SystemError('Source is still throttling requests after '
+                                  '{0} retries.\n'
+                                  'url = {1}\n'
+                                  'Exception: {2}'
+                                  .format(attempt, url, exc))
+            attempt += 1
+            print('Source is throttling requests, backing off -- \n'
+                  '    url     = {0}\n'
+                  '    attempt = {1}\n'
+                  '    backoff = {2:.1f} seconds'.format(url, attempt,
+                                                         _download_backoff))
+            continue
+        _download_backoff = _download_backoff / 2 \
+            if _download_backoff > _download_backoff_min else 0.0
+        return result
+
+# --- end shared block: throttling ---
+
+
+def _fetch_file(url, filename):
+    """
+Makes one download request for `download_file`.
+    :rtype : None
+    """
+    response = urllib2.urlopen(url)
+    with open(filename, 'wb') as outfile:
+        shutil.copyfileobj(response,
+                           _ThrottledWriter(outfile, _download_throttle))
+
+
+def _fetch_artifact(url):
+    """
+Returns the path of the copy of `url` in the artifact directory, downloading
+it first if no run sharing the directory has done so yet. A lock file next
+to the artifact makes concurrent runs wait for the one that is downloading
+it, so each artifact is downloaded once.
+    :rtype : str
+    :param url: str, url of the artifact
+    """
+    artifact = os.sep.join([_artifact_dir] +
+                           url.split('://', 1)[-1].split('/'))
+    try:
+        os.makedirs(os.path.dirname(artifact))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(artifact)):
+            raise
+    with open('{0}.lock'.format(artifact), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isfile(artifact):
+                partial = '{0}.part'.format(artifact)
+                _call_with_backoff(url, _fetch_file, url, partial)
+                os.rename(partial, artifact)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return artifact
+
+
 def download_file(url, filename):
     """
-Download the file from `url` and save it locally under `filename`.
+Download the file from `url` and save it locally under `filename`, within
+the download rate limit, backing off while the source throttles requests.
+If an artifact directory is set, the file is copied from the shared copy in
+that directory instead.
     :rtype : bool
     :param url:
     :param filename:
     """
     try:
-        response = urllib2.urlopen(url)
-        with open(filename, 'wb') as outfile:
-            shutil.copyfileobj(response, outfile)
+        if _artifact_dir:
+            shutil.copyfile(_fetch_artifact(url), filename)
+        else:
+            _call_with_backoff(url, _fetch_file, url, filename)
     except Exception as exc:
         # TODO: Update `except` logic
         raise SystemError('Unable to download file from web server.\n'
@@ -31,6 +215,76 @@ Download the file from `url` and save it locally under `filename`.
     return True
 
 
+# --- begin shared block: resource usage ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+def get_resource_usage():
+    """
+Returns the resources consumed by this process and by the child processes it
+has waited for, including every process they waited for in turn.
+    :rtype : dict
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cpu_user_seconds': round(own.ru_utime + children.ru_utime, 3),
+        'cpu_system_seconds': round(own.ru_stime + children.ru_stime, 3),
+        'max_rss_kb': max(own.ru_maxrss, children.ru_maxrss),
+        'block_reads': own.ru_inblock + children.ru_inblock,
+        'block_writes': own.ru_oublock + children.ru_oublock,
+        'bytes_downloaded': _download_bytes,
+    }
+
+
+def get_resource_usage_since(startusage):
+    """
+Returns the resources consumed since `startusage` was taken. Peak memory
+cannot be measured over an interval, so `max_rss_kb` is the peak so far.
+    :rtype : dict
+    :param startusage: dict, as returned by `get_resource_usage`
+    """
+    usage = get_resource_usage()
+    for key in usage:
+        if key.startswith('cpu_'):
+            usage[key] = round(usage[key] - startusage[key], 3)
+        elif 'max_rss_kb' != key:
+            usage[key] -= startusage[key]
+    return usage
+
+
+def print_resource_usage(name, usage):
+    """
+Prints `usage` on one line, in a format that is easy to find in the logs.
+    :rtype : bool
+    :param name: str, name of the run the usage belongs to
+    :param usage: dict, as returned by `get_resource_usage`
+    """
+    print('Resource usage -- name = {0}, {1}'
+          .format(name, ', '.join('{0} = {1}'.format(k, usage[k])
+                                  for k in sorted(usage))))
+    sys.stdout.flush()
+    return True
+
+# --- end shared block: resource usage ---
+
+
+# --- begin shared block: phase banners ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+def print_phase(phase, start):
+    """
+Prints a banner recording the duration of a provisioning phase. The banner
+is parsed by `Utils/systemprep-timeline.py` to report fleet-wide timings.
+    :rtype : float
+    :param phase: str, name of the phase
+    :param start: float, time the phase started, as returned by `time.time`
+    """
+    end = time.time()
+    print('Completed phase -- name = {0}, start = {1:.3f}, seconds = {2:.3f}'
+          .format(phase, start, end - start))
+    return end
+
+# --- end shared block: phase banners ---
+
+
 _supported_dists = ('amazon', 'centos', 'red hat')
 _match_supported_dist = re.compile(r'^({0})'
                                     '(?:[^0-9]+)'
@@ -45,7 +299,37 @@ _amazon_epel_versions = {
 }
 
 
+def get_target_path(targetroot, path):
+    """
+Returns the absolute `path` resolved under `targetroot`, the root of the
+filesystem being provisioned.
+    :rtype : str
+    :param targetroot: str, path of the target root. None or '/' is the
+                       running system
+    :param path: str, absolute path within the target root
+    """
+    if not targetroot or '/' == targetroot:
+        return path
+    return os.sep.join((targetroot.rstrip(os.sep), path.lstrip(os.sep)))
+
+
+def reset_run_state():
+    """
+Resets the download state left by an earlier call of `main` in this process,
+e.g. by the agent of the master script, which imports this script once and
+calls `main` for every request.
+    :rtype : bool
+    """
+    global _download_backoff
+    _download_backoff = 0.0
+    return True
+
+
 def main(yumrepomap=None,
+         downloadratelimit=None,
+         downloadretries=None,
+         targetroot=None,
+         artifactdir=None,
          **kwargs):
     """
     Checks the distribution version and installs yum repo definition files
@@ -67,12 +351,32 @@ def main(yumrepomap=None,
                      'epel_version' : '6' or '7',
                    },
                  ]
+    :param downloadratelimit: str, maximum download rate in bytes per second.
+                              default is no limit
+    :param downloadretries: str, number of times to retry a download the
+                            source rejects because it is throttling requests.
+                            default is 5
+    :param targetroot: str, path of a mounted root filesystem to provision
+                       instead of the running system. the distribution is read
+                       from, and the repo files are installed to, the target
+                       root. default is '/'
+    :param artifactdir: str, directory shared by concurrent runs in which
+                        each artifact is downloaded once. default is to
+                        download every artifact directly
     """
     scriptname = __file__
+    startusage = get_resource_usage()
+    phasestart = time.time()
     print('+' * 80)
     print('Entering script -- {0}'.format(scriptname))
     print('Printing parameters...')
     print('    yumrepomap = {0}'.format(yumrepomap))
+    print('    downloadratelimit = {0}'.format(downloadratelimit))
+    print('    downloadretries = {0}'.format(downloadretries))
+    print('    targetroot = {0}'.format(targetroot))
+    print('    artifactdir = {0}'.format(artifactdir))
+
+    configure_downloads(downloadratelimit, downloadretries, artifactdir)
 
     if not yumrepomap:
         print('`yumrepomap` is empty. Nothing to do!')
@@ -83,12 +387,13 @@ def main(yumrepomap=None,
 
     # Read first line from /etc/system-release
     release = None
+    releasefile = get_target_path(targetroot, '/etc/system-release')
     try:
-        with open(name='/etc/system-release', mode='rb') as f:
+        with open(name=releasefile, mode='rb') as f:
             release = f.readline().strip()
     except Exception as exc:
-        raise SystemError('Could not read /etc/system-release. '
-                          'Error: {0}'.format(exc))
+        raise SystemError('Could not read {0}. '
+                          'Error: {1}'.format(releasefile, exc))
 
     # Search the release file for a match against _supported_dists
     m = _match_supported_dist.search(release.lower())
@@ -110,6 +415,8 @@ def main(yumrepomap=None,
     if epel_version is None:
         raise SystemError('Unsupported OS version! dist = {0}, version = {1}.'
                           .format(dist, version))
+    print('Detected distribution -- dist = {0}, version = {1}, '
+          'epel_version = {2}'.format(dist, version, epel_version))
 
     for repo in yumrepomap:
         # Test whether this repo should be installed to this system
@@ -117,8 +424,11 @@ def main(yumrepomap=None,
                                                 in [epel_version, 'all']:
             # Download the yum repo definition to /etc/yum.repos.d/
             url = repo['url']
-            repofile = '/etc/yum.repos.d/{0}'.format(url.split('/')[-1])
+            repofile = get_target_path(targetroot, '/etc/yum.repos.d/{0}'
+                                       .format(url.split('/')[-1]))
             download_file(url, repofile)
+    print_phase('yum-repos', phasestart)
+    print_resource_usage('yum-repos', get_resource_usage_since(startusage))
 
     print('{0} complete!'.format(scriptname))
     print('-' * 80)
@@ -140,13 +450,24 @@ def _convert_string_to_list_of_dicts(fixme):
     return fixed
 
 
-if __name__ == "__main__":
+def parse_args(args):
+    """
+Converts command line parameters of the form `param=value` to the keyword
+arguments of `main`. The master script also uses this to run the script in
+its own interpreter.
+    :rtype : dict
+    :param args: list, command line parameters
+    """
     # Convert command line parameters of the form `param=value` to a dict
-    kwargs = dict(x.split('=', 1) for x in sys.argv[1:])
+    kwargs = dict(x.split('=', 1) for x in args)
     # Convert parameter keys to lowercase, parameter values are unmodified
     kwargs = dict((k.lower(), v) for k, v in kwargs.items())
 
     # Need to convert a formatted string to a list of dicts,
     kwargs['yumrepomap'] = _convert_string_to_list_of_dicts(
                                 kwargs.get('yumrepomap', ''))
-    main(**kwargs)
+    return kwargs
+
+
+if __name__ == "__main__":
+    main(**parse_args(sys.argv[1:]))
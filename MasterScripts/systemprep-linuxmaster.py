@@ -1,13 +1,30 @@
 #!/usr/bin/env python
+import atexit
+import fcntl
+import hashlib
+import imp
+import json
 import os
+import re
+import resource
 import sys
 import platform
+import random
+import runpy
+import shlex
+import SocketServer
 import tempfile
+import threading
+import time
 import urllib2
 import shutil
+import StringIO
+import subprocess
 import boto
 
 from boto.exception import BotoClientError
+from boto.exception import S3ResponseError
+from distutils.spawn import find_executable
 
 def merge_dicts(a, b):
     """
@@ -78,6 +95,7 @@ Use `merge_dicts({yourdict}, scriptparams)` to merge command line parameters wit
                 'ScriptSource': "https://systemprep.s3.amazonaws.com/ContentScripts/SystemPrep-LinuxSaltInstall.py",
                 'Parameters': merge_dicts({
                     'saltinstallmethod': 'yum',
+                    'saltbundlesource': "https://s3.amazonaws.com/systemprep-repo/linux/bundles/salt-minion-{dist}-el{epel_version}-{arch}.tar",
                     'saltcontentsource': "https://systemprep-content.s3.amazonaws.com/linux/salt/salt-content.zip",
                     'formulastoinclude': [
                         "https://salt-formulas.s3.amazonaws.com/systemprep-formula-master.zip",
@@ -144,6 +162,12 @@ Returns the path to the working directory.
     return workingdir
 
 
+# Directory of the instance cloud-init is booting, and the longest time, in
+# seconds, to wait for it to finish before rebooting
+_cloud_init_instance_dir = '/var/lib/cloud/instance'
+_cloud_init_timeout = 600
+
+
 def get_system_params(system):
     """
 Returns a dictionary of OS platform-specific parameters.
@@ -157,7 +181,19 @@ Returns a dictionary of OS platform-specific parameters.
         tempdir = '/usr/tmp/'
         a['pathseparator'] = '/'
         a['readyfile'] = '/var/run/system-is-ready'
-        a['restart'] = 'shutdown -r +1 &'
+        a['rebootflag'] = '/var/run/systemprep-reboot-required'
+        # Reboot once the bootstrap script, or this script when run directly,
+        # has exited, and cloud-init has finished booting the instance, so its
+        # later modules, e.g. scripts-user and final-message, are not cut
+        # short. cloud-init writes `boot-finished` at the end of every boot.
+        # The wait is skipped without cloud-init, and bounded otherwise
+        a['restart'] = '(while kill -0 {0} 2> /dev/null; do sleep 1; done; ' \
+                       'for i in $(seq {1}); do [ ! -d {2} ] || ' \
+                       '[ -e {2}/boot-finished ] && break; sleep 1; done; ' \
+                       'shutdown -r now) > /dev/null 2>&1 &' \
+                       .format(os.environ.get('SYSTEMPREP_BOOTSTRAP_PID',
+                                              os.getpid()),
+                               _cloud_init_timeout, _cloud_init_instance_dir)
     elif 'Windows' in system:
         #TODO: Add and test the Windows parameters/functionality
         systemroot = os.environ['SYSTEMROOT']
@@ -165,6 +201,7 @@ Returns a dictionary of OS platform-specific parameters.
         tempdir = os.environ['TEMP']
         a['pathseparator'] = '\\'
         a['readyfile'] = '{0}\system-is-ready'.format(systemdrive)
+        a['rebootflag'] = '{0}\systemprep-reboot-required'.format(systemdrive)
         a['restart'] = '{0}\system32\shutdown.exe/r /t 30 /d p:2:4 /c "SystemPrep complete. Rebooting computer."'.format(systemroot)
     else:
         #TODO: Update `except` logic
@@ -175,32 +212,210 @@ Returns a dictionary of OS platform-specific parameters.
     return a
 
 
-def download_file(url, filename, sourceiss3bucket=None):
+# --- begin shared block: downloads ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+_s3_connection = None
+
+
+def _get_s3_connection():
     """
-Download the file from `url` and save it locally under `filename`.
+Returns a connection to S3, reusing the connection of earlier downloads.
+    :rtype : boto.s3.connection.S3Connection
+    """
+    global _s3_connection
+    if _s3_connection is None:
+        _s3_connection = boto.connect_s3()
+    return _s3_connection
+
+
+class _HashingWriter(object):
+    """
+    File-like wrapper that updates a hash object with every block written to
+    the underlying file, so the digest is computed as the download streams in.
+    """
+    def __init__(self, fileobj, hashobj):
+        self.fileobj = fileobj
+        self.hashobj = hashobj
+        self.name = fileobj.name
+
+    def write(self, data):
+        self.hashobj.update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# --- begin shared block: throttling ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+class _TokenBucket(object):
+    """
+    Token bucket that caps the average download rate at `rate` bytes per
+    second, allowing bursts of up to one second of data. Shared by every
+    download in the process.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class _ThrottledWriter(object):
+    """
+    File-like wrapper that takes a token from the download bucket for every
+    byte written to the underlying file, if a rate limit is set, and counts
+    the bytes downloaded by the process.
+    """
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+        self.name = fileobj.name
+
+    def write(self, data):
+        global _download_bytes
+        _download_bytes += len(data)
+        if self.bucket:
+            self.bucket.consume(len(data))
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+_download_throttle = None
+_download_bytes = 0
+_download_retries = 5
+_download_backoff = 0.0
+_download_backoff_min = 1.0
+_download_backoff_max = 60.0
+_artifact_dir = None
+
+
+def configure_downloads(downloadratelimit=None, downloadretries=None,
+                        artifactdir=None):
+    """
+Sets the bandwidth cap, the throttling retry limit and the shared artifact
+directory for every download made by this script.
+    :rtype : bool
+    :param downloadratelimit: str, maximum download rate in bytes per second.
+                              '0' or None disables the cap
+    :param downloadretries: str, number of times to retry a request the source
+                            rejected because it is throttling requests
+    :param artifactdir: str, directory of downloaded artifacts shared by
+                        concurrent runs. None downloads every file directly
+    """
+    global _download_throttle, _download_retries, _artifact_dir
+    rate = int(downloadratelimit or 0)
+    _download_throttle = _TokenBucket(rate) if rate > 0 else None
+    if downloadretries is not None:
+        _download_retries = int(downloadretries)
+    _artifact_dir = artifactdir or None
+    return True
+
+
+def _is_throttled(exc):
+    """
+Returns True if `exc` is a response from a source that is throttling
+requests, e.g. an S3 503 SlowDown.
+    :rtype : bool
+    :param exc: Exception, error raised by urllib2 or boto
+    """
+    status = getattr(exc, 'status', None) or getattr(exc, 'code', None)
+    return status in (429, 503) or getattr(exc, 'error_code', None) in \
+        ('SlowDown', 'Throttling', 'RequestLimitExceeded')
+
+
+def _call_with_backoff(url, func, *args):
+    """
+Returns `func(*args)`, retrying up to `downloadretries` times while the
+source throttles the request. The backoff delay is shared by all downloads:
+it doubles with every throttled response and halves with every success, so
+later requests slow down as long as the source is overloaded. Each wait is
+randomized so a fleet of systems does not retry in lockstep.
+    :param url: str, url being requested, for messages
+    :param func: function that makes the request
+    :param args: arguments to `func`
+    """
+    global _download_backoff
+    attempt = 0
+    while True:
+        if _download_backoff:
+            time.sleep(random.uniform(_download_backoff / 2, _download_backoff))
+        try:
+            result = func(*args)
+        except Exception as exc:
+            if not _is_throttled(exc):
+                raise
+            _download_backoff = min(_download_backoff_max,
+                                    max(_download_backoff_min,
+                                        _download_backoff * 2))
+            if attempt >= _download_retries:
+                raise SystemError('Source is still throttling requests after '
+                                  '{0} retries.\n'
+                                  'url = {1}\n'
+                                  'Exception: {2}'
+                                  .format(attempt, url, exc))
+            attempt += 1
+            print('Source is throttling requests, backing off -- \n'
+                  '    url     = {0}\n'
+                  '    attempt = {1}\n'
+                  '    backoff = {2:.1f} seconds'.format(url, attempt,
+                                                         _download_backoff))
+            continue
+        _download_backoff = _download_backoff / 2 \
+            if _download_backoff > _download_backoff_min else 0.0
+        return result
+
+# --- end shared block: throttling ---
+
+
+# ETag the source sent with each url downloaded by `_fetch_to_fileobj`
+_download_etags = {}
+
+
+def _fetch_to_fileobj(url, fileobj, sourceiss3bucket=None):
+    """
+Download the file from `url` and write it to the open file object `fileobj`.
     :rtype : bool
     :param url:
-    :param filename:
+    :param fileobj:
     :param sourceiss3bucket:
     """
     conn = None
+    filename = fileobj.name
 
     if sourceiss3bucket:
         bucket_name = url.split('/')[3]
         key_name = '/'.join(url.split('/')[4:])
         try:
-            conn = boto.connect_s3()
+            conn = _get_s3_connection()
             bucket = conn.get_bucket(bucket_name)
             key = bucket.get_key(key_name)
-            key.get_contents_to_filename(filename=filename)
-        except (NameError, BotoClientError):
+            key.get_contents_to_file(fileobj)
+        except (NameError, BotoClientError, S3ResponseError) as exc:
+            if _is_throttled(exc):
+                raise
             try:
                 bucket_name = url.split('/')[2].split('.')[0]
                 key_name = '/'.join(url.split('/')[3:])
                 bucket = conn.get_bucket(bucket_name)
                 key = bucket.get_key(key_name)
-                key.get_contents_to_filename(filename=filename)
+                key.get_contents_to_file(fileobj)
             except Exception as exc:
+                if _is_throttled(exc):
+                    raise
                 raise SystemError('Unable to download file from S3 bucket.\n'
                                   'url = {0}\n'
                                   'bucket = {1}\n'
@@ -210,6 +425,8 @@ Download the file from `url` and save it locally under `filename`.
                                   .format(url, bucket_name, key_name,
                                           filename, exc))
         except Exception as exc:
+            if _is_throttled(exc):
+                raise
             raise SystemError('Unable to download file from S3 bucket.\n'
                               'url = {0}\n'
                               'bucket = {1}\n'
@@ -218,16 +435,19 @@ Download the file from `url` and save it locally under `filename`.
                               'Exception: {4}'
                               .format(url, bucket_name, key_name,
                                       filename, exc))
+        _download_etags[url] = key.etag
         print('Downloaded file from S3 bucket -- \n'
               '    url      = {0}\n'
               '    filename = {1}'.format(url, filename))
     else:
         try:
             response = urllib2.urlopen(url)
-            with open(filename, 'wb') as outfile:
-                shutil.copyfileobj(response, outfile)
+            shutil.copyfileobj(response, fileobj)
+            _download_etags[url] = response.info().getheader('ETag')
         except Exception as exc:
-            #TODO: Update `except` logic
+            if _is_throttled(exc):
+                raise
+            # TODO: Update `except` logic
             raise SystemError('Unable to download file from web server.\n'
                               'url = {0}\n'
                               'filename = {1}\n'
@@ -239,6 +459,1099 @@ Download the file from `url` and save it locally under `filename`.
     return True
 
 
+def _download_to_fileobj(url, fileobj, sourceiss3bucket=None):
+    """
+Download the file from `url` and write it to the open file object `fileobj`,
+within the download rate limit, backing off while the source throttles
+requests. Throttling is reported in the response status, before any data is
+written, so a throttled request is safe to repeat. If an artifact directory is
+set, the file is copied from the shared copy in that directory instead.
+    :rtype : bool
+    :param url:
+    :param fileobj:
+    :param sourceiss3bucket:
+    """
+    if _artifact_dir:
+        artifact = _fetch_artifact(url, sourceiss3bucket)
+        with open(artifact, 'rb') as f:
+            shutil.copyfileobj(f, fileobj)
+        print('Copied file from the artifact directory -- \n'
+              '    url      = {0}\n'
+              '    artifact = {1}'.format(url, artifact))
+        return True
+    return _call_with_backoff(url, _fetch_to_fileobj, url,
+                              _ThrottledWriter(fileobj, _download_throttle),
+                              sourceiss3bucket)
+
+
+def _get_artifact_path(url):
+    """
+Returns the path of the copy of `url` in the artifact directory. The path
+mirrors the host and path of the url, so distinct urls never collide.
+    :rtype : str
+    :param url: str, url of the artifact
+    """
+    return os.sep.join([_artifact_dir] + url.split('://', 1)[-1].split('/'))
+
+
+def _fetch_artifact(url, sourceiss3bucket=None):
+    """
+Returns the path of the copy of `url` in the artifact directory, downloading
+it first if no run sharing the directory has done so yet. A lock file next
+to the artifact makes concurrent runs wait for the one that is downloading
+it, so each artifact is downloaded once. Artifacts are never refreshed; use a
+new directory for each batch.
+    :rtype : str
+    :param url: str, url of the artifact
+    :param sourceiss3bucket:
+    """
+    artifact = _get_artifact_path(url)
+    try:
+        os.makedirs(os.path.dirname(artifact))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(artifact)):
+            raise
+    with open('{0}.lock'.format(artifact), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.isfile(artifact):
+                partial = '{0}.part'.format(artifact)
+                with open(partial, 'wb') as f:
+                    _call_with_backoff(url, _fetch_to_fileobj, url,
+                                       _ThrottledWriter(f, _download_throttle),
+                                       sourceiss3bucket)
+                os.rename(partial, artifact)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return artifact
+
+
+_artifact_store = None
+_artifact_peers = []
+# peers are asked in random order, so a missing artifact costs at most this
+# many timeouts before the origin url is used
+_artifact_peer_attempts = 3
+_artifact_peer_timeout = 2
+
+
+def configure_peers(artifactstore=None, artifactpeers=None):
+    """
+Sets the local store of verified artifacts and the peers to query for
+artifacts before their origin url.
+    :rtype : bool
+    :param artifactstore: str, directory in which to keep a copy of every
+                          verified artifact, named by its SHA-256 digest.
+                          None disables the store
+    :param artifactpeers: str, comma-separated `host:port` or base urls of
+                          peers serving their artifact stores with
+                          `Utils/systemprep-artifactpeer.py`
+    """
+    global _artifact_store, _artifact_peers
+    _artifact_store = artifactstore or None
+    _artifact_peers = []
+    for peer in (artifactpeers or '').split(','):
+        peer = peer.strip().rstrip('/')
+        if peer:
+            _artifact_peers.append(peer if '://' in peer
+                                   else 'http://{0}'.format(peer))
+    return True
+
+
+def _get_file_digest(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def store_artifact(filepath, sha256):
+    """
+Copies the verified file at `filepath` into the artifact store as
+`<artifactstore>/sha256/<sha256>`, if the store is enabled.
+    :rtype : bool
+    :param filepath: str, path of the verified file
+    :param sha256: str, hex digest of the file
+    """
+    if not _artifact_store:
+        return False
+    storedir = os.sep.join((_artifact_store, 'sha256'))
+    try:
+        if not os.path.isdir(storedir):
+            os.makedirs(storedir)
+        fd, partial = tempfile.mkstemp(dir=storedir)
+        os.close(fd)
+    except (IOError, OSError) as exc:
+        print('Could not add the file to the artifact store -- {0}'
+              .format(exc))
+        return False
+    try:
+        shutil.copyfile(filepath, partial)
+        os.chmod(partial, 0o644)
+        os.rename(partial, os.sep.join((storedir, sha256.lower())))
+    except (IOError, OSError) as exc:
+        print('Could not add the file to the artifact store -- {0}'
+              .format(exc))
+        os.remove(partial)
+        return False
+    return True
+
+
+def fetch_from_peers(sha256, filename):
+    """
+Saves the artifact with the SHA-256 digest `sha256` to `filename` from the
+local artifact store, or from the first peer that serves it. At most
+`_artifact_peer_attempts` peers, chosen at random, are asked. Every copy is
+verified against the digest; a peer that serves a bad copy is skipped.
+Returns False if no verified copy was found, so the caller can fall back to
+the origin url.
+    :rtype : bool
+    :param sha256: str, hex digest of the artifact
+    :param filename: str, path in which to save the artifact
+    """
+    sha256 = sha256.lower()
+    if _artifact_store:
+        stored = os.sep.join((_artifact_store, 'sha256', sha256))
+        if os.path.isfile(stored) and sha256 == _get_file_digest(stored):
+            shutil.copyfile(stored, filename)
+            print('Copied file from the artifact store -- \n'
+                  '    sha256   = {0}\n'
+                  '    filename = {1}'.format(sha256, filename))
+            return True
+    for peer in random.sample(_artifact_peers, min(len(_artifact_peers),
+                                                   _artifact_peer_attempts)):
+        url = '{0}/sha256/{1}'.format(peer, sha256)
+        try:
+            response = urllib2.urlopen(url, timeout=_artifact_peer_timeout)
+            with open(filename, 'wb') as outfile:
+                writer = _HashingWriter(outfile, hashlib.sha256())
+                shutil.copyfileobj(response,
+                                   _ThrottledWriter(writer,
+                                                    _download_throttle))
+        except Exception:
+            continue
+        if sha256 == writer.hashobj.hexdigest():
+            print('Downloaded file from peer -- \n'
+                  '    url      = {0}\n'
+                  '    filename = {1}'.format(url, filename))
+            store_artifact(filename, sha256)
+            return True
+        print('Peer served a file that does not match its digest -- {0}'
+              .format(url))
+    return False
+
+
+def download_file(url, filename, sourceiss3bucket=None, sha256=None,
+                  retries=2):
+    """
+Download the file from `url` and save it locally under `filename`.
+The SHA-256 digest is computed while the file is written, so verification does
+not cost a second read of the file. If `sha256` is given and the digest does
+not match, the file is fetched again, up to `retries` times.
+If `sha256` is given, the file is first looked up by its digest in the
+artifact store and on peers, see `fetch_from_peers`, and verified files are
+added to the artifact store.
+Returns the hex digest of the downloaded file.
+    :rtype : str
+    :param url:
+    :param filename:
+    :param sourceiss3bucket:
+    :param sha256: str, expected hex digest of the file
+    :param retries: int, number of re-fetches to attempt on a digest mismatch
+    """
+    if sha256 and fetch_from_peers(sha256, filename):
+        return sha256.lower()
+
+    digest = None
+    for attempt in range(retries + 1):
+        try:
+            with open(filename, 'wb') as outfile:
+                writer = _HashingWriter(outfile, hashlib.sha256())
+                _download_to_fileobj(url, writer, sourceiss3bucket)
+        except IOError as exc:
+            raise SystemError('Unable to write downloaded file.\n'
+                              'url = {0}\n'
+                              'filename = {1}\n'
+                              'Exception: {2}'
+                              .format(url, filename, exc))
+        digest = writer.hashobj.hexdigest()
+        if not sha256 or digest == sha256.lower():
+            if sha256:
+                print('Verified SHA-256 digest of {0} -- {1}'
+                      .format(filename, digest))
+                store_artifact(filename, digest)
+            return digest
+        print('SHA-256 digest mismatch, re-fetching file -- \n'
+              '    url      = {0}\n'
+              '    expected = {1}\n'
+              '    actual   = {2}'.format(url, sha256, digest))
+        if _artifact_dir and os.path.isfile(_get_artifact_path(url)):
+            os.remove(_get_artifact_path(url))
+
+    raise SystemError('Downloaded file does not match the published '
+                      'SHA-256 digest.\n'
+                      'url = {0}\n'
+                      'filename = {1}\n'
+                      'expected = {2}\n'
+                      'actual = {3}'
+                      .format(url, filename, sha256, digest))
+
+
+def get_artifact_digest(url, sourceiss3bucket=None):
+    """
+Returns the SHA-256 digest published for the artifact at `url`.
+The digest is read from the manifest published next to the artifact,
+`<url>.sha256`, which holds the hex digest followed by the file name, as
+written by `sha256sum`.
+    :rtype : str
+    :param url: str, url of the artifact
+    :param sourceiss3bucket:
+    """
+    manifesturl = '{0}.sha256'.format(url)
+    manifest = StringIO.StringIO()
+    manifest.name = manifesturl.split('/')[-1]
+    _download_to_fileobj(manifesturl, manifest, sourceiss3bucket)
+    fields = manifest.getvalue().split()
+    if not fields or not re.match('^[0-9a-fA-F]{64}$', fields[0]):
+        raise SystemError('Artifact manifest does not contain a SHA-256 '
+                          'digest.\n'
+                          'url = {0}'.format(manifesturl))
+    return fields[0].lower()
+
+# --- end shared block: downloads ---
+
+
+_s3_url_pattern = re.compile(r'^https?://(?:(?P<bucket>[^/]+)\.)?'
+                             r's3(?:[.-][a-z0-9-]+)?\.amazonaws\.com/'
+                             r'(?P<path>.+)$')
+_selected_mirrors = {}
+
+
+def get_instance_region(awsregion=None):
+    """
+Returns the AWS region of this system, read from the instance metadata
+service, or `awsregion` if the metadata service is not available.
+    :rtype : str
+    :param awsregion: str, region to use if the metadata service is not
+                      available
+    """
+    try:
+        zone = urllib2.urlopen('http://169.254.169.254/latest/meta-data/'
+                               'placement/availability-zone',
+                               timeout=2).read().strip()
+        return zone[:-1]
+    except Exception:
+        return awsregion
+
+
+def get_mirror_url(url, mirror):
+    """
+Returns the url of the artifact at the S3 `url` on `mirror`, or None if `url`
+is not an S3 url. `mirror` is a base url under which the artifact is found at
+`<bucket>/<key>`. If `mirror` contains '{bucket}', the bucket name is
+substituted there instead, and the artifact is found at `<key>`.
+    :rtype : str
+    :param url: str, path-style or virtual-hosted-style S3 url
+    :param mirror: str, base url of the mirror
+    """
+    m = _s3_url_pattern.match(url)
+    if m is None:
+        return None
+    bucket = m.group('bucket')
+    key = m.group('path')
+    if not bucket:
+        bucket, key = key.split('/', 1)
+    if '{bucket}' in mirror:
+        return '/'.join((mirror.replace('{bucket}', bucket).rstrip('/'), key))
+    return '/'.join((mirror.rstrip('/'), bucket, key))
+
+
+def probe_mirror(url, sourceiss3bucket=None, timeout=5):
+    """
+Returns the seconds taken to read the first byte of `url`, or None if the
+mirror is unreachable or does not have the artifact. If `sourceiss3bucket`
+is set and `url` is an S3 url, a 403 counts as a response, since the probe
+is not signed and the download will be.
+    :rtype : float
+    :param url: str, url of an artifact on the mirror
+    :param sourceiss3bucket:
+    :param timeout: int, seconds to wait for a response
+    """
+    start = time.time()
+    try:
+        request = urllib2.Request(url, headers={'Range': 'bytes=0-0'})
+        urllib2.urlopen(request, timeout=timeout).read()
+    except urllib2.HTTPError as exc:
+        if not (sourceiss3bucket and 403 == exc.code and
+                _s3_url_pattern.match(url)):
+            return None
+    except Exception:
+        return None
+    return time.time() - start
+
+
+def select_mirror(mirrors, probeurl, sourceiss3bucket=None, awsregion=None):
+    """
+Probes every mirror in `mirrors` concurrently for the artifact at `probeurl`
+and returns the mirror that answered first, or None if none answered. A
+'{region}' in a mirror is replaced with the region of this system. The
+choice is cached, so later calls in the same process do not probe again.
+    :rtype : str
+    :param mirrors: str, comma-separated base urls of the mirrors
+    :param probeurl: str, S3 url of an artifact present on every mirror
+    :param sourceiss3bucket:
+    :param awsregion: str, region to use if the metadata service is not
+                      available
+    """
+    if mirrors in _selected_mirrors:
+        return _selected_mirrors[mirrors]
+
+    region = get_instance_region(awsregion)
+    candidates = [x.strip() for x in mirrors.split(',') if x.strip()]
+    candidates = [x.replace('{region}', region) if region else x
+                  for x in candidates if region or '{region}' not in x]
+    latencies = {}
+
+    def probe(mirror):
+        latencies[mirror] = probe_mirror(get_mirror_url(probeurl, mirror),
+                                         sourceiss3bucket)
+
+    threads = [threading.Thread(target=probe, args=(x,)) for x in candidates]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('Probed artifact mirrors -- ')
+    for mirror in candidates:
+        latency = latencies.get(mirror)
+        print('    {0} = {1}'.format(mirror, 'unavailable' if latency is None
+                                     else '{0:.3f} seconds'.format(latency)))
+    healthy = [(v, k) for k, v in latencies.items() if v is not None]
+    selected = min(healthy)[1] if healthy else None
+    print('Selected artifact mirror -- {0}'.format(
+        selected or 'none, using the original urls'))
+    _selected_mirrors[mirrors] = selected
+    return selected
+
+
+def is_s3_mirror(mirror):
+    """
+Returns True if the urls on `mirror` are S3 urls, which `download_file` can
+fetch with `sourceiss3bucket`. Urls on any other mirror must be fetched over
+plain HTTP.
+    :rtype : bool
+    :param mirror: str, base url of the mirror, see `get_mirror_url`
+    """
+    return bool(_s3_url_pattern.match('/'.join(
+        (mirror.replace('{bucket}', 'bucket').rstrip('/'), 'key'))))
+
+
+def apply_mirror(scriptstoexecute, mirror):
+    """
+Returns a copy of `scriptstoexecute` with every S3 url replaced by its url on
+`mirror`. If `mirror` is not an S3 mirror, `sourceiss3bucket` is also set to
+'false' for every content script, so the rewritten urls are fetched from the
+mirror instead of through the S3 API.
+    :rtype : list
+    :param scriptstoexecute: list, as returned by `get_scripts_to_execute`
+    :param mirror: str, base url of the mirror, see `get_mirror_url`
+    """
+    scriptstoexecute = rewrite_artifact_urls(scriptstoexecute, mirror)
+    if not is_s3_mirror(mirror):
+        for script in scriptstoexecute:
+            script['Parameters']['sourceiss3bucket'] = 'false'
+    return scriptstoexecute
+
+
+def rewrite_artifact_urls(value, mirror):
+    """
+Returns a copy of `value` with every S3 url replaced by its url on `mirror`.
+`value` may be a string or any nesting of lists, tuples and dicts, such as
+the list returned by `get_scripts_to_execute`.
+    :param value: str, list, tuple or dict
+    :param mirror: str, base url of the mirror, see `get_mirror_url`
+    """
+    if isinstance(value, dict):
+        return dict((k, rewrite_artifact_urls(v, mirror))
+                    for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(rewrite_artifact_urls(v, mirror) for v in value)
+    if isinstance(value, basestring):
+        return get_mirror_url(value, mirror) or value
+    return value
+
+
+def get_instance_id():
+    """
+Returns the EC2 instance ID of this system, read from the instance metadata
+service, or the hostname if the metadata service is not available.
+    :rtype : str
+    """
+    try:
+        return urllib2.urlopen('http://169.254.169.254/latest/meta-data/'
+                               'instance-id', timeout=2).read().strip()
+    except Exception:
+        return platform.node()
+
+
+def wait_for_download_slot(downloadjitter):
+    """
+Sleeps for between zero and `downloadjitter` seconds before the first
+download. The delay is derived from the instance ID, so an autoscale group
+that launches many instances at once spreads their downloads evenly across
+the window, and an instance always waits the same time.
+Returns the delay in seconds.
+    :rtype : float
+    :param downloadjitter: str, width of the window in seconds. '0' or None
+                           disables the delay
+    """
+    jitter = float(downloadjitter or 0)
+    if jitter <= 0:
+        return 0.0
+    instanceid = get_instance_id()
+    delay = int(hashlib.sha256(instanceid).hexdigest()[:8], 16) \
+        / float(0xffffffff) * jitter
+    print('Delaying downloads to spread the load of the fleet -- \n'
+          '    instance = {0}\n'
+          '    delay    = {1:.1f} seconds'.format(instanceid, delay))
+    sys.stdout.flush()
+    time.sleep(delay)
+    return delay
+
+
+def discover_artifact_peers(artifactpeerport='8771', awsregion=None):
+    """
+Returns a comma-separated list of `host:port` peers for `configure_peers`,
+one for each other in-service instance in the autoscale group of this
+system, addressed by private IP. Returns an empty string if this system is
+not in an autoscale group or the group cannot be described.
+    :rtype : str
+    :param artifactpeerport: str, port on which the peers serve their artifact
+                             stores
+    :param awsregion: str, region to use if the metadata service is not
+                      available
+    """
+    import boto.ec2
+    import boto.ec2.autoscale
+
+    instanceid = get_instance_id()
+    region = get_instance_region(awsregion)
+    try:
+        autoscale = boto.ec2.autoscale.connect_to_region(region)
+        membership = autoscale.get_all_autoscaling_instances([instanceid])
+        if not membership:
+            print('This system is not in an autoscale group. No artifact '
+                  'peers were discovered.')
+            return ''
+        group = autoscale.get_all_groups([membership[0].group_name])[0]
+        peerids = [i.instance_id for i in group.instances
+                   if i.instance_id != instanceid and
+                   'InService' == i.lifecycle_state]
+        peers = []
+        if peerids:
+            ec2 = boto.ec2.connect_to_region(region)
+            for instance in ec2.get_only_instances(peerids):
+                if instance.private_ip_address:
+                    peers.append('{0}:{1}'.format(
+                        instance.private_ip_address, artifactpeerport))
+    except Exception as exc:
+        print('Could not discover artifact peers -- {0}'.format(exc))
+        return ''
+    print('Discovered artifact peers in autoscale group {0} -- {1}'
+          .format(group.name, ', '.join(peers) or 'None'))
+    return ','.join(peers)
+
+
+# --- begin shared block: journal ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+class CheckpointJournal(object):
+    """
+    Records the phases of a run that completed, with a digest of the inputs
+    of each phase, so a rerun after a failure can skip them. A rerun skips
+    phases while they match the journal in order. The first phase that did
+    not complete, or whose inputs changed, and every phase after it, run
+    again.
+    """
+    def __init__(self, path, cleanrun=False):
+        self.path = path
+        self.entries = []
+        self.position = 0
+        self.resuming = not cleanrun
+        if cleanrun:
+            print('Detected `cleanrun`, ignoring the checkpoint journal -- {0}'
+                  .format(path))
+            return
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)['phases']
+        except (IOError, ValueError, KeyError, TypeError):
+            self.entries = []
+
+    def expects(self, name):
+        """
+    Returns True if the next phase recorded by an earlier run is `name`, so it
+    may be skipped. The input digest of any other phase is only needed once
+    the phase completes.
+        """
+        return self.resuming and self.position < len(self.entries) and \
+            name == self.entries[self.position]['name']
+
+    def skip(self, name, digest):
+        """
+    Returns True if the phase `name` completed in an earlier run with the
+    same input `digest`, and every phase before it was skipped too. A phase
+    with no digest is never skipped.
+        """
+        if self.resuming and digest and self.position < len(self.entries) \
+                and {'name': name, 'digest': digest} == \
+                self.entries[self.position]:
+            self.position += 1
+            print('Skipping phase completed by an earlier run -- {0}'
+                  .format(name))
+            return True
+        self.resuming = False
+        del self.entries[self.position:]
+        return False
+
+    def complete(self, name, digest):
+        """
+    Records that the phase `name` completed with the input `digest`.
+        """
+        self.entries.append({'name': name, 'digest': digest})
+        self.position = len(self.entries)
+        journaldir = os.path.dirname(self.path)
+        if not os.path.isdir(journaldir):
+            os.makedirs(journaldir)
+        with open('{0}.tmp'.format(self.path), 'w') as f:
+            json.dump({'phases': self.entries}, f, indent=2)
+        os.rename('{0}.tmp'.format(self.path), self.path)
+
+    def clear(self):
+        """
+    Removes the journal, so the next run starts from the first phase.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.entries = []
+        self.position = 0
+
+
+def get_input_digest(*inputs):
+    """
+Returns the SHA-256 hex digest of `inputs`, which must be serializable as
+JSON.
+    :rtype : str
+    :param inputs: values the phase depends on
+    """
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+# --- end shared block: journal ---
+
+
+def get_target_path(targetroot, path):
+    """
+Returns the absolute `path` resolved under `targetroot`, the root of the
+filesystem being provisioned.
+    :rtype : str
+    :param targetroot: str, path of the target root. None or '/' is the
+                       running system
+    :param path: str, absolute path within the target root
+    """
+    if not targetroot or '/' == targetroot:
+        return path
+    return os.sep.join((targetroot.rstrip(os.sep), path.lstrip(os.sep)))
+
+
+# Defaults of a governed run, used for any parameter that is not set
+_governed_defaults = {
+    'downloadratelimit': '2097152',
+    'maxthreads': '1',
+    'governedcpu': '50',
+    'governednice': '10',
+}
+# Each run gets its own cgroup, so every process left in it belongs to the run
+_governor_cgroup = 'systemprep-{0}'
+# (cgroup, original cgroup) of each hierarchy joined by `join_governor_cgroup`
+_governor_cgroups = []
+
+
+def _write_cgroup_file(path, value):
+    try:
+        with open(path, 'w') as f:
+            f.write(value)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _get_current_cgroup(hierarchy, controller):
+    """
+Returns the path of the cgroup this process is in, under `hierarchy`. An
+empty `controller` selects the unified (v2) hierarchy.
+    :rtype : str
+    :param hierarchy: str, mount point of the hierarchy
+    :param controller: str, controller of the v1 hierarchy, e.g. 'cpu'
+    """
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split(':', 2)
+                if 3 == len(fields) and (controller in fields[1].split(',')
+                                         if controller else not fields[1]):
+                    return hierarchy + fields[2].rstrip('/')
+    except IOError:
+        pass
+    return hierarchy
+
+
+def join_governor_cgroup(governedcpu):
+    """
+Moves this process into a `systemprep-<pid>` cgroup, creating it if needed.
+`leave_governor_cgroup` removes it when the run finishes. The cgroup caps
+the CPU time of the process tree at `governedcpu` percent of one core, and
+gives its disk I/O a low weight. Supports the unified (v2)
+hierarchy, and the cpu and blkio controllers of the v1 hierarchy. Settings
+the kernel does not support are skipped.
+Returns the paths of the cgroups joined.
+    :rtype : list
+    :param governedcpu: str, percent of one core
+    """
+    period = 100000
+    quota = max(1000, int(period * float(governedcpu) / 100))
+    if os.path.isfile('/sys/fs/cgroup/cgroup.controllers'):
+        _write_cgroup_file('/sys/fs/cgroup/cgroup.subtree_control',
+                           '+cpu +io')
+        hierarchies = [('/sys/fs/cgroup', '', (
+            ('cpu.max', '{0} {1}'.format(quota, period)),
+            ('io.weight', 'default 10')))]
+    else:
+        hierarchies = [
+            ('/sys/fs/cgroup/cpu', 'cpu', (
+                ('cpu.cfs_period_us', str(period)),
+                ('cpu.cfs_quota_us', str(quota)))),
+            ('/sys/fs/cgroup/blkio', 'blkio', (('blkio.weight', '10'),)),
+        ]
+
+    joined = []
+    for hierarchy, controller, settings in hierarchies:
+        cgroup = os.sep.join((hierarchy,
+                              _governor_cgroup.format(os.getpid())))
+        original = _get_current_cgroup(hierarchy, controller)
+        if original == cgroup:
+            joined.append(cgroup)
+            continue
+        try:
+            if not os.path.isdir(cgroup):
+                os.mkdir(cgroup)
+        except OSError:
+            continue
+        for name, value in settings:
+            _write_cgroup_file(os.sep.join((cgroup, name)), value)
+        if _write_cgroup_file(os.sep.join((cgroup, 'cgroup.procs')),
+                              str(os.getpid())):
+            _governor_cgroups.append((cgroup, original))
+            joined.append(cgroup)
+    return joined
+
+
+def leave_governor_cgroup():
+    """
+Moves every process left in the cgroups joined by `join_governor_cgroup`
+back to the cgroup this process was in, and removes the cgroups. That
+includes this process and any daemon a content script started, so the caps
+do not outlast the run.
+    :rtype : bool
+    """
+    while _governor_cgroups:
+        cgroup, original = _governor_cgroups.pop()
+        procs = os.sep.join((cgroup, 'cgroup.procs'))
+        try:
+            with open(procs, 'r') as f:
+                pids = f.read().split()
+        except IOError:
+            pids = []
+        for pid in pids:
+            _write_cgroup_file(os.sep.join((original, 'cgroup.procs')), pid)
+        try:
+            os.rmdir(cgroup)
+        except OSError as exc:
+            print('Could not remove the cgroup {0} -- {1}'.format(cgroup, exc))
+    return True
+
+
+def govern_process(governedcpu, governednice):
+    """
+Lowers the CPU and I/O scheduling priority of this process, and caps its CPU
+time with a cgroup where one can be created. Every content script, `yum` and
+`salt-call` run by this process inherits the limits.
+    :rtype : bool
+    :param governedcpu: str, percent of one core the process tree may use.
+                        '0' skips the cgroup
+    :param governednice: str, niceness of the process tree
+    """
+    niceness = int(governednice)
+    if niceness > os.nice(0):
+        os.nice(niceness - os.nice(0))
+    ionice = find_executable('ionice')
+    if ionice:
+        subprocess.call([ionice, '-c2', '-n7', '-p', str(os.getpid())])
+    cgroups = join_governor_cgroup(governedcpu) \
+        if float(governedcpu) > 0 else []
+    print('Governing the resources of this run -- \n'
+          '    nice    = {0}\n'
+          '    ionice  = {1}\n'
+          '    cgroups = {2}'.format(os.nice(0),
+                                     'best-effort 7' if ionice else 'None',
+                                     ', '.join(cgroups) or 'None'))
+    return True
+
+
+# the line printed by `print_resource_usage`, also in the content scripts
+_resource_usage_pattern = re.compile(r'^Resource usage -- .*\bbytes_downloaded'
+                                     r' = (?P<bytes>\d+)')
+
+
+# --- begin shared block: resource usage ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+def get_resource_usage():
+    """
+Returns the resources consumed by this process and by the child processes it
+has waited for, including every process they waited for in turn.
+    :rtype : dict
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cpu_user_seconds': round(own.ru_utime + children.ru_utime, 3),
+        'cpu_system_seconds': round(own.ru_stime + children.ru_stime, 3),
+        'max_rss_kb': max(own.ru_maxrss, children.ru_maxrss),
+        'block_reads': own.ru_inblock + children.ru_inblock,
+        'block_writes': own.ru_oublock + children.ru_oublock,
+        'bytes_downloaded': _download_bytes,
+    }
+
+
+def get_resource_usage_since(startusage):
+    """
+Returns the resources consumed since `startusage` was taken. Peak memory
+cannot be measured over an interval, so `max_rss_kb` is the peak so far.
+    :rtype : dict
+    :param startusage: dict, as returned by `get_resource_usage`
+    """
+    usage = get_resource_usage()
+    for key in usage:
+        if key.startswith('cpu_'):
+            usage[key] = round(usage[key] - startusage[key], 3)
+        elif 'max_rss_kb' != key:
+            usage[key] -= startusage[key]
+    return usage
+
+
+def print_resource_usage(name, usage):
+    """
+Prints `usage` on one line, in a format that is easy to find in the logs.
+    :rtype : bool
+    :param name: str, name of the run the usage belongs to
+    :param usage: dict, as returned by `get_resource_usage`
+    """
+    print('Resource usage -- name = {0}, {1}'
+          .format(name, ', '.join('{0} = {1}'.format(k, usage[k])
+                                  for k in sorted(usage))))
+    sys.stdout.flush()
+    return True
+
+# --- end shared block: resource usage ---
+
+
+# --- begin shared block: phase banners ---
+# Keep every copy identical, see Utils/systemprep-checkshared.py
+def print_phase(phase, start):
+    """
+Prints a banner recording the duration of a provisioning phase. The banner
+is parsed by `Utils/systemprep-timeline.py` to report fleet-wide timings.
+    :rtype : float
+    :param phase: str, name of the phase
+    :param start: float, time the phase started, as returned by `time.time`
+    """
+    end = time.time()
+    print('Completed phase -- name = {0}, start = {1:.3f}, seconds = {2:.3f}'
+          .format(phase, start, end - start))
+    return end
+
+# --- end shared block: phase banners ---
+
+
+# Packages that only take effect after a reboot when updated
+_reboot_packages = re.compile(r'^(kernel(-.+)?|glibc|linux-firmware|systemd|'
+                              r'dbus|udev)$')
+
+
+def _get_command_output(command):
+    """
+Returns the exit code and stdout of `command`, or (None, '') if the command
+could not be run.
+    :rtype : tuple
+    :param command: list, the command and its arguments
+    """
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                   stderr=open(os.devnull, 'w'))
+    except OSError:
+        return None, ''
+    output = process.communicate()[0]
+    return process.returncode, output
+
+
+def get_reboot_reasons(system, rebootflag):
+    """
+Returns a list of the reasons the system must be rebooted to finish
+provisioning. An empty list means the system is ready without a reboot.
+A reboot is needed when a kernel, glibc or other boot-time package was
+installed since boot, when the SELinux config enables or disables SELinux
+relative to the running mode, when `needs-restarting -r` reports one, or when
+a salt state created the file `rebootflag`.
+Reboot detection is only implemented for Linux; other systems always report
+a reason to reboot.
+    :rtype : list
+    :param system: str, the system type as returned by `platform.system`
+    :param rebootflag: str, path of the file salt states create to request a
+                       reboot
+    """
+    if 'Linux' not in system:
+        return ['Reboot detection is not supported on {0}.'.format(system)]
+
+    reasons = []
+
+    boottime = None
+    try:
+        with open('/proc/stat', 'r') as f:
+            for line in f:
+                if line.startswith('btime '):
+                    boottime = int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    returncode, output = _get_command_output(
+        ['rpm', '-qa', '--queryformat', '%{INSTALLTIME} %{NAME}\\n'])
+    if boottime is None or returncode != 0:
+        reasons.append('Could not determine the packages installed since '
+                       'boot.')
+    else:
+        updated = sorted(set(
+            name for installtime, name in
+            (line.split(None, 1) for line in output.splitlines() if line)
+            if int(installtime) >= boottime and _reboot_packages.match(name)))
+        if updated:
+            reasons.append('Packages updated since boot: {0}'
+                           .format(', '.join(updated)))
+
+    configmode = None
+    try:
+        with open('/etc/selinux/config', 'r') as f:
+            for line in f:
+                if line.startswith('SELINUX='):
+                    configmode = line.split('=', 1)[1].strip().lower()
+    except IOError:
+        pass
+    returncode, output = _get_command_output(['getenforce'])
+    runningmode = output.strip().lower() if returncode == 0 else None
+    if configmode and runningmode and \
+            ('disabled' == configmode) != ('disabled' == runningmode):
+        reasons.append('SELinux mode changes from {0} to {1}.'
+                       .format(runningmode, configmode))
+
+    if find_executable('needs-restarting'):
+        # Older versions do not support `-r` and exit with a usage error
+        returncode, output = _get_command_output(['needs-restarting', '-r'])
+        if 1 == returncode:
+            reasons.append('`needs-restarting -r` reports a reboot is '
+                           'required.')
+
+    if os.path.exists(rebootflag):
+        reasons.append('Salt states requested a reboot with {0}.'
+                       .format(rebootflag))
+
+    return reasons
+
+
+def write_ready_file(readyfile):
+    """
+Creates `readyfile` to signal that provisioning is complete and the system is
+ready for use.
+    :rtype : bool
+    :param readyfile: str, path to the ready file
+    """
+    try:
+        with open(readyfile, 'w') as f:
+            f.write('{0}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                 time.gmtime())))
+    except Exception as exc:
+        #TODO: Update `except` logic
+        raise SystemError('Could not write the ready file: {0}\n'
+                          'Exception: {1}'.format(readyfile, exc))
+    print('Wrote the ready file -- {0}'.format(readyfile))
+    return True
+
+
+def fetch_script(url, fullfilepath, sourceiss3bucket=None,
+                 verifyartifacts=None):
+    """
+Downloads the content script at `url` to `fullfilepath`, verifying it against
+the published manifest if `verifyartifacts` is set.
+Returns the hex digest of the script.
+    :rtype : str
+    :param url: str, url of the content script
+    :param fullfilepath: str, path in which to save the script
+    :param sourceiss3bucket:
+    :param verifyartifacts:
+    """
+    scriptdigest = None
+    if verifyartifacts:
+        scriptdigest = get_artifact_digest(url, sourceiss3bucket)
+    return download_file(url, fullfilepath, sourceiss3bucket,
+                         sha256=scriptdigest)
+
+
+def run_content_script(fullfilepath, parameters):
+    """
+Executes the content script at `fullfilepath` in a new python process,
+passing each of `parameters` as a `key='value'` argument. The output of the
+script is relayed, and the bytes it reports having downloaded are added to
+those of this process.
+    :rtype : bool
+    :param fullfilepath: str, path to the content script
+    :param parameters: dict, parameters to pass to the script
+    """
+    global _download_bytes
+    #TODO: figure out if there's a better way to call and execute the script
+    paramstring = ' '.join("%s='%s'" % (key, val) for (key, val) in parameters.iteritems())
+    fullcommand = 'python {0} {1}'.format(fullfilepath, paramstring)
+    sys.stdout.flush()
+    process = subprocess.Popen(fullcommand, shell=True,
+                               stdout=subprocess.PIPE)
+    for line in iter(process.stdout.readline, ''):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+        usage = _resource_usage_pattern.match(line)
+        if usage:
+            _download_bytes += int(usage.group('bytes'))
+    result = process.wait()
+    if result is not 0:
+        message = 'Encountered an unrecoverable error executing a ' \
+                  'content script. Exiting with failure.\n' \
+                  'Command executed: {0}' \
+                  .format(fullcommand)
+        raise SystemError(message)
+    return True
+
+
+# content scripts imported by `run_content_script_in_process`, by digest
+_content_modules = {}
+
+
+def run_content_script_in_process(fullfilepath, parameters):
+    """
+Executes the content script at `fullfilepath` in this interpreter, with the
+same arguments `run_content_script` would pass on the command line. A script
+that defines `parse_args` is imported once per version and its `main` is
+called, so the state it keeps between runs, e.g. its S3 connection, stays
+warm. Its `reset_run_state`, if any, is called first to discard the state
+of the previous run. Other scripts are run from scratch, reusing only the modules they
+import. The bytes the script downloaded are added to those of this process.
+    :rtype : bool
+    :param fullfilepath: str, path to the content script
+    :param parameters: dict, parameters to pass to the script
+    """
+    global _download_bytes
+    paramstring = ' '.join("%s='%s'" % (key, val) for (key, val) in parameters.iteritems())
+    # shlex strips the quotes exactly as the shell does for os.system
+    savedargv = sys.argv
+    sys.argv = [fullfilepath] + shlex.split(paramstring)
+    module = None
+    startbytes = 0
+    try:
+        digest = _get_file_digest(fullfilepath)
+        if digest not in _content_modules:
+            module = imp.load_source(
+                'systemprep_content_{0}'.format(digest[:16]), fullfilepath)
+            # None marks a script that can only be run from scratch
+            _content_modules[digest] = module \
+                if hasattr(module, 'parse_args') else None
+        module = _content_modules[digest]
+        if module is None:
+            namespace = runpy.run_path(fullfilepath, run_name='__main__')
+            _download_bytes += namespace.get('_download_bytes', 0)
+        else:
+            if hasattr(module, 'reset_run_state'):
+                module.reset_run_state()
+            startbytes = getattr(module, '_download_bytes', 0)
+            module.main(**module.parse_args(sys.argv[1:]))
+    except SystemExit as exc:
+        if exc.code:
+            raise SystemError('Content script exited with an error.\n'
+                              'Script executed: {0}\n'
+                              'Exit code: {1}'.format(fullfilepath, exc.code))
+    except Exception as exc:
+        raise SystemError('Encountered an unrecoverable error executing a '
+                          'content script.\n'
+                          'Script executed: {0}\n'
+                          'Exception: {1}'.format(fullfilepath, exc))
+    finally:
+        sys.argv = savedargv
+        if module is not None:
+            _download_bytes += getattr(module, '_download_bytes', 0) - \
+                startbytes
+    return True
+
+
+def execute_scripts(scriptstoexecute, systemparams, sourceiss3bucket=None,
+                    verifyartifacts=None, fetch=fetch_script,
+                    run=run_content_script, journal=None):
+    """
+Downloads and executes each content script in `scriptstoexecute`, in order.
+    :rtype : bool
+    :param scriptstoexecute: list, as returned by `get_scripts_to_execute`
+    :param systemparams: dict, as returned by `get_system_params`
+    :param sourceiss3bucket:
+    :param verifyartifacts:
+    :param fetch: function that downloads a script, with the signature of
+                  `fetch_script`
+    :param run: function that executes a script, with the signature of
+                `run_content_script`
+    :param journal: CheckpointJournal, optional. scripts that completed with
+                    the same script digest and parameters in an earlier run
+                    are skipped
+    """
+    #Loop through each 'script' in scriptstoexecute
+    for script in scriptstoexecute:
+        url = script['ScriptSource']
+        filename = url.split('/')[-1]
+        fullfilepath = systemparams['workingdir'] + systemparams['pathseparator'] + filename
+        #Download each script, script['ScriptSource']
+        phasestart = time.time()
+        scriptdigest = fetch(url, fullfilepath, sourceiss3bucket,
+                             verifyartifacts)
+        phasestart = print_phase('download {0}'.format(filename), phasestart)
+        if journal:
+            parameters = dict((k, v) for k, v in script['Parameters'].items()
+                              if 'cleanrun' != k)
+            phasedigest = get_input_digest(scriptdigest, parameters)
+            if journal.skip(filename, phasedigest):
+                continue
+        #Execute each script, passing it the parameters in script['Parameters']
+        print('Running script -- ' + script['ScriptSource'])
+        print('Sending parameters --')
+        for key, value in script['Parameters'].items():
+            print('    {0} = {1}'.format(key, value))
+        try:
+            run(fullfilepath, script['Parameters'])
+        finally:
+            print_phase(filename, phasestart)
+        if journal:
+            journal.complete(filename, phasedigest)
+    return True
+
+
 def cleanup(workingdir):
     """
     Removes temporary files loaded to the system.
@@ -260,9 +1573,259 @@ def cleanup(workingdir):
     return True
 
 
+def get_remote_etag(url, sourceiss3bucket=None):
+    """
+Returns the ETag of the remote file at `url`, using a HEAD request, or None
+if the server does not provide one.
+    :rtype : str
+    :param url: str, url of the remote file
+    :param sourceiss3bucket:
+    """
+    try:
+        if sourceiss3bucket:
+            conn = _get_s3_connection()
+            parts = url.split('/')
+            for bucket_name, key_name in ((parts[3], '/'.join(parts[4:])),
+                                          (parts[2].split('.')[0],
+                                           '/'.join(parts[3:]))):
+                try:
+                    key = conn.get_bucket(bucket_name).get_key(key_name)
+                except BotoClientError:
+                    continue
+                if key is not None:
+                    return key.etag
+            return None
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        return urllib2.urlopen(request).info().getheader('ETag')
+    except Exception:
+        return None
+
+
+class SystemPrepAgent(object):
+    """
+    Applies SystemPrep content on request from a long-running process. The
+    interpreter, imported modules, S3 connection, parsed script plans and the
+    downloaded content scripts stay warm between requests, so a repeated
+    update only pays for what changed.
+    """
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self.lock = threading.Lock()
+        self.system = platform.system()
+        self.systemparams = get_system_params(self.system)
+        self.plans = {}
+        self.artifacts = {}
+        self.runs = 0
+        self.lastresponse = None
+
+    def get_plan(self, params):
+        """
+    Returns the parsed `get_scripts_to_execute` plan for `params`, with its
+    urls rewritten to the selected mirror if `mirrors` is set, reusing the
+    plan from an earlier request with the same parameters.
+        """
+        plankey = json.dumps(params, sort_keys=True)
+        if plankey not in self.plans:
+            plan = get_scripts_to_execute(
+                self.system, self.systemparams['workingdir'], **params)
+            mirror = params.get('mirrors') and select_mirror(
+                params['mirrors'], plan[0]['ScriptSource'],
+                'true' == params.get('sourceiss3bucket', 'false').lower(),
+                params.get('awsregion'))
+            if mirror:
+                plan = apply_mirror(plan, mirror)
+            self.plans[plankey] = plan
+        return self.plans[plankey]
+
+    def fetch(self, url, fullfilepath, sourceiss3bucket=None,
+              verifyartifacts=None):
+        """
+    Downloads a content script unless the copy fetched by an earlier request
+    still matches the remote ETag. Has the signature of `fetch_script`.
+        """
+        etag = get_remote_etag(url, sourceiss3bucket)
+        cached = self.artifacts.get(url)
+        if etag and cached and etag == cached['etag'] and \
+                os.path.isfile(fullfilepath):
+            print('Content script is unchanged, using the cached copy -- {0}'
+                  .format(url))
+            return cached['digest']
+        digest = fetch_script(url, fullfilepath, sourceiss3bucket,
+                              verifyartifacts)
+        self.artifacts[url] = {'etag': etag, 'digest': digest}
+        return digest
+
+    def handle_request(self, request):
+        """
+    Handles a request dictionary and returns a response dictionary.
+    A request has the keys 'action' and, optionally, 'params'.
+    'action' is one of:
+        'apply':  run the content scripts with `params` merged over the
+                  parameters the agent was started with
+        'update': like 'apply', but defaults `saltstates` to 'None' and
+                  `saltcontentdelta` to 'true', the same as
+                  `Utils/systemprep-updatecontent.sh`
+        'status': report whether a run is in progress and the last result
+    The agent never reboots the system; the response lists the reasons a
+    reboot is required, if any, and the resources the request consumed.
+    A request with the param `governed` set to 'true' lowers the priority of
+    the agent, which keeps the lower priority for later requests. The cgroup
+    that caps its CPU time is removed when the request finishes.
+        """
+        if not isinstance(request, dict) or \
+                not isinstance(request.get('params', {}), dict):
+            return {'status': 'error',
+                    'message': 'Invalid request: expected a JSON object, '
+                               'with `params` as an object'}
+        action = str(request.get('action', '')).lower()
+        if 'status' == action:
+            return {'status': 'ok', 'busy': self.lock.locked(),
+                    'runs': self.runs, 'last': self.lastresponse}
+        if action not in ('apply', 'update'):
+            return {'status': 'error',
+                    'message': 'Unknown action: {0}'.format(action)}
+
+        params = dict(self.defaults)
+        if 'update' == action:
+            params.update({'saltstates': 'None', 'saltcontentdelta': 'true'})
+        try:
+            params.update((str(k).lower(), str(v)) for k, v in
+                          request.get('params', {}).items())
+        except (ValueError, TypeError) as exc:
+            return {'status': 'error',
+                    'message': 'Invalid request params: {0}'.format(exc)}
+        governed = 'true' == params.get('governed', 'false').lower()
+        if governed:
+            for key, value in _governed_defaults.items():
+                params.setdefault(key, value)
+        sourceiss3bucket = 'true' == params.get('sourceiss3bucket', 'false').lower()
+        verifyartifacts = 'true' == params.get('verifyartifacts', 'false').lower()
+
+        with self.lock:
+            start = time.time()
+            startusage = get_resource_usage()
+            print('+' * 80)
+            print('Agent received request -- {0}'.format(action))
+            try:
+                if governed:
+                    govern_process(params['governedcpu'],
+                                   params['governednice'])
+                configure_downloads(params.get('downloadratelimit'),
+                                    params.get('downloadretries'),
+                                    params.get('artifactdir'))
+                configure_peers(params.get('artifactstore'),
+                                params.get('artifactpeers'))
+                wait_for_download_slot(params.get('downloadjitter'))
+                plan = self.get_plan(params)
+                mirror = _selected_mirrors.get(params.get('mirrors'))
+                if mirror and not is_s3_mirror(mirror):
+                    sourceiss3bucket = False
+                execute_scripts(plan, self.systemparams,
+                                sourceiss3bucket, verifyartifacts,
+                                fetch=self.fetch,
+                                run=run_content_script_in_process)
+            except SystemError as exc:
+                response = {'status': 'error', 'message': str(exc)}
+            except (ValueError, TypeError, KeyError) as exc:
+                # e.g. a param that is not a number where one is expected
+                response = {'status': 'error',
+                            'message': 'Invalid request params: {0}'
+                                       .format(exc)}
+            else:
+                rebootreasons = get_reboot_reasons(
+                    self.system, self.systemparams['rebootflag'])
+                if not rebootreasons:
+                    write_ready_file(self.systemparams['readyfile'])
+                response = {'status': 'ok', 'rebootreasons': rebootreasons}
+            if governed:
+                leave_governor_cgroup()
+            response['seconds'] = round(print_phase(
+                'agent {0}'.format(action), start) - start, 3)
+            usage = get_resource_usage_since(startusage)
+            print_resource_usage('agent {0}'.format(action), usage)
+            response['resources'] = usage
+            print('-' * 80)
+            sys.stdout.flush()
+            self.runs += 1
+            self.lastresponse = response
+        return response
+
+
+class _AgentRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Reads one JSON request per line from the agent socket and writes one
+    JSON response per line.
+    """
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                response = self.server.agent.handle_request(json.loads(line))
+            except ValueError as exc:
+                response = {'status': 'error',
+                            'message': 'Invalid request: {0}'.format(exc)}
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+def run_agent(agentsocket='/var/run/systemprep-agent.sock', **kwargs):
+    """
+Runs the master script as a resident agent, serving requests on the Unix
+socket `agentsocket` until interrupted. Requests are handled one at a time.
+See `SystemPrepAgent.handle_request` for the request format.
+    :param agentsocket: str, path of the Unix socket to listen on
+    :param kwargs: dict, default parameters for every request
+    """
+    if os.path.exists(agentsocket):
+        os.remove(agentsocket)
+    server = SocketServer.ThreadingUnixStreamServer(agentsocket,
+                                                    _AgentRequestHandler)
+    os.chmod(agentsocket, 0o600)
+    server.daemon_threads = True
+    server.agent = SystemPrepAgent(**kwargs)
+    print('SystemPrep agent listening on socket -- {0}'.format(agentsocket))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(agentsocket)
+        cleanup(server.agent.systemparams['workingdir'])
+
+
 def main(noreboot = 'false', **kwargs):
     """
     Master script that calls content scripts to be deployed when provisioning systems
+    Every parameter is relayed to the content scripts. See README.md.
+    :param noreboot: str, set to 'true' to never reboot the system
+    :param downloadratelimit: str, maximum download rate in bytes per second.
+                              default is no limit, or 2 MiB when governed
+    :param downloadjitter: str, width in seconds of the window over which
+                           instances launched together spread their first
+                           request. default is 0
+    :param downloadretries: str, number of retries of a throttled request.
+                            default is 5
+    :param mirrors: str, comma-separated base urls of mirrors of the artifact
+                    buckets. the fastest one is used
+    :param targetroot: str, mounted root filesystem to provision instead of
+                       the running system. it is never rebooted
+    :param artifactdir: str, directory of artifacts shared by concurrent runs
+    :param cleanrun: str, set to 'true' to ignore the checkpoint journals
+    :param artifactstore: str, directory in which to keep verified artifacts
+    :param artifactpeers: str, comma-separated `host:port` peers to fetch
+                          verified artifacts from, or 'asg'
+    :param artifactpeerport: str, port of the peers when `artifactpeers` is
+                             'asg'. default is 8771
+    :param governed: str, set to 'true' to run with a low CPU and I/O
+                     priority, in a cgroup that caps the CPU time
+    :param governedcpu: str, percent of one core when governed. default is 50
+    :param governednice: str, niceness when governed. default is 10
+    :param maxthreads: str, threads per decompressor. default is 1 when
+                       governed, otherwise one per core
+    :param kwargs: dict, the parameters above, and any other parameter of the
+                   content scripts
     """
 
     # NOTE: Using __file__ may freeze if trying to build an executable, e.g. via py2exe.
@@ -274,9 +1837,17 @@ def main(noreboot = 'false', **kwargs):
     else:
         scriptname = os.path.abspath(sys.argv[0])
 
+    masterstart = time.time()
+
     # Check special parameter types
     noreboot = 'true' == noreboot.lower()
     sourceiss3bucket = 'true' == kwargs.get('sourceiss3bucket', 'false').lower()
+    verifyartifacts = 'true' == kwargs.get('verifyartifacts', 'false').lower()
+    cleanrun = 'true' == kwargs.get('cleanrun', 'false').lower()
+    governed = 'true' == kwargs.get('governed', 'false').lower()
+    if governed:
+        for key, value in _governed_defaults.items():
+            kwargs.setdefault(key, value)
 
     print('+' * 80)
     print('Entering script -- {0}'.format(scriptname))
@@ -285,39 +1856,78 @@ def main(noreboot = 'false', **kwargs):
     for key, value in kwargs.items():
         print('    {0} = {1}'.format(key, value))
 
+    if governed:
+        govern_process(kwargs['governedcpu'], kwargs['governednice'])
+        atexit.register(leave_governor_cgroup)
+
+    configure_downloads(kwargs.get('downloadratelimit'),
+                        kwargs.get('downloadretries'),
+                        kwargs.get('artifactdir'))
+    # Wait before any request, so the peer discovery and the mirror probes of
+    # a fleet booting together are spread across the window too
+    phasestart = time.time()
+    if wait_for_download_slot(kwargs.get('downloadjitter')):
+        print_phase('download-jitter', phasestart)
+
+    # Resolve discovered peers once, so the content scripts query the same list
+    if 'asg' == kwargs.get('artifactpeers', '').lower():
+        kwargs['artifactpeers'] = discover_artifact_peers(
+            kwargs.get('artifactpeerport', '8771'), kwargs.get('awsregion'))
+
     system = platform.system()
     systemparams = get_system_params(system)
     scriptstoexecute = get_scripts_to_execute(system, systemparams['workingdir'], **kwargs)
+    if kwargs.get('mirrors'):
+        phasestart = time.time()
+        mirror = select_mirror(kwargs['mirrors'],
+                               scriptstoexecute[0]['ScriptSource'],
+                               sourceiss3bucket, kwargs.get('awsregion'))
+        if mirror:
+            scriptstoexecute = apply_mirror(scriptstoexecute, mirror)
+            sourceiss3bucket = sourceiss3bucket and is_s3_mirror(mirror)
+        print_phase('mirror-selection', phasestart)
 
-    #Loop through each 'script' in scriptstoexecute
-    for script in scriptstoexecute:
-        url = script['ScriptSource']
-        filename = url.split('/')[-1]
-        fullfilepath = systemparams['workingdir'] + systemparams['pathseparator'] + filename
-        #Download each script, script['ScriptSource']
-        download_file(url, fullfilepath, sourceiss3bucket)
-        #Execute each script, passing it the parameters in script['Parameters']
-        #TODO: figure out if there's a better way to call and execute the script
-        print('Running script -- ' + script['ScriptSource'])
-        print('Sending parameters --')
-        for key, value in script['Parameters'].items():
-            print('    {0} = {1}'.format(key, value))
-        paramstring = ' '.join("%s='%s'" % (key, val) for (key, val) in script['Parameters'].iteritems())
-        fullcommand = 'python {0} {1}'.format(fullfilepath, paramstring)
-        result = os.system(fullcommand)
-        if result is not 0:
-            message = 'Encountered an unrecoverable error executing a ' \
-                      'content script. Exiting with failure.\n' \
-                      'Command executed: {0}' \
-                      .format(fullcommand)
-            raise SystemError(message)
+    configure_peers(kwargs.get('artifactstore'), kwargs.get('artifactpeers'))
+
+    journal = CheckpointJournal(get_target_path(
+        kwargs.get('targetroot'), '/var/lib/systemprep/master.journal'),
+        cleanrun)
+    execute_scripts(scriptstoexecute, systemparams, sourceiss3bucket,
+                    verifyartifacts, journal=journal)
+    journal.clear()
 
     cleanup(systemparams['workingdir'])
+    print_phase('systemprep-linuxmaster', masterstart)
+    print_resource_usage('systemprep-linuxmaster', get_resource_usage())
+
+    if kwargs.get('targetroot') and '/' != kwargs['targetroot']:
+        print('Provisioned the target root {0}. The running system will not '
+              'be rebooted.'.format(kwargs['targetroot']))
+        print('{0} complete!'.format(scriptname))
+        print('-' * 80)
+        return
 
-    if noreboot:
-        print('Detected `noreboot` switch. System will not be rebooted.')
+    # Record the time from boot to the end of provisioning
+    try:
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        print_phase('boot-to-ready', time.time() - uptime)
+    except (IOError, ValueError):
+        pass
+
+    rebootreasons = get_reboot_reasons(system, systemparams['rebootflag'])
+    if not rebootreasons:
+        print('No reboot is required. System will not be rebooted.')
+        write_ready_file(systemparams['readyfile'])
+    elif noreboot:
+        print('Detected `noreboot` switch. System will not be rebooted, '
+              'though a reboot is required --')
+        for reason in rebootreasons:
+            print('    {0}'.format(reason))
     else:
-        print('Reboot scheduled. System will reboot after the script exits.')
+        print('Reboot scheduled. System will reboot after the script exits --')
+        for reason in rebootreasons:
+            print('    {0}'.format(reason))
         os.system(systemparams['restart'])
 
     print('{0} complete!'.format(scriptname))
@@ -339,4 +1949,7 @@ if "__main__" == __name__:
     # definition.  The rest are packed back into kwargs.
     # TODO: This is not necessary and consumes a minor overhead. I would just pass along the dictionary.
     # However, since we will be moving to using argparse, this will become obsolete.
-    main(**kwargs)
+    if 'true' == kwargs.pop('agent', 'false').lower():
+        run_agent(**kwargs)
+    else:
+        main(**kwargs)
@@ -71,6 +71,15 @@ SALT_RAET_DEPS=(
     "python-simplejson"
 )
 
+# Packages installed by the `bundle` method of SystemPrep-LinuxSaltInstall.py.
+# These are the salt-minion packages from SALT_DEPS; the bundle holds them
+# plus every dependency missing from this (clean) builder image.
+BUNDLE_PKGS=(
+    "policycoreutils-python"
+    "selinux-policy-targeted"
+    "salt-minion"
+)
+
 GPGKEY_CENTOS="RPM-GPG-KEY-CentOS-[0-9]"
 GPGKEY_AMZN="RPM-GPG-KEY-amazon-ga"
 GPGKEY_RHEL="RPM-GPG-KEY-redhat-release"
@@ -118,10 +127,12 @@ case "${RELEASE}" in
 "Amazon"*)
     OSVER="latest"  # $(echo ${RELEASE} | grep -o '[0-9]*\.[0-9]*') #e.g. 'OSVER=2014.7'
     DIST="amzn"
+    BUNDLE_DIST="amazon"
     ELVER="6"
     ;;
 "CentOS"*"6."*)
     DIST="centos"
+    BUNDLE_DIST="centos"
     OSVER=$(echo ${RELEASE} | grep -o '[0-9]*\.[0-9]*' | cut -d'.' -f1) #e.g. 'OSVER=6'
     ELVER="6"
     service ntpd start 2>&1 > /dev/null && echo "Started ntpd..." || echo "Failed to start ntpd..."
@@ -130,17 +141,20 @@ case "${RELEASE}" in
     ;;
 "CentOS"*"7."*)
     DIST="centos"
+    BUNDLE_DIST="centos"
     OSVER=$(echo ${RELEASE} | grep -o '[0-9]*\.[0-9]*' | cut -d'.' -f1) #e.g. 'OSVER=7'
     ELVER="7"
     ;;
 "Red Hat"*"6."*)
     DIST="rhel"
+    BUNDLE_DIST="redhat"
     OSVER="$(echo ${RELEASE} | grep -o '[0-9]*\.[0-9]*' | cut -d'.' -f1)Server" #e.g. 'OSVER=6Server'
     ELVER="6"
     SALT_DEPS+=( ${SALT_RAET_DEPS[@]} )
     ;;
 "Red Hat"*"7."*)
     DIST="rhel"
+    BUNDLE_DIST="redhat"
     OSVER="$(echo ${RELEASE} | grep -o '[0-9]*\.[0-9]*' | cut -d'.' -f1)Server" #e.g. 'OSVER=7Server'
     ELVER="7"
     ;;
@@ -163,6 +177,9 @@ SALTREPO=$(echo ~/repo/saltstack/salt/el${ELVER}/${ARCH})
 SALTREPOPACKAGES="${SALTREPO}/packages"
 SALTREPOBUCKET="${BUCKETNAME}/linux/saltstack/salt/el${ELVER}/"
 GPGKEY_SALTREPO="https://repo.saltstack.com/yum/redhat/${ELVER}/x86_64/latest/SALTSTACK-GPG-KEY.pub"
+BUNDLE_NAME="salt-minion-${BUNDLE_DIST}-el${ELVER}-${ARCH}"
+BUNDLE=$(echo ~/repo/bundles/${BUNDLE_NAME})
+BUNDLEBUCKET="${BUCKETNAME}/linux/bundles/"
 
 # Define SaltStack repo with the latest salt packages and dependencies that
 # are not in the OS or epel repos
@@ -190,6 +207,14 @@ yum clean all
 mkdir -p "${OSPACKAGES}" "${STAGING}" "${SALTREPOPACKAGES}"
 yumdownloader --resolve --destdir "${STAGING}" --archlist="${ARCH}" ${SALT_DEPS[@]}
 
+# Build the salt-minion bundle: the resolved rpms, plus a manifest the
+# installer checks against the system before installing
+mkdir -p "${BUNDLE}"
+yumdownloader --resolve --destdir "${BUNDLE}" --archlist="${ARCH}" ${BUNDLE_PKGS[@]}
+printf "dist=%s\nepel_version=%s\narch=%s\n" "${BUNDLE_DIST}" "${ELVER}" "${ARCH}" > "${BUNDLE}/bundle.manifest"
+tar -cf "${BUNDLE}.tar" -C "${BUNDLE}" .
+( cd $(dirname "${BUNDLE}") && sha256sum "${BUNDLE_NAME}.tar" > "${BUNDLE_NAME}.tar.sha256" )
+
 SALT_OS_DEPS=()
 SALT_REPO_DEPS=()
 
@@ -237,6 +262,7 @@ hash s3cmd 2> /dev/null || PATH="${PATH}:/usr/local/bin"  # Make sure s3cmd is i
 # Sync the packages to S3
 s3cmd sync ${OSREPO} s3://${OSBUCKET}
 s3cmd sync ${SALTREPO} s3://${SALTREPOBUCKET}
+s3cmd put "${BUNDLE}.tar" "${BUNDLE}.tar.sha256" s3://${BUNDLEBUCKET}
 
 # Restore prior rsyslog config
 if [[ -n "${RSYSLOGFLAG}" ]]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import BaseHTTPServer
+import os
+import re
+import shutil
+import SocketServer
+import sys
+
+
+_digest_path = re.compile(r'^/sha256/(?P<digest>[0-9a-f]{64})$')
+
+
+class _ArtifactRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+Serves `GET /sha256/<digest>` and `HEAD /sha256/<digest>` from the artifact
+store of the server. Any other path is a 404. Only names matching a SHA-256
+digest are served, so no path outside the store can be requested.
+    """
+    def send_artifact(self, body):
+        match = _digest_path.match(self.path.split('?', 1)[0])
+        path = match and os.sep.join((self.server.artifactstore, 'sha256',
+                                      match.group('digest')))
+        if not path or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length',
+                             str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            if body:
+                shutil.copyfileobj(f, self.wfile)
+
+    def do_GET(self):
+        self.send_artifact(True)
+
+    def do_HEAD(self):
+        self.send_artifact(False)
+
+
+class _ArtifactServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(artifactstore='/var/cache/systemprep/artifacts',
+         address='',
+         port='8771',
+         **kwargs):
+    """
+    Serves the artifact store of a provisioned system to its peers, so new
+    instances in the same autoscale group can fetch archives from it instead
+    of their origin. The store is populated by the master and content
+    scripts when they run with `artifactstore` and `verifyartifacts`, and
+    each artifact is found at `http://<host>:<port>/sha256/<digest>`.
+    Peers verify every artifact they receive against its digest.
+    Several servers can run on one system, each with its own store and port,
+    to stand in for a group of peers.
+    :param artifactstore: str, directory of the artifact store
+    :param address: str, address to listen on. default is all addresses
+    :param port: str, port to listen on. default is 8771
+    :param kwargs: dict, catch-all for other params
+    :raise SystemError: error raised whenever an issue is encountered
+    """
+    scriptname = __file__
+
+    print('+' * 80)
+    print('Entering script -- ' + scriptname)
+    print('Printing parameters...')
+    print('    artifactstore = {0}'.format(artifactstore))
+    print('    address = {0}'.format(address))
+    print('    port = {0}'.format(port))
+    for key, value in kwargs.items():
+        print('    {0} = {1}'.format(key, value))
+
+    if not os.path.isdir(artifactstore):
+        raise SystemError('`artifactstore` must be the path to a directory.')
+
+    try:
+        server = _ArtifactServer((address, int(port)),
+                                 _ArtifactRequestHandler)
+    except Exception as exc:
+        raise SystemError('Could not listen on {0}:{1}.\n'
+                          'Exception: {2}'.format(address, port, exc))
+    server.artifactstore = os.path.abspath(artifactstore)
+    print('Serving artifacts -- \n'
+          '    artifactstore = {0}\n'
+          '    address       = {1}:{2}'
+          .format(server.artifactstore, address or '*', port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    print(str(scriptname) + ' complete!')
+    print('-' * 80)
+
+
+if __name__ == "__main__":
+    # convert command line parameters of the form `param=value` to a dict
+    kwargs = dict(x.split('=', 1) for x in sys.argv[1:])
+    # Convert parameter keys to lowercase, parameter values are unmodified
+    kwargs = dict((k.lower(), v) for k, v in kwargs.items())
+
+    main(**kwargs)
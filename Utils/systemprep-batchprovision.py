@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+import json
+import os
+import Queue
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+
+_bind_mounts = ('/dev', '/proc', '/sys')
+_phase_pattern = re.compile(r'Completed phase -- name = (?P<name>.+?), '
+                            r'start = (?P<start>[\d.]+), '
+                            r'seconds = (?P<seconds>[\d.]+)')
+
+
+def get_master_script(mastersource, workingdir):
+    """
+Returns the path of the master script, downloading it to `workingdir` if
+`mastersource` is a url.
+    :rtype : str
+    :param mastersource: str, path or url of `systemprep-linuxmaster.py`
+    :param workingdir: str, directory in which to save a downloaded script
+    """
+    if os.path.isfile(mastersource):
+        return os.path.abspath(mastersource)
+    masterscript = os.sep.join((workingdir, mastersource.split('/')[-1]))
+    try:
+        response = urllib2.urlopen(mastersource)
+        with open(masterscript, 'wb') as outfile:
+            shutil.copyfileobj(response, outfile)
+    except Exception as exc:
+        raise SystemError('Unable to download the master script.\n'
+                          'url = {0}\n'
+                          'Exception: {1}'.format(mastersource, exc))
+    return masterscript
+
+
+def get_log_dirs(targetroots, logdir):
+    """
+Returns a dictionary mapping each target root to its own log directory under
+`logdir`, named for the last component of the root's path.
+    :rtype : dict
+    :param targetroots: list, paths of the target roots
+    :param logdir: str, directory holding the per-root log directories
+    """
+    logdirs = {}
+    for targetroot in targetroots:
+        name = os.path.basename(targetroot.rstrip(os.sep))
+        rootlogdir = os.sep.join((logdir, name))
+        if not name or rootlogdir in logdirs.values():
+            raise SystemError('Target roots must have distinct directory '
+                              'names: {0}'.format(targetroot))
+        logdirs[targetroot] = rootlogdir
+    return logdirs
+
+
+def mount_target(targetroot):
+    """
+Bind-mounts /dev, /proc and /sys of the running system into `targetroot`, so
+commands run in a chroot of the target work. Returns the list of mounts.
+    :rtype : list
+    :param targetroot: str, path of the target root
+    """
+    mounts = []
+    try:
+        for source in _bind_mounts:
+            mountpoint = os.sep.join((targetroot.rstrip(os.sep),
+                                      source.lstrip(os.sep)))
+            if not os.path.isdir(mountpoint):
+                os.makedirs(mountpoint)
+            subprocess.check_call(['mount', '--bind', source, mountpoint])
+            mounts.append(mountpoint)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        unmount_target(mounts)
+        raise SystemError('Could not mount {0} in the target root {1}.\n'
+                          'Exception: {2}'.format(source, targetroot, exc))
+    return mounts
+
+
+def unmount_target(mounts):
+    """
+Unmounts the mounts returned by `mount_target`, in reverse order.
+    :rtype : bool
+    :param mounts: list, paths of the mounts
+    """
+    for mountpoint in reversed(mounts):
+        subprocess.call(['umount', mountpoint])
+    return True
+
+
+def provision_root(masterscript, targetroot, rootlogdir, params):
+    """
+Runs the master script against `targetroot`, writing its output to a log in
+`rootlogdir`. The salt results log is copied from the target root to the
+same directory, so `Utils/systemprep-timeline.py` can read the directory as
+one run. Returns a dictionary of the run's result and timings.
+    :rtype : dict
+    :param masterscript: str, path of the master script
+    :param targetroot: str, path of the target root
+    :param rootlogdir: str, directory for the logs of this root
+    :param params: dict, parameters to pass to the master script
+    """
+    if not os.path.isdir(rootlogdir):
+        os.makedirs(rootlogdir)
+    logfile = os.sep.join((rootlogdir, 'systemprep-{0}.log'.format(
+        time.strftime('%Y%m%d_%H%M_%S', time.gmtime()))))
+    command = [sys.executable, masterscript] + \
+        ['{0}={1}'.format(k, v) for k, v in sorted(params.items())] + \
+        ['targetroot={0}'.format(targetroot)]
+
+    start = time.time()
+    with open(logfile, 'w') as log:
+        try:
+            mounts = mount_target(targetroot)
+        except SystemError as exc:
+            log.write('{0}\n'.format(exc))
+            returncode = None
+        else:
+            try:
+                returncode = subprocess.call(command, stdout=log,
+                                             stderr=subprocess.STDOUT)
+            finally:
+                unmount_target(mounts)
+    seconds = time.time() - start
+
+    resultslog = params.get('salt_results_log',
+                            '/var/log/saltcall.results.log')
+    resultslog = os.sep.join((targetroot.rstrip(os.sep),
+                              resultslog.lstrip(os.sep)))
+    if os.path.isfile(resultslog):
+        shutil.copy(resultslog, rootlogdir)
+
+    with open(logfile, 'r') as log:
+        phases = [(m.group('name'), float(m.group('seconds')))
+                  for m in _phase_pattern.finditer(log.read())]
+    return {
+        'targetroot': targetroot,
+        'log': logfile,
+        'returncode': returncode,
+        'start': round(start, 3),
+        'seconds': round(seconds, 3),
+        'phases': phases,
+    }
+
+
+def provision_roots(masterscript, logdirs, params, processes):
+    """
+Provisions every target root in `logdirs`, running up to `processes` master
+scripts at once. Returns the results of `provision_root`, in the order the
+roots finished.
+    :rtype : list
+    :param masterscript: str, path of the master script
+    :param logdirs: dict, maps each target root to its log directory
+    :param params: dict, parameters to pass to each master script
+    :param processes: int, number of roots to provision concurrently
+    """
+    pending = Queue.Queue()
+    for targetroot in sorted(logdirs):
+        pending.put(targetroot)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                targetroot = pending.get_nowait()
+            except Queue.Empty:
+                return
+            result = provision_root(masterscript, targetroot,
+                                    logdirs[targetroot], params)
+            with lock:
+                results.append(result)
+                print('Provisioned target root -- \n'
+                      '    targetroot = {0}\n'
+                      '    returncode = {1}\n'
+                      '    seconds    = {2:.3f}\n'
+                      '    log        = {3}'
+                      .format(targetroot, result['returncode'],
+                              result['seconds'], result['log']))
+                sys.stdout.flush()
+
+    workers = [threading.Thread(target=worker) for _ in range(processes)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results
+
+
+def main(targetroots=None,
+         mastersource=None,
+         artifactdir=None,
+         logdir='/var/log/systemprep-batch',
+         processes=None,
+         **kwargs):
+    """
+    Provisions several mounted root filesystems at once, e.g. chroots or
+    mounted disk images in a golden-image pipeline, by running
+    `systemprep-linuxmaster.py` with `targetroot` set for each of them.
+    The runs share one artifact directory, so each content script, archive
+    and repo file is downloaded once for the whole batch. /dev, /proc and
+    /sys are bind-mounted into each root while it is provisioned.
+    Each root gets a log directory under `logdir`, and the result and phase
+    timings of every root are written to `<logdir>/timings.json`. The log
+    directory can also be passed to `Utils/systemprep-timeline.py`.
+    :param targetroots: str, comma-separated paths of the target roots. the
+                        last component of each path must be unique
+    :param mastersource: str, path or url of `systemprep-linuxmaster.py`
+    :param artifactdir: str, directory in which to share downloaded
+                        artifacts. default is a temporary directory that is
+                        removed when the batch completes
+    :param logdir: str, directory for the per-root logs
+    :param processes: str, number of roots to provision concurrently.
+                      default is all of them
+    :param kwargs: dict, parameters passed to every master script
+    :raise SystemError: error raised whenever an issue is encountered
+    """
+    scriptname = __file__
+
+    print('+' * 80)
+    print('Entering script -- ' + scriptname)
+    print('Printing parameters...')
+    print('    targetroots = {0}'.format(targetroots))
+    print('    mastersource = {0}'.format(mastersource))
+    print('    artifactdir = {0}'.format(artifactdir))
+    print('    logdir = {0}'.format(logdir))
+    print('    processes = {0}'.format(processes))
+    for key, value in kwargs.items():
+        print('    {0} = {1}'.format(key, value))
+
+    targetroots = [os.path.abspath(x) for x in
+                   filter(None, (targetroots or '').split(','))]
+    if not targetroots:
+        raise SystemError('`targetroots` is a required parameter.')
+    for targetroot in targetroots:
+        if not os.path.isdir(targetroot):
+            raise SystemError('Target root is not a directory: {0}'
+                              .format(targetroot))
+    if not mastersource:
+        raise SystemError('`mastersource` is a required parameter.')
+    processes = int(processes or len(targetroots))
+
+    logdirs = get_log_dirs(targetroots, logdir)
+    workingdir = tempfile.mkdtemp(prefix='systemprep-batch-')
+    try:
+        params = dict(kwargs)
+        params['artifactdir'] = artifactdir or \
+            os.sep.join((workingdir, 'artifacts'))
+        masterscript = get_master_script(mastersource, workingdir)
+
+        start = time.time()
+        results = provision_roots(masterscript, logdirs, params, processes)
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(workingdir)
+
+    timings = os.sep.join((logdir, 'timings.json'))
+    with open(timings, 'w') as f:
+        json.dump({'seconds': round(seconds, 3), 'roots': results}, f,
+                  indent=2, sort_keys=True)
+
+    print('Provisioned {0} target roots in {1:.3f} seconds. Timings are in '
+          '{2}'.format(len(results), seconds, timings))
+    failed = sorted(r['targetroot'] for r in results if r['returncode'] != 0)
+    if failed:
+        raise SystemError('Provisioning failed for the target roots: {0}'
+                          .format(', '.join(failed)))
+    print(str(scriptname) + ' complete!')
+    print('-' * 80)
+
+
+if __name__ == "__main__":
+    # convert command line parameters of the form `param=value` to a dict
+    kwargs = dict(x.split('=', 1) for x in sys.argv[1:])
+    # Convert parameter keys to lowercase, parameter values are unmodified
+    kwargs = dict((k.lower(), v) for k, v in kwargs.items())
+
+    main(**kwargs)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import difflib
+import os
+import re
+import sys
+
+
+_begin_pattern = re.compile(r'^# --- begin shared block: (?P<name>.+) ---$')
+_end_marker = '# --- end shared block: {0} ---'
+
+
+def get_shared_blocks(filepath):
+    """
+Returns a dictionary mapping the name of every shared block in the file at
+`filepath` to the list of lines between its begin and end markers.
+    :rtype : dict
+    :param filepath: str, path of a python script
+    :raise SystemError: error raised if a block has no end marker
+    """
+    with open(filepath, 'r') as f:
+        lines = f.read().splitlines(True)
+    blocks = {}
+    for index, line in enumerate(lines):
+        match = _begin_pattern.match(line.rstrip('\n'))
+        if not match:
+            continue
+        name = match.group('name')
+        try:
+            stop = lines.index(_end_marker.format(name) + '\n', index)
+        except ValueError:
+            raise SystemError('Shared block `{0}` has no end marker in {1}.'
+                              .format(name, filepath))
+        blocks[name] = lines[index + 1:stop]
+    return blocks
+
+
+def main(repo=None, **kwargs):
+    """
+    Checks that every copy of each shared block in the scripts of the repo is
+    identical. The master and content scripts are each downloaded and run on
+    their own, so helpers they have in common, e.g. the download stack, are
+    copied into each script between `# --- begin shared block: <name> ---`
+    and `# --- end shared block: <name> ---` markers. Prints a diff of every
+    copy that differs from the first one found.
+    :param repo: str, root of the repo. default is the parent directory of
+                 this script
+    :param kwargs: dict, catch-all for other params
+    :raise SystemError: error raised if any copy differs
+    """
+    scriptname = __file__
+
+    print('+' * 80)
+    print('Entering script -- ' + scriptname)
+    print('Printing parameters...')
+    print('    repo = {0}'.format(repo))
+    for key, value in kwargs.items():
+        print('    {0} = {1}'.format(key, value))
+
+    repo = repo or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    copies = {}
+    for dirpath, dirnames, filenames in os.walk(repo):
+        dirnames[:] = sorted(x for x in dirnames if not x.startswith('.'))
+        for filename in sorted(filenames):
+            if not filename.endswith('.py'):
+                continue
+            path = os.path.join(dirpath, filename)
+            for name, block in get_shared_blocks(path).items():
+                copies.setdefault(name, []).append(
+                    (os.path.relpath(path, repo), block))
+
+    mismatches = []
+    for name in sorted(copies):
+        firstpath, first = copies[name][0]
+        print('Shared block -- name = {0}, copies = {1}'
+              .format(name, ', '.join(x[0] for x in copies[name])))
+        for path, block in copies[name][1:]:
+            if block != first:
+                mismatches.append(name)
+                sys.stdout.writelines(difflib.unified_diff(first, block,
+                                                           firstpath, path))
+    if mismatches:
+        raise SystemError('Copies of shared blocks differ: {0}'
+                          .format(', '.join(sorted(set(mismatches)))))
+
+    print(str(scriptname) + ' complete!')
+    print('-' * 80)
+
+
+if __name__ == "__main__":
+    # convert command line parameters of the form `param=value` to a dict
+    kwargs = dict(x.split('=', 1) for x in sys.argv[1:])
+    # Convert parameter keys to lowercase, parameter values are unmodified
+    kwargs = dict((k.lower(), v) for k, v in kwargs.items())
+
+    main(**kwargs)
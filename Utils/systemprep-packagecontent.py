@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+import bz2
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import zipfile
+import zlib
+
+from distutils.spawn import find_executable
+
+
+_archive_formats = (
+    ('.zip', 'zip'),
+    ('.tar', 'tar'),
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.bz2', 'bz2'),
+    ('.tbz', 'bz2'),
+    ('.tar.xz', 'xz'),
+    ('.txz', 'xz'),
+)
+# Uncompressed bytes per compressed stream. 900 kB matches the bzip2 block
+# size, so lbzip2 and pbzip2 can hand one stream to each core.
+_default_block_sizes = {
+    'gz': 8 * 1024 * 1024,
+    'bz2': 900 * 1000,
+    'xz': 8 * 1024 * 1024,
+}
+
+# Written at the root of the archive. Lists the digests of the custom module
+# files, under the `_modules`, `_states`, `_grains`, etc. directories, which
+# `SystemPrep-LinuxSaltInstall.py` compares to the minion's extmods cache
+_sync_manifest = '.systemprep-sync.json'
+# Files salt's sync copies to the extmods cache; it ignores any other file
+_sync_file_pattern = re.compile(r'\.(pyx?|so|zip)$')
+
+
+def get_archive_format(archive):
+    """
+Returns the format of `archive` based on its file name. One of 'zip', 'tar',
+'gz', 'bz2' or 'xz'.
+    :rtype : str
+    :param archive: str, path to the archive to create
+    :raise ValueError: error raised if the file name is not recognized
+    """
+    for suffix, archiveformat in _archive_formats:
+        if archive.lower().endswith(suffix):
+            return archiveformat
+    raise ValueError('Could not determine the archive format of `"{0}`". '
+                     'Must end in one of: {1}'
+                     .format(archive,
+                             ', '.join(s for s, f in _archive_formats)))
+
+
+def get_members(source, arcroot=None):
+    """
+Returns a sorted list of (path, arcname) tuples for every file and directory
+under `source`. Directories sort before their contents, so extraction never
+has to create parent directories out of order.
+    :rtype : list
+    :param source: str, path to the directory to package
+    :param arcroot: str, optional directory name to nest the members under
+    """
+    members = []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            arcname = os.path.relpath(path, source)
+            if arcroot:
+                arcname = '/'.join((arcroot, arcname))
+            members.append((path, arcname.replace(os.sep, '/')))
+    return members
+
+
+def _is_custom_module(arcname, arcroot=None):
+    if arcroot:
+        arcname = arcname[len(arcroot) + 1:]
+    return any(x.startswith('_') for x in arcname.split('/')[:-1])
+
+
+def _get_file_digest(filepath):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def write_sync_manifest(members, arcroot, manifest):
+    """
+Writes the sync manifest of `members` to `manifest`, a JSON document that
+maps the path of every file salt syncs from a custom module directory,
+relative to the archive root, to its SHA-256 digest. Returns the
+(path, arcname) tuple of the manifest to add to the archive, or None if there
+are no custom modules.
+    :rtype : tuple
+    :param members: list, (path, arcname) tuples as returned by `get_members`
+    :param arcroot: str, directory name the members are nested under
+    :param manifest: str, path in which to write the manifest
+    """
+    files = {}
+    for path, arcname in members:
+        if os.path.isfile(path) and _is_custom_module(arcname, arcroot) and \
+                _sync_file_pattern.search(arcname):
+            relpath = arcname[len(arcroot) + 1:] if arcroot else arcname
+            files[relpath] = _get_file_digest(path)
+    if not files:
+        return None
+    with open(manifest, 'w') as f:
+        json.dump({'files': files}, f, indent=2, sort_keys=True)
+    return (manifest, '/'.join(filter(None, (arcroot, _sync_manifest))))
+
+
+def _compress_gzip_block(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_bz2_block(data):
+    return bz2.compress(data, 9)
+
+
+_block_compressors = {
+    'gz': _compress_gzip_block,
+    'bz2': _compress_bz2_block,
+}
+
+
+def compress_blocks(tarpath, archive, archiveformat, blocksize, processes):
+    """
+Compresses the tar file at `tarpath` into `archive` as a series of
+independent gzip or bzip2 streams, one per `blocksize` bytes of input. The
+streams are compressed in parallel, with at most two blocks per process in
+flight, so memory use does not grow with the size of the tar file. The result
+is a valid single file that parallel decompressors can split back into
+streams, one per core.
+    :rtype : bool
+    :param tarpath: str, path to the uncompressed tar file
+    :param archive: str, path to the archive to create
+    :param archiveformat: str, 'gz' or 'bz2'
+    :param blocksize: int, uncompressed bytes per stream
+    :param processes: int, number of compression processes
+    """
+    compressor = _block_compressors[archiveformat]
+    pool = multiprocessing.Pool(processes)
+    try:
+        with open(tarpath, 'rb') as infile:
+            with open(archive, 'wb') as outfile:
+                # results are written in order, as the oldest one completes
+                pending = collections.deque()
+                for block in iter(lambda: infile.read(blocksize), b''):
+                    if len(pending) >= processes * 2:
+                        outfile.write(pending.popleft().get())
+                    pending.append(pool.apply_async(compressor, (block,)))
+                while pending:
+                    outfile.write(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return True
+
+
+def compress_xz(tarpath, archive, blocksize, processes):
+    """
+Compresses the tar file at `tarpath` into `archive` with the `xz` utility.
+xz 5.2 and later split the output into independent blocks of `blocksize`
+bytes, which multi-threaded xz can decompress in parallel.
+    :rtype : bool
+    :param tarpath: str, path to the uncompressed tar file
+    :param archive: str, path to the archive to create
+    :param blocksize: int, uncompressed bytes per block
+    :param processes: int, number of compression threads
+    """
+    if not find_executable('xz'):
+        raise SystemError('Could not find the `xz` utility, which is required '
+                          'to create .tar.xz archives.')
+    command = ['xz', '--threads={0}'.format(processes),
+               '--block-size={0}'.format(blocksize), '-9', '-c', tarpath]
+    with open(os.devnull, 'w') as devnull:
+        # xz only accepts `--threads` and `--block-size` from version 5.2
+        if subprocess.call(command[:3] + ['--version'], stdout=devnull,
+                           stderr=subprocess.STDOUT):
+            command = ['xz', '-9', '-c', tarpath]
+    with open(archive, 'wb') as outfile:
+        returncode = subprocess.call(command, stdout=outfile)
+    if returncode:
+        raise SystemError('xz exited with an error.\n'
+                          'command = {0}\n'
+                          'return code = {1}'
+                          .format(' '.join(command), returncode))
+    return True
+
+
+def create_archive(members, archive, archiveformat, blocksize, processes):
+    """
+Writes `members` to `archive` in the layout that decompresses fastest for
+`archiveformat`.
+    :rtype : bool
+    :param members: list, (path, arcname) tuples as returned by `get_members`
+    :param archive: str, path to the archive to create
+    :param archiveformat: str, format returned by `get_archive_format`
+    :param blocksize: int, uncompressed bytes per compressed stream
+    :param processes: int, number of compression processes
+    """
+    if 'zip' == archiveformat:
+        z = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for path, arcname in members:
+                z.write(path, arcname)
+        finally:
+            z.close()
+        return True
+
+    if 'tar' == archiveformat:
+        tarpath = archive
+    else:
+        fd, tarpath = tempfile.mkstemp(suffix='.tar',
+                                       dir=os.path.dirname(archive))
+        os.close(fd)
+    try:
+        t = tarfile.open(tarpath, 'w')
+        try:
+            for path, arcname in members:
+                t.add(path, arcname, recursive=False)
+        finally:
+            t.close()
+        if 'xz' == archiveformat:
+            compress_xz(tarpath, archive, blocksize, processes)
+        elif archiveformat in _block_compressors:
+            compress_blocks(tarpath, archive, archiveformat, blocksize,
+                            processes)
+    finally:
+        if tarpath != archive:
+            os.remove(tarpath)
+    return True
+
+
+def main(source=None,
+         archive=None,
+         arcroot=None,
+         blocksize=None,
+         processes=None,
+         **kwargs):
+    """
+    Packages a directory of salt content or a salt formula into an archive
+    that `SystemPrep-LinuxSaltInstall.py` can extract.
+    The archive format is taken from the file name of `archive`. Compressed
+    tar archives are written as a series of independent streams, which
+    pigz, lbzip2, pbzip2 and xz decompress across cores on the target system.
+    .tar.bz2 decompresses fastest on multi-core systems; .zip is required for
+    `saltcontentdelta`.
+    If the directory contains salt custom modules, e.g. under `_modules`,
+    `_states` or `_grains`, a manifest of their digests is written to the
+    root of the archive as `.systemprep-sync.json`. The installer compares
+    it to the minion's extmods cache and skips the sync when no module
+    changed. When one type with a targeted saltutil sync changed, it syncs
+    only that type, and runs `saltutil.sync_all` for any other change. The
+    modules are shipped as source only.
+    :param source: str, path to the directory to package
+    :param archive: str, path to the archive to create. must end in .zip,
+                    .tar, .tar.gz, .tgz, .tar.bz2, .tbz, .tar.xz or .txz
+    :param arcroot: str, optional directory name to nest the members under,
+                    e.g. 'ash-linux-formula-master' for a formula archive
+    :param blocksize: str, uncompressed bytes per compressed stream. default
+                      is 900000 for bzip2, and 8 MiB for gzip and xz
+    :param processes: str, number of compression processes. default is the
+                      number of cores
+    :param kwargs: dict, catch-all for other params
+    :raise SystemError: error raised whenever an issue is encountered
+    """
+    scriptname = __file__
+
+    print('+' * 80)
+    print('Entering script -- ' + scriptname)
+    print('Printing parameters...')
+    print('    source = {0}'.format(source))
+    print('    archive = {0}'.format(archive))
+    print('    arcroot = {0}'.format(arcroot))
+    print('    blocksize = {0}'.format(blocksize))
+    print('    processes = {0}'.format(processes))
+    for key, value in kwargs.items():
+        print('    {0} = {1}'.format(key, value))
+
+    if not source or not os.path.isdir(source):
+        raise SystemError('`source` must be the path to a directory.')
+    if not archive:
+        raise SystemError('`archive` is a required parameter.')
+
+    archive = os.path.abspath(archive)
+    archiveformat = get_archive_format(archive)
+    blocksize = int(blocksize or _default_block_sizes.get(archiveformat, 0))
+    processes = int(processes or multiprocessing.cpu_count())
+
+    members = get_members(source, arcroot)
+    workingdir = tempfile.mkdtemp(dir=os.path.dirname(archive))
+    try:
+        manifest = write_sync_manifest(
+            members, arcroot, os.sep.join((workingdir, _sync_manifest)))
+        if manifest:
+            members.append(manifest)
+        create_archive(members, archive, archiveformat, blocksize, processes)
+    finally:
+        shutil.rmtree(workingdir)
+
+    print('Created archive -- \n'
+          '    source  = {0}\n'
+          '    archive = {1}\n'
+          '    format  = {2}\n'
+          '    members = {3}\n'
+          '    bytes   = {4}'.format(source, archive, archiveformat,
+                                     len(members), os.path.getsize(archive)))
+    print(str(scriptname) + ' complete!')
+    print('-' * 80)
+
+
+if __name__ == "__main__":
+    # convert command line parameters of the form `param=value` to a dict
+    kwargs = dict(x.split('=', 1) for x in sys.argv[1:])
+    # Convert parameter keys to lowercase, parameter values are unmodified
+    kwargs = dict((k.lower(), v) for k, v in kwargs.items())
+
+    main(**kwargs)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+import json
+import os
+import re
+import sys
+import tarfile
+
+
+_phase_pattern = re.compile(r'Completed phase -- name = (?P<name>.+?), '
+                            r'start = (?P<start>[\d.]+), '
+                            r'seconds = (?P<seconds>[\d.]+)')
+_dist_pattern = re.compile(r'Detected distribution -- dist = (?P<dist>\S+), '
+                           r'version = (?P<version>\S+), '
+                           r'epel_version = (?P<epel_version>\S+)')
+_master_log_pattern = re.compile(r'^systemprep-.+\.log$')
+_salt_results_log_pattern = re.compile(r'^saltcall\.results.*\.log$')
+_salt_state_pattern = re.compile(r'^  (?P<tag>\S.*_\|-.*):\s*$')
+# yaml writes keys longer than 128 characters as `? <key>` then `: <value>`
+_salt_complex_key_pattern = re.compile(r'^  \?(?: (?P<tag>.*?))?\s*$')
+_salt_complex_value_pattern = re.compile(r'^  :(?: (?P<field>.*))?$')
+_salt_key_indent_pattern = re.compile(r'^ {0,2}\S')
+_salt_field_pattern = re.compile(r'^    (?P<key>__sls__|__id__|duration|'
+                                 r'result):\s*(?P<value>.*?)\s*$')
+_categories = ('phases', 'formulas', 'states')
+
+
+def iter_log_files(source):
+    """
+Yields a (rundir, filename, text) tuple for every master log and salt results
+log under `source`, which may be a directory or a tarball of directories.
+Symlinks, such as `/var/log/systemprep.log`, are skipped so a run is not
+counted twice.
+    :rtype : generator
+    :param source: str, path to a directory or tarball of per-host logs
+    """
+    def is_log(filename):
+        return _master_log_pattern.match(filename) or \
+            _salt_results_log_pattern.match(filename)
+
+    if os.path.isfile(source) and tarfile.is_tarfile(source):
+        # TarFile is not a context manager on python 2.6
+        archive = tarfile.open(source, 'r:*')
+        try:
+            for member in archive:
+                filename = os.path.basename(member.name)
+                if member.isfile() and is_log(filename):
+                    text = archive.extractfile(member).read()
+                    yield (os.path.dirname(member.name), filename,
+                           text.decode('utf-8', 'replace'))
+        finally:
+            archive.close()
+        return
+
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if is_log(filename) and not os.path.islink(path):
+                with open(path, 'rb') as f:
+                    yield (dirpath, filename,
+                           f.read().decode('utf-8', 'replace'))
+
+
+def parse_master_log(text):
+    """
+Parses the output of the master script, including the output of the content
+scripts it runs. Returns a dictionary with the keys 'dist', 'epel_version'
+and 'phases'. 'phases' maps each phase name to its duration in seconds.
+'dist' and 'epel_version' are None when the log has no `Detected
+distribution` line, e.g. a run that resumed after the yum repo phase.
+    :rtype : dict
+    :param text: str, contents of a `/var/log/systemprep-*.log` file
+    """
+    run = {'dist': None, 'epel_version': None, 'phases': {}}
+    for line in text.splitlines():
+        m = _phase_pattern.search(line)
+        if m:
+            run['phases'][m.group('name')] = float(m.group('seconds'))
+            continue
+        m = _dist_pattern.search(line)
+        if m:
+            run['dist'] = m.group('dist')
+            run['epel_version'] = m.group('epel_version')
+    return run
+
+
+def parse_salt_results(text):
+    """
+Parses the yaml output of `salt-call --out yaml`, without requiring a yaml
+library. Returns a list of dictionaries, one per state, with the keys
+'state', 'sls', 'seconds' and 'result'. 'state' combines the state function
+and id, e.g. 'pkg.installed aide'.
+    :rtype : list
+    :param text: str, contents of a `saltcall.results.log` file
+    """
+    def new_state(tag):
+        tag = tag.strip('\'"').split('_|-')
+        state = {
+            'state': '{0}.{1} {2}'.format(tag[0], tag[-1], tag[1])
+                     if len(tag) >= 4 else '_|-'.join(tag),
+            'sls': None,
+            'seconds': None,
+            'result': None,
+        }
+        states.append(state)
+        return state
+
+    states = []
+    state = None
+    complexkey = None
+    for line in text.splitlines():
+        m = _salt_state_pattern.match(line)
+        if m:
+            state, complexkey = new_state(m.group('tag')), None
+            continue
+        m = _salt_complex_key_pattern.match(line)
+        if m:
+            state, complexkey = None, [m.group('tag') or '']
+            continue
+        m = _salt_complex_value_pattern.match(line)
+        if m and complexkey is not None:
+            state = new_state(' '.join(x for x in complexkey if x))
+            complexkey = None
+            # the first field of the state follows the `: ` indicator
+            line = '    ' + (m.group('field') or '')
+        elif _salt_key_indent_pattern.match(line):
+            # any other line at or above the key indent ends the state, so
+            # its fields are not attributed to the previous one
+            state, complexkey = None, None
+            continue
+        elif complexkey is not None:
+            # a long key may be folded over several lines
+            complexkey.append(line.strip())
+            continue
+        m = _salt_field_pattern.match(line)
+        if state is None or not m:
+            continue
+        key, value = m.group('key'), m.group('value').strip('\'"')
+        if 'duration' == key:
+            number = re.match(r'[\d.]+', value)
+            if number:
+                # salt reports the duration in milliseconds
+                state['seconds'] = float(number.group(0)) / 1000
+        elif '__sls__' == key:
+            state['sls'] = value
+        elif 'result' == key:
+            state['result'] = value.lower()
+    return states
+
+
+def load_runs(source):
+    """
+Returns a list of run dictionaries, one per master log under `source`. Each
+run has the keys 'source', 'dist', 'epel_version', 'phases', 'formulas' and
+'states', where the last three map a name to a duration in seconds. Salt
+results are attributed to the latest master log in the same directory. A run
+with no `Detected distribution` line takes the distribution of an earlier
+master log in the same directory, which is the same host.
+    :rtype : list
+    :param source: str, path to a directory or tarball of per-host logs
+    """
+    masterlogs = {}
+    saltresults = {}
+    for rundir, filename, text in iter_log_files(source):
+        if _master_log_pattern.match(filename):
+            masterlogs.setdefault(rundir, []).append((filename, text))
+        else:
+            saltresults.setdefault(rundir, []).extend(
+                parse_salt_results(text))
+
+    runs = []
+    for rundir in sorted(masterlogs):
+        logs = sorted(masterlogs[rundir])
+        dist = (None, None)
+        for index, (filename, text) in enumerate(logs):
+            run = parse_master_log(text)
+            if run['dist']:
+                dist = (run['dist'], run['epel_version'])
+            else:
+                run['dist'], run['epel_version'] = dist
+            run['source'] = os.path.join(rundir, filename)
+            run['formulas'] = {}
+            run['states'] = {}
+            if index == len(logs) - 1:
+                for state in saltresults.get(rundir, []):
+                    if state['seconds'] is None:
+                        continue
+                    run['states'][state['state']] = state['seconds']
+                    formula = (state['sls'] or 'unknown').split('.')[0]
+                    run['formulas'][formula] = \
+                        run['formulas'].get(formula, 0) + state['seconds']
+            runs.append(run)
+    return runs
+
+
+def percentile(values, percent):
+    """
+Returns the nearest-rank percentile of `values`.
+    :rtype : float
+    :param values: list, numbers to summarize
+    :param percent: float, percentile to compute, from 0 to 100
+    """
+    ordered = sorted(values)
+    rank = int(-(-percent * len(ordered) // 100))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarize(runs):
+    """
+Aggregates the durations of `runs`. Returns a dictionary keyed by group,
+'all' plus one '<dist> el<epel_version>' group per distribution. A run
+with no distribution is only counted in 'all'. Each group maps a category ('phases', 'formulas', 'states') to a dictionary of
+name -> {'count', 'p50', 'p95', 'p99'}.
+    :rtype : dict
+    :param runs: list, runs as returned by `load_runs`
+    """
+    durations = {}
+    for run in runs:
+        groups = ('all',)
+        if run['dist']:
+            groups += ('{0} el{1}'.format(run['dist'], run['epel_version']),)
+        for group in groups:
+            for category in _categories:
+                names = durations.setdefault(group, {}).setdefault(
+                    category, {})
+                for name, seconds in run[category].items():
+                    names.setdefault(name, []).append(seconds)
+
+    summary = {}
+    for group, categories in durations.items():
+        for category, names in categories.items():
+            summary.setdefault(group, {})[category] = dict(
+                (name, {
+                    'count': len(values),
+                    'p50': percentile(values, 50),
+                    'p95': percentile(values, 95),
+                    'p99': percentile(values, 99),
+                }) for name, values in names.items())
+    return summary
+
+
+def compare(baseline, candidate, threshold):
+    """
+Compares the 'all' group of two summaries. Returns a dictionary mapping each
+category to a list of dictionaries with the keys 'name', 'baseline_p50',
+'candidate_p50', 'baseline_p95', 'candidate_p95', 'change' and 'regression'.
+'change' is the relative change of p95, and 'regression' is True when it
+exceeds `threshold`.
+    :rtype : dict
+    :param baseline: dict, summary of the baseline batch
+    :param candidate: dict, summary of the candidate batch
+    :param threshold: float, relative p95 increase that counts as a regression
+    """
+    comparison = {}
+    for category in _categories:
+        before = baseline.get('all', {}).get(category, {})
+        after = candidate.get('all', {}).get(category, {})
+        rows = []
+        for name in sorted(set(before) & set(after)):
+            change = (after[name]['p95'] - before[name]['p95']) / \
+                before[name]['p95'] if before[name]['p95'] else 0.0
+            rows.append({
+                'name': name,
+                'baseline_p50': before[name]['p50'],
+                'candidate_p50': after[name]['p50'],
+                'baseline_p95': before[name]['p95'],
+                'candidate_p95': after[name]['p95'],
+                'change': change,
+                'regression': change > threshold,
+            })
+        rows.sort(key=lambda r: r['change'], reverse=True)
+        comparison[category] = rows
+    return comparison
+
+
+def format_summary(summary, top):
+    """
+Returns the summary as a text report, listing the `top` slowest entries of
+each category by p95.
+    :rtype : str
+    :param summary: dict, as returned by `summarize`
+    :param top: int, number of entries to list per category
+    """
+    lines = []
+    for group in sorted(summary, key=lambda g: (g != 'all', g)):
+        for category in _categories:
+            names = summary[group].get(category, {})
+            if not names:
+                continue
+            lines.append('')
+            lines.append('== {0} -- {1} =='.format(group, category))
+            lines.append('{0:<56} {1:>6} {2:>9} {3:>9} {4:>9}'
+                         .format('name', 'runs', 'p50', 'p95', 'p99'))
+            ordered = sorted(names.items(), key=lambda i: i[1]['p95'],
+                             reverse=True)
+            for name, stats in ordered[:top]:
+                lines.append('{0:<56} {1:>6} {2:>9.2f} {3:>9.2f} {4:>9.2f}'
+                             .format(name[:56], stats['count'], stats['p50'],
+                                     stats['p95'], stats['p99']))
+    return '\n'.join(lines)
+
+
+def format_comparison(comparison, top):
+    """
+Returns the comparison as a text report, listing the `top` entries of each
+category with the largest p95 increase.
+    :rtype : str
+    :param comparison: dict, as returned by `compare`
+    :param top: int, number of entries to list per category
+    """
+    lines = []
+    for category in _categories:
+        rows = comparison.get(category, [])
+        if not rows:
+            continue
+        lines.append('')
+        lines.append('== regression -- {0} =='.format(category))
+        lines.append('{0:<44} {1:>9} {2:>9} {3:>9} {4:>9} {5:>8}'
+                     .format('name', 'base p50', 'new p50', 'base p95',
+                             'new p95', 'change'))
+        for row in rows[:top]:
+            lines.append('{0:<44} {1:>9.2f} {2:>9.2f} {3:>9.2f} {4:>9.2f} '
+                         '{5:>+7.1%}{6}'
+                         .format(row['name'][:44], row['baseline_p50'],
+                                 row['candidate_p50'], row['baseline_p95'],
+                                 row['candidate_p95'], row['change'],
+                                 ' !' if row['regression'] else ''))
+    return '\n'.join(lines)
+
+
+def main(logs=None,
+         baseline=None,
+         top='20',
+         threshold='0.1',
+         output='text',
+         **kwargs):
+    """
+    Aggregates the provisioning logs of many SystemPrep runs, and reports the
+    p50/p95/p99 duration of each phase, formula and salt state, overall and
+    per distribution and epel version.
+    Each run is a directory holding the `/var/log/systemprep-*.log` and
+    `saltcall.results.log` files of one host.
+    :param logs: str, path to a directory or tarball of per-host log
+                 directories
+    :param baseline: str, optional path to a directory or tarball of an
+                     earlier batch of runs. if set, the report includes a
+                     p95 regression comparison of `logs` against `baseline`
+    :param top: str, number of entries to list per category
+    :param threshold: str, relative p95 increase flagged as a regression
+    :param output: str, 'text' or 'json'
+    :param kwargs: dict, catch-all for other params
+    :raise SystemError: error raised whenever an issue is encountered
+    """
+    if not logs or not os.path.exists(logs):
+        raise SystemError('`logs` must be the path to a directory or '
+                          'tarball of provisioning logs.')
+    top = int(top)
+    threshold = float(threshold)
+
+    runs = load_runs(logs)
+    if not runs:
+        raise SystemError('No SystemPrep master logs were found in: {0}'
+                          .format(logs))
+    summary = summarize(runs)
+    nodist = [x['source'] for x in runs if not x['dist']]
+    comparison = None
+    if baseline:
+        baselineruns = load_runs(baseline)
+        if not baselineruns:
+            raise SystemError('No SystemPrep master logs were found in: {0}'
+                              .format(baseline))
+        comparison = compare(summarize(baselineruns), summary, threshold)
+
+    if 'json' == output.lower():
+        print(json.dumps({'runs': len(runs), 'runs_without_dist': nodist,
+                          'summary': summary, 'comparison': comparison},
+                         indent=2, sort_keys=True))
+        return
+
+    print('Runs analyzed: {0}'.format(len(runs)))
+    if nodist:
+        print('Runs without a detected distribution, only counted in `all`: '
+              '{0}'.format(len(nodist)))
+        for source in nodist:
+            print('    {0}'.format(source))
+    print(format_summary(summary, top))
+    if comparison is not None:
+        print(format_comparison(comparison, top))
+
+
+if __name__ == "__main__":
+    # convert command line parameters of the form `param=value` to a dict
+    kwargs = dict(x.split('=', 1) for x in sys.argv[1:])
+    # Convert parameter keys to lowercase, parameter values are unmodified
+    kwargs = dict((k.lower(), v) for k, v in kwargs.items())
+
+    main(**kwargs)
@@ -65,6 +65,22 @@ print_usage()
       environment pillar. Default is "".
   -u|--bootstrap-url|\$SYSTEMPREP_BOOTSTRAP_URL
       URL of the systemprep bootstrapper.
+  -a|--agent-socket|\$SYSTEMPREP_AGENT_SOCKET
+      Unix socket of a running systemprep agent (the master script started
+      with "Agent=True"). If the socket exists, the update is sent to the
+      agent, which reuses its warm state, instead of running the
+      bootstrapper. Default is "".
+  -g|--governed|\$SYSTEMPREP_GOVERNED
+      Run the update with a low CPU and I/O priority, inside a cgroup that
+      caps its CPU time, with capped download bandwidth and decompressor
+      threads, so it does not compete with the workload of a host serving
+      traffic. The resources the update consumed are reported in the log.
+      Default is "".
+  -f|--full-content|\$SYSTEMPREP_FULL_CONTENT
+      Download and extract the complete salt content archive. By default, a
+      zip archive is updated in place, fetching only the members that changed
+      since the last update, both by the agent and by the bootstrapper.
+      Default is "".
   -h|--help
       Display this message.
   -v|--verbose
@@ -84,11 +100,14 @@ lower()
 SYSTEMPREP_ENVIRONMENT="${SYSTEMPREP_ENVIRONMENT}"
 OUPATH="${SYSTEMPREP_OUPATH}"
 BOOTSTRAP_URL="${SYSTEMPREP_BOOTSTRAP_URL:-https://systemprep.s3.amazonaws.com/BootStrapScripts/SystemPrep-Bootstrap--Linux.sh}"
+AGENT_SOCKET="${SYSTEMPREP_AGENT_SOCKET}"
+GOVERNED="${SYSTEMPREP_GOVERNED}"
+FULL_CONTENT="${SYSTEMPREP_FULL_CONTENT}"
 VERBOSE=
 
 # Parse command-line parameters
-SHORTOPTS="hve:u:p:"
-LONGOPTS="help,verbose,environment:,bootstrap-url:,oupath:"
+SHORTOPTS="hvgfe:u:p:a:"
+LONGOPTS="help,verbose,governed,full-content,environment:,bootstrap-url:,oupath:,agent-socket:"
 ARGS=$(getopt \
     --options "${SHORTOPTS}" \
     --longoptions "${LONGOPTS}" \
@@ -125,6 +144,16 @@ do
             shift
             BOOTSTRAP_URL="${1}"
             ;;
+        -a|--agent-socket)
+            shift
+            AGENT_SOCKET="${1}"
+            ;;
+        -g|--governed)
+            GOVERNED="true"
+            ;;
+        -f|--full-content)
+            FULL_CONTENT="true"
+            ;;
         -v|--verbose)
             VERBOSE="true"
             ;;
@@ -152,16 +181,49 @@ log -v "Printing parameters:"
 log -v "  environment:   ${SYSTEMPREP_ENVIRONMENT}"
 log -v "  oupath: ${OUPATH}"
 log -v "  bootstrap-url: ${BOOTSTRAP_URL}"
+log -v "  agent-socket: ${AGENT_SOCKET}"
+log -v "  governed: ${GOVERNED}"
+log -v "  full-content: ${FULL_CONTENT}"
+
+if [ -n "${FULL_CONTENT}" ]
+then
+    SALTCONTENTDELTA="false"
+else
+    SALTCONTENTDELTA="true"
+fi
 
 
+# Execute
+if [ -n "${AGENT_SOCKET}" ] && [ -S "${AGENT_SOCKET}" ]
+then
+    log "Using systemprep agent to update systemprep content..."
+    python - "${AGENT_SOCKET}" "${SYSTEMPREP_ENVIRONMENT}" "${OUPATH}" \
+        "${GOVERNED:-false}" "${SALTCONTENTDELTA}" << 'EOT' || \
+        die "ERROR: systemprep agent failed to update content."
+import json
+import socket
+import sys
+s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+s.connect(sys.argv[1])
+s.sendall(json.dumps({'action': 'update',
+                      'params': {'entenv': sys.argv[2],
+                                 'oupath': sys.argv[3],
+                                 'governed': sys.argv[4],
+                                 'saltcontentdelta': sys.argv[5]}}) + '\n')
+response = json.loads(s.makefile().readline())
+print(json.dumps(response, indent=4))
+sys.exit(0 if 'ok' == response.get('status') else 1)
+EOT
+    log "Sucessfully updated systemprep content."
+    exit 0
+fi
+
 # Check dependencies
 if [ $(command -v curl > /dev/null 2>&1)$? -ne 0 ]
 then
     die "ERROR: Could not find 'curl'."
 fi
 
-
-# Execute
 log "Using bootstrapper to update systemprep content..."
 curl -L --retry 3 --silent --show-error "${BOOTSTRAP_URL}" | \
     sed "{
@@ -170,7 +232,8 @@ curl -L --retry 3 --silent --show-error "${BOOTSTRAP_URL}" | \
         s/^NOREBOOT=.*/NOREBOOT=\"True\"/
         s/^SALTSTATES=.*/SALTSTATES=\"None\"/
     }" | \
-    bash || \
+    SYSTEMPREP_GOVERNED="${GOVERNED:-false}" \
+    SYSTEMPREP_SALTCONTENTDELTA="${SALTCONTENTDELTA}" bash || \
     die "ERROR: systemprep bootstrapper failed."
 
 log "Sucessfully updated systemprep content."